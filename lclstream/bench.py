@@ -0,0 +1,146 @@
+""" Loopback throughput benchmarks.
+
+Each case runs a `pusher` (listening) and a `puller` (dialing
+`ndial` times) in one process, over tcp://, ipc:// or inproc://,
+and sends `count` messages of `size` bytes into a sink:
+
+* "null" - discard the messages,
+* "tar"  - `write_tar_fd` to /dev/null,
+* "dir"  - `write_dir` into a temporary directory.
+
+Every message starts with its send time, so the latency from
+send to receive is measured too.  Results are lists of dicts,
+which can be saved as JSON and `compare`d against a baseline.
+"""
+
+from typing import Dict, List, Any, Sequence
+from collections.abc import Iterator
+import itertools
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import stream
+
+from .nng import puller, pusher
+from .metrics import Metrics, measure
+from .stream_tar import write_tar_fd
+from .stream_dir import write_dir
+
+transports = ("tcp", "ipc", "inproc")
+sinks = ("null", "tar", "dir")
+
+stamp = struct.Struct('!d')
+_cases = itertools.count()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def loopback_addr(transport: str) -> str:
+    assert transport in transports, f"Invalid transport {transport}"
+    name = f"lclstream-bench-{os.getpid()}-{next(_cases)}"
+    if transport == "tcp":
+        return f"tcp://127.0.0.1:{free_port()}"
+    if transport == "ipc":
+        return f"ipc://{tempfile.gettempdir()}/{name}"
+    return f"inproc://{name}"
+
+@stream.stream
+def latency(inp: Iterator[bytes], metrics: Metrics) -> Iterator[bytes]:
+    """ Record the time since each message was sent.
+    """
+    h = metrics.histogram("latency_seconds")
+    for x in inp:
+        h.observe(time.perf_counter() - stamp.unpack_from(x)[0])
+        yield x
+
+@stream.sink
+def null_sink(inp: Iterator[bytes]) -> None:
+    for _ in inp:
+        pass
+
+def run_case(transport: str, size: int, ndial: int = 1,
+             sink: str = "null", count: int = 1000) -> Dict[str,Any]:
+    """ Time sending `count` messages of `size` bytes
+    over a loopback connection.
+    """
+    assert sink in sinks, f"Invalid sink {sink}"
+    assert size >= stamp.size and count > 0 and ndial > 0
+    addr = loopback_addr(transport)
+    body = os.urandom(size)[stamp.size:]
+    listening = threading.Event()
+    received = threading.Event()
+
+    def messages() -> Iterator[bytes]:
+        listening.set() # pusher asks for the first message once listening
+        for _ in range(count):
+            yield stamp.pack(time.perf_counter()) + body
+        # closing the socket would discard messages still queued
+        received.wait(60)
+
+    send = threading.Thread(target=lambda: messages() >> pusher(addr, 0)
+                                                      >> null_sink(),
+                            daemon=True)
+    send.start()
+    listening.wait()
+
+    metrics = Metrics()
+    inp = puller(addr, ndial) >> stream.take(count) \
+                              >> latency(metrics) >> measure(metrics)
+    t0 = time.perf_counter()
+    if sink == "null":
+        inp >> null_sink()
+    elif sink == "tar":
+        with open(os.devnull, "wb") as f:
+            inp >> write_tar_fd(f.fileno(), "%08d.h5")
+    else:
+        with tempfile.TemporaryDirectory(prefix="lclstream-bench") as d:
+            inp >> write_dir(d, "%08d.h5")
+    dt = max(time.perf_counter() - t0, 1e-9)
+    received.set()
+    send.join()
+
+    n = metrics.counters.get("messages", 0)
+    lat = metrics.histograms["latency_seconds"]
+    return {"transport": transport, "size": size, "ndial": ndial,
+            "sink": sink, "count": n, "seconds": dt,
+            "mb_per_s": metrics.counters.get("bytes", 0)/dt/1024**2,
+            "msgs_per_s": n/dt,
+            "p50": lat.quantile(0.5), "p99": lat.quantile(0.99)}
+
+def sweep(transports: Sequence[str] = transports,
+          sizes: Sequence[int] = (1024, 1024**2),
+          ndials: Sequence[int] = (1,),
+          sinks: Sequence[str] = ("null",),
+          count: int = 1000) -> List[Dict[str,Any]]:
+    """ Run every combination of the parameters.
+    """
+    return [run_case(t, sz, n, s, count)
+            for t in transports for sz in sizes
+            for n in ndials for s in sinks]
+
+def case_key(r: Dict[str,Any]) -> tuple:
+    return (r["transport"], r["size"], r["ndial"], r["sink"])
+
+def compare(results: List[Dict[str,Any]],
+            baseline: List[Dict[str,Any]],
+            tolerance: float = 0.1) -> List[str]:
+    """ List the cases whose throughput dropped more than
+    `tolerance` (as a fraction) below the baseline.
+    Cases missing from the baseline are skipped.
+    """
+    base = {case_key(r): r for r in baseline}
+    slow = []
+    for r in results:
+        b = base.get(case_key(r))
+        if b is None:
+            continue
+        if r["mb_per_s"] < (1-tolerance)*b["mb_per_s"]:
+            slow.append("%s size=%d ndial=%d sink=%s: %.1f MB/sec (baseline %.1f)"
+                        % (case_key(r) + (r["mb_per_s"], b["mb_per_s"])))
+    return slow
@@ -1,22 +1,35 @@
 #!/usr/bin/env python3
 
-import time
-from typing import Annotated, Optional, List, Tuple, Dict, Any
+from typing import Annotated, Optional, List, Tuple, Dict, Any, Union
 from collections.abc import Iterator
 from pathlib import Path
-import asyncio
-import json
+import os
 import sys
 import signal
+import tempfile
 
 import stream
 import typer
-import yaml
-from certified import Certified
 
-from .nng import puller, pusher
-from .stream_utils import clock
-from .stream_tar import write_tar
+from .nng import puller, pusher, aio_puller, aio_pusher, request, serving
+from .stream_tar import write_tar_fd
+from .stream_dir import write_dir
+from .stream_prefetch import prefetch
+from .stream_chunks import (
+    file_messages,
+    chunk_writer,
+    fetch_manifest,
+    manifest_handler,
+)
+from .manifest import Progress, commit_count, is_file, rewind
+from .stream_batch import batch, unbatch
+from .stream_compress import compress, decompress
+from .stream_check import checksum, verify, modes
+from .stream_seq import sequence, reorder
+from .relay import Outlet, fan_out
+from .spool import spooled
+from .transfers import load_configs, expand, unique_labels, request_all, cancel_all, merge
+from .metrics import Metrics, measure, reporting
 
 from lclstream import __version__
 
@@ -25,6 +38,38 @@ app = typer.Typer()
 def readfile(fname: Path) -> bytes:
     return fname.read_bytes()
 
+def socket_opts(kind: str, buffer: Optional[int],
+                timeout: Optional[int]) -> Dict[str,Union[str,int]]:
+    """ nng socket options for one direction ("send" or "recv").
+    """
+    opts : Dict[str,Union[str,int]] = {}
+    if buffer is not None:
+        opts[f"{kind}_buffer_size"] = buffer
+    if timeout is not None:
+        opts[f"{kind}_timeout"] = timeout
+    return opts
+
+def receive(addr: str, ndial: int, aio: bool = False,
+            zerocopy: bool = False,
+            opts: Optional[Dict[str,Union[str,int]]] = None,
+            credits: Optional[str] = None, window: int = 64,
+            inflight: int = 4, on_corrupt: str = "raise",
+            metrics: Optional[Metrics] = None,
+            require_checksum: bool = False,
+           ) -> Iterator[Union[bytes,memoryview]]:
+    """ Messages pulled from `addr`, with their checksums
+    verified (see `verify` for `on_corrupt` and
+    `require_checksum`), decompressed and unbatched.
+    """
+    if aio:
+        inp = aio_puller(addr, ndial, inflight, opts, metrics)
+    else:
+        inp = puller(addr, ndial, zerocopy, opts, credits, window)
+    inp >>= verify(0 if zerocopy else 4, on_corrupt, metrics,
+                   require_checksum)
+    inp >>= decompress(0 if zerocopy else 4)
+    return inp >> unbatch()
+
 @app.command()
 def pull(listen: Annotated[
             Optional[str],
@@ -46,10 +91,147 @@ def pull(listen: Annotated[
             bool,
             typer.Option("--quiet", "-q", help="Quiet. Don't output to stderr."),
         ] = False,
+        aio: Annotated[
+            bool,
+            typer.Option("--aio", help="Receive with asyncio, keeping several receives in flight."),
+        ] = False,
+        zerocopy: Annotated[
+            bool,
+            typer.Option("--zerocopy", help="Write messages to stdout straight from nng's receive buffers."),
+        ] = False,
+        output_dir: Annotated[
+            Optional[Path],
+            typer.Option("--output-dir", "-o", help="Write each message to its own file in this directory instead of a tarfile to stdout."),
+        ] = None,
+        writers: Annotated[
+            int,
+            typer.Option(help="Number of writer threads (with --output-dir)."),
+        ] = 4,
+        fsync: Annotated[
+            int,
+            typer.Option(help="Flush files to disk in batches of this size (with --output-dir, 0 to disable)."),
+        ] = 0,
+        atomic: Annotated[
+            bool,
+            typer.Option("--atomic", help="Write to a temporary name, then rename into place (with --output-dir)."),
+        ] = False,
+        resume: Annotated[
+            Optional[Path],
+            typer.Option(help="Progress file recording the number of messages written.  Numbering resumes from the count found there.  A tar file on stdout is resumed in place when opened for appending (>>)."),
+        ] = None,
+        control: Annotated[
+            Optional[str],
+            typer.Option(help="Address to listen at (URL format) for a pusher asking how many messages to skip (needs --resume)."),
+        ] = None,
+        metrics: Annotated[
+            Optional[Path],
+            typer.Option(help="Export metrics to this file periodically (Prometheus text format if it ends in .prom, else JSON lines)."),
+        ] = None,
+        metrics_interval: Annotated[
+            float,
+            typer.Option(help="Seconds between metrics exports."),
+        ] = 10.0,
+        recv_buffer: Annotated[
+            Optional[int],
+            typer.Option(help="Messages buffered in the receive socket (0-8192)."),
+        ] = None,
+        recv_timeout: Annotated[
+            Optional[int],
+            typer.Option(help="Milliseconds to wait for a message before checking whether the stream has ended."),
+        ] = None,
+        inflight: Annotated[
+            int,
+            typer.Option(help="Receives kept in flight (with --aio)."),
+        ] = 4,
+        credits: Annotated[
+            Optional[str],
+            typer.Option(help="Grant the pusher credits at this address (URL format), so it sends no more than --window messages ahead of this puller."),
+        ] = None,
+        window: Annotated[
+            int,
+            typer.Option(help="Messages granted at a time (with --credits)."),
+        ] = 64,
+        seq: Annotated[
+            bool,
+            typer.Option("--seq", help="Put messages numbered by push --seq back in order, and name files by their sequence numbers."),
+        ] = False,
+        reorder_window: Annotated[
+            int,
+            typer.Option(help="Messages held waiting for a missing one before giving up on it (with --seq)."),
+        ] = 1024,
+        splice: Annotated[
+            bool,
+            typer.Option("--splice", help="When stdout is a pipe, move messages into it with vmsplice instead of copying them."),
+        ] = False,
+        index: Annotated[
+            Optional[Path],
+            typer.Option(help="Also write an index of the tar members (name, offset, size, time, number) to this file, for random access with TarIndex."),
+        ] = None,
+        h5_out: Annotated[
+            Optional[str],
+            typer.Option(help="Append the datasets of every (hdf5) message along an event axis into large hdf5 files, named with this pattern (containing a numeric format specifier like %03d)."),
+        ] = None,
+        h5_dataset: Annotated[
+            Optional[List[str]],
+            typer.Option(help="Dataset to keep (with --h5-out, repeat for each; default: all)."),
+        ] = None,
+        h5_compress: Annotated[
+            Optional[str],
+            typer.Option(help="Compression for --h5-out: gzip, lzf, lz4, zstd, blosc or bitshuffle."),
+        ] = None,
+        h5_chunk: Annotated[
+            int,
+            typer.Option(help="Events per hdf5 chunk (with --h5-out)."),
+        ] = 64,
+        rollover_gb: Annotated[
+            float,
+            typer.Option(help="Start a new file after this many GB (with --h5-out, uncompressed, 0 for no limit)."),
+        ] = 4.0,
+        shm: Annotated[
+            Optional[str],
+            typer.Option(help="Put messages into a shared memory ring with this name, for local processes to read with RingReader."),
+        ] = None,
+        shm_slots: Annotated[
+            int,
+            typer.Option(help="Messages the shared memory ring holds (with --shm)."),
+        ] = 64,
+        shm_slot_mb: Annotated[
+            float,
+            typer.Option(help="Largest message size in MB (with --shm)."),
+        ] = 8.0,
+        shm_policy: Annotated[
+            str,
+            typer.Option(help="When the shared memory ring is full: block (wait for the slowest reader) or overwrite (the oldest message)."),
+        ] = "block",
+        spool_mb: Annotated[
+            float,
+            typer.Option(help="Keep receiving while the output stalls, holding up to this many MB of messages in memory, and spilling the rest to disk (0 to disable)."),
+        ] = 0,
+        spool_dir: Annotated[
+            Optional[Path],
+            typer.Option(help="Directory for spool files (with --spool-mb, default: system temp dir)."),
+        ] = None,
+        on_corrupt: Annotated[
+            str,
+            typer.Option(help="When a message fails its checksum (see push --checksum): raise (stop with an error), log (count it and keep it) or drop (count it and leave it out)."),
+        ] = "raise",
+        require_checksum: Annotated[
+            bool,
+            typer.Option("--require-checksum", help="Treat messages without a checksum (see push --checksum) as corrupt, so that damage to the checksum header is caught too."),
+        ] = False,
+        workers: Annotated[
+            int,
+            typer.Option(help="Number of processes, each dialing the address and writing its share of the messages to its own shard."),
+        ] = 1,
+        shards: Annotated[
+            str,
+            typer.Option(help="Tar file names for the shards (with --workers, containing a numeric format specifier like %02d).  File (or tar member) names are prefixed by the worker number, so the shards can be extracted together."),
+        ] = "shard-%02d.tar",
     ) -> None:
     """
     Pull data from an open nng stream, printing as
-    a tarfile format to stdout.
+    a tarfile format to stdout (or writing to --output-dir,
+    --h5-out or --shm).
     """
 
     assert (dial is None) != (listen is None), "Use either dial or listen to specify an address."
@@ -63,12 +245,142 @@ def pull(listen: Annotated[
 
     if ndial is None: # wasn't set above, must be dialing
         ndial = 1
+    assert not (aio and zerocopy), "Use either aio or zerocopy."
+    assert not (zerocopy and output_dir), "zerocopy only writes to stdout."
+    assert not (aio and credits), "credits are not available with aio."
+    assert not (zerocopy and seq), "zerocopy buffers can't be held for reordering."
+    assert not (zerocopy and splice), "zerocopy buffers can't be held for splicing."
+    assert not (output_dir and index), "index is only written for tar output."
+    assert not (output_dir and h5_out), "Use either output-dir or h5-out."
+    assert not (resume and h5_out), "h5-out can't resume (events are buffered before writing)."
+    assert sum(x is not None for x in (output_dir, h5_out, shm)) <= 1, \
+            "Use only one of output-dir, h5-out and shm."
+    assert not (shm and (index or resume)), "shm keeps no index or progress."
+    if shm is not None:
+        from .shm_ring import policies
+        assert shm_policy in policies, f"Invalid shm-policy {shm_policy}"
+    assert on_corrupt in modes, f"Invalid on-corrupt {on_corrupt}"
+    assert workers > 0
+
+    if workers > 1:
+        assert ndial > 0, "Workers must dial."
+        assert not (resume or control or seq or index or h5_out or shm), \
+                "Workers only write tar or directory shards."
+        pull_workers(workers, shards, quiet, metrics, metrics_interval,
+                     dict(dial=addr, ndial=ndial, names=names, aio=aio,
+                          zerocopy=zerocopy, output_dir=output_dir,
+                          writers=writers, fsync=fsync, atomic=atomic,
+                          recv_buffer=recv_buffer,
+                          recv_timeout=recv_timeout, inflight=inflight,
+                          credits=credits, window=window,
+                          spool_mb=spool_mb, spool_dir=spool_dir,
+                          on_corrupt=on_corrupt,
+                          require_checksum=require_checksum))
+        return
+
+    progress = None
+    start = 0
+    if resume is not None:
+        progress = Progress(resume)
+        start = progress.start
+    else:
+        assert control is None, "Control requires a progress file (--resume)."
 
-    inp = puller(addr, ndial)
-    if not quiet: # add a display?
-        inp >>= display_sz
+    opts = socket_opts("recv", recv_buffer, recv_timeout)
+    stats = Metrics()
+    inp = receive(addr, ndial, aio, zerocopy, opts, credits, window,
+                  inflight, on_corrupt, stats, require_checksum)
+    inp >>= measure(stats)
+    if spool_mb > 0:
+        inp >>= spooled(int(spool_mb*1024**2),
+                        None if spool_dir is None else str(spool_dir),
+                        metrics=stats)
+    if seq:
+        inp >>= reorder(reorder_window, stats)
 
-    inp >> write_tar(sys.stdout, names)
+    def run() -> None:
+        nonlocal inp
+        if shm is not None:
+            from .shm_ring import write_shm
+            inp >> write_shm(shm, shm_slots, int(shm_slot_mb*1024**2),
+                             shm_policy, numbered=seq)
+            return
+        if h5_out is not None:
+            from .stream_h5 import write_h5
+            inp >> write_h5(h5_out, h5_dataset, h5_compress, h5_chunk,
+                            rollover=int(rollover_gb*1024**3),
+                            numbered=seq)
+            return
+        if output_dir is not None:
+            inp >> write_dir(output_dir, names, writers, fsync, atomic,
+                             start, progress, seq, stats)
+            return
+        sys.stdout.flush()
+        fd = sys.stdout.fileno()
+        offset = 0
+        if progress is not None:
+            if is_file(fd):
+                offset = rewind(fd, progress)
+                inp >>= commit_count(progress, fd)
+            else:
+                assert index is None, "An index can only be resumed along with a tar file on stdout (opened with >>)."
+                inp >>= commit_count(progress)
+        inp >> write_tar_fd(fd, names, start, seq, splice, index,
+                            offset, start)
+
+    with reporting(stats, metrics, metrics_interval,
+                   None if quiet else 1.0, "Received"):
+        if control is None:
+            run()
+        else:
+            assert progress is not None
+            with serving(control, lambda req: progress.tobytes()):
+                run()
+
+def pull_worker(shard: Optional[str], kwargs: Dict[str,Any]) -> None:
+    """ Run `pull` in a worker process, sending the
+    tar output (if any) to the file `shard`.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent stops us
+    if shard is not None:
+        fd = os.open(shard, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(fd, sys.stdout.fileno())
+        os.close(fd)
+    pull(**kwargs)
+
+def shard_args(k: int, shards: str, kwargs: Dict[str,Any]
+              ) -> Tuple[Optional[str], Dict[str,Any]]:
+    """ The shard file (None with output_dir) and `pull`
+    arguments of worker `k`.  Its file names are prefixed
+    by `k`, so that no two workers write the same name -
+    whether as files or as tar members.
+    """
+    kw = dict(kwargs, names=f"{k:02d}-{kwargs['names']}")
+    return (shards % k if kwargs["output_dir"] is None else None), kw
+
+def pull_workers(workers: int, shards: str, quiet: bool,
+                 metrics: Optional[Path], metrics_interval: float,
+                 kwargs: Dict[str,Any]) -> None:
+    """ Run `pull(**kwargs)` in `workers` processes, each
+    writing its own shard, and report their combined metrics.
+    """
+    from .workers import run_workers
+    stats = Metrics()
+    with tempfile.TemporaryDirectory(prefix="lclstream-workers") as tmp:
+        args = []
+        files = []
+        for k in range(workers):
+            files.append(Path(tmp) / f"{k}.jsonl")
+            shard, kw = shard_args(k, shards, kwargs)
+            kw.update(quiet=True, metrics=files[-1],
+                      metrics_interval=min(metrics_interval, 1.0))
+            args.append((shard, kw))
+        with reporting(stats, metrics, metrics_interval,
+                       None if quiet else 1.0, "Received"):
+            codes = run_workers(pull_worker, args, files, stats)
+    failed = sum(c != 0 for c in codes)
+    if failed:
+        raise RuntimeError(f"{failed} of {workers} workers failed.")
 
 # TODO tee to a Sink:
 #@stream
@@ -86,45 +398,293 @@ def push(names: Annotated[
             int,
             typer.Option("--ndial", "-n", help="Dial-out to address if >0."),
         ] = 0,
+        aio: Annotated[
+            bool,
+            typer.Option("--aio", help="Send with asyncio, reading the next file while sending."),
+        ] = False,
+        readahead: Annotated[
+            int,
+            typer.Option(help="Number of files to read ahead of sending (0 to read each file just before it is sent)."),
+        ] = 8,
+        readahead_mb: Annotated[
+            int,
+            typer.Option(help="Stop reading ahead once this many MB are waiting to be sent."),
+        ] = 256,
+        control: Annotated[
+            Optional[str],
+            typer.Option(help="Ask a restarted pull at this address (URL format) how many files it already has, and skip those."),
+        ] = None,
+        batch_kb: Annotated[
+            int,
+            typer.Option(help="Pack files smaller than this many kB into batches of up to this size (0 to send every file on its own)."),
+        ] = 0,
+        batch_ms: Annotated[
+            float,
+            typer.Option(help="Send a partial batch once it has waited this many milliseconds."),
+        ] = 10.0,
+        compress_with: Annotated[
+            Optional[str],
+            typer.Option("--compress", help="Compress messages with this codec (zlib, or zstd/lz4 if installed)."),
+        ] = None,
+        checksum_with: Annotated[
+            Optional[str],
+            typer.Option("--checksum", help="Add a checksum to each message, for pull to verify: crc32, or crc32c/xxh3 if installed (auto for the fastest available)."),
+        ] = None,
+        metrics: Annotated[
+            Optional[Path],
+            typer.Option(help="Export metrics to this file periodically (Prometheus text format if it ends in .prom, else JSON lines)."),
+        ] = None,
+        metrics_interval: Annotated[
+            float,
+            typer.Option(help="Seconds between metrics exports."),
+        ] = 10.0,
+        send_buffer: Annotated[
+            Optional[int],
+            typer.Option(help="Messages buffered in the send socket before sending blocks (0-8192)."),
+        ] = None,
+        send_timeout: Annotated[
+            Optional[int],
+            typer.Option(help="Milliseconds a send may block before it is logged and retried."),
+        ] = None,
+        inflight: Annotated[
+            int,
+            typer.Option(help="Sends kept in flight (with --aio)."),
+        ] = 1,
+        credits: Annotated[
+            Optional[str],
+            typer.Option(help="Listen at this address (URL format) for credits from the puller, and only send messages it has granted."),
+        ] = None,
+        seq: Annotated[
+            bool,
+            typer.Option("--seq", help="Number the messages, so pull --seq can restore their order and detect losses."),
+        ] = False,
+        stream_id: Annotated[
+            int,
+            typer.Option(help="Stream id sent with the sequence numbers (with --seq).  Give each pusher feeding one puller its own."),
+        ] = 0,
+        seq_start: Annotated[
+            int,
+            typer.Option(help="Number of the first file (with --seq).  Pushers feeding one puller need separate ranges, since files are named by number."),
+        ] = 0,
     ) -> None:
     """ Push a list of files to an nng stream.
     Used to replay a data transmission.
     """
-    
-    messages = names >> stream.map(readfile) \
-                     >> display_sz \
-                     >> pusher(addr, ndial) \
-                     >> clock()
+    skip = 0
+    if control is not None:
+        ans = request(control, b"")
+        if ans:
+            skip = Progress.frombytes(ans)
+            print(f"Resuming after {skip} files.", file=sys.stderr)
+            names = names[skip:]
+
+    assert not (aio and credits), "credits are not available with aio."
+    # wait = reading (and packing) files, sink = sending
+    stats = Metrics()
+    if readahead > 0:
+        files = prefetch(names, readahead, readahead_mb*1024**2,
+                         metrics=stats)
+    else:
+        files = names >> stream.map(readfile)
+    opts = socket_opts("send", send_buffer, send_timeout)
+    if aio:
+        send = aio_pusher(addr, ndial, inflight, opts, stats)
+    else:
+        send = pusher(addr, ndial, opts, credits, stats)
+    if seq: # numbered by position in the full list of names
+        files >>= sequence(stream_id, seq_start+skip)
+    if batch_kb > 0:
+        files >>= batch(batch_kb*1024, batch_ms/1000)
+    if compress_with is not None:
+        files >>= compress(compress_with)
+    if checksum_with is not None:
+        files >>= checksum(None if checksum_with == "auto" else checksum_with)
+    messages = files >> measure(stats) >> send
     # run the stream
-    final = messages >> stream.last()
-    # {'count': 0, 'size': 0, 'wait': 0, 'time': time.time()}
-    if final['wait'] == 0: # prevent divide by zero exception [sic]
-        final['wait'] = -1
-    print(f"Sent {final['count']} messages in {final['wait']} seconds: {final['size']/final['wait']/1024**2} MB/sec.",
-          file=sys.stderr
-    )
-
-
-@stream.stream
-def display_sz(inp: Iterator[bytes]) -> Iterator[bytes]:
-    # Note - it's also possible to write this as a composition
-    # of stream operators...
-    #yield from (inp >> a >> b)
-    items = {'count': 0,
-             'wait': 0.0,
-             'size': 0
-            }
-    t0 = time.time() # to time the wait for input data
-    for i, x in enumerate(inp):
-        t1 = time.time()
-        sz = len(x)
-        items['count'] += 1
-        items['wait'] += t1-t0
-        items['size'] += sz
-        if i % 10 == 9:
-            print(f"At {items['count']}, {items['wait']} seconds: {items['size']/items['wait']/1024**2} MB/sec.", file=sys.stderr)
-        yield x
-        t0 = time.time()
+    with reporting(stats, metrics, metrics_interval, label="Sent"):
+        for _ in messages:
+            pass
+
+
+@app.command()
+def send_file(name: Annotated[
+            Path,
+            typer.Argument(help="File path."),
+        ],
+        addr: Annotated[str,
+            typer.Option(help="Address to dial/listen at (URL format)."),
+        ] = "tcp://127.0.0.1:3030",
+        ndial: Annotated[
+            int,
+            typer.Option("--ndial", "-n", help="Dial-out to address if >0, spreading chunks over this many connections."),
+        ] = 0,
+        chunk_mb: Annotated[
+            int,
+            typer.Option(help="Chunk size in MB."),
+        ] = 1,
+        control: Annotated[
+            Optional[str],
+            typer.Option(help="Ask recv-file at this address (URL format) which chunks it already has, and skip those."),
+        ] = None,
+        check: Annotated[
+            str,
+            typer.Option(help="Checksum: sha256, crc32 or another hashlib algorithm. Use tree-<alg> to hash chunks separately (in parallel)."),
+        ] = "sha256",
+    ) -> None:
+    """ Send one (large) file to an nng stream in chunks.
+    Use recv-file to receive it.
+    """
+    chunksz = chunk_mb*1024**2
+    skip = None
+    if control is not None:
+        skip = fetch_manifest(control, name.stat().st_size, chunksz)
+        if skip is not None:
+            print(f"Resuming with {skip.count} of {skip.nchunks} chunks.",
+                  file=sys.stderr)
+    stats = Metrics()
+    messages = file_messages(name, chunksz, check, skip) \
+                     >> measure(stats) \
+                     >> pusher(addr, ndial)
+    with reporting(stats, label="Sent"):
+        for _ in messages:
+            pass
+
+@app.command()
+def recv_file(out: Annotated[
+            Path,
+            typer.Argument(help="Output file."),
+        ],
+        listen: Annotated[
+            Optional[str],
+            typer.Option("--listen", "-l", help="Address to listen at (URL format)."),
+        ] = None,
+        dial: Annotated[
+            Optional[str],
+            typer.Option("--dial", "-d", help="Address to dial (URL format)."),
+        ] = None,
+        ndial: Annotated[
+            Optional[int],
+            typer.Option("--ndial", "-n", help="Number of simultaneous connections (dial only)"),
+        ] = None,
+        resume: Annotated[
+            bool,
+            typer.Option("--resume", help="Keep a manifest of the chunks written (OUT.manifest), so an interrupted transfer can be resumed."),
+        ] = False,
+        control: Annotated[
+            Optional[str],
+            typer.Option(help="Address to listen at (URL format) for send-file asking which chunks are already here (needs --resume)."),
+        ] = None,
+        check: Annotated[
+            str,
+            typer.Option(help="Checksum (must match send-file): sha256, crc32 or another hashlib algorithm. Use tree-<alg> to hash chunks separately (in parallel)."),
+        ] = "sha256",
+    ) -> None:
+    """ Receive one file sent in chunks by send-file.
+    Chunks are written as they arrive, in any order.
+    """
+    manifest = None
+    if resume:
+        manifest = out.with_name(out.name + ".manifest")
+    else:
+        assert control is None, "Control requires --resume."
+    assert (dial is None) != (listen is None), "Use either dial or listen to specify an address."
+
+    if listen is None:
+        addr = dial
+    else:
+        assert ndial is None or ndial == 0, "Invalid ndial for listening mode"
+        ndial = 0
+        addr = listen
+
+    if ndial is None: # wasn't set above, must be dialing
+        ndial = 1
+
+    stats = Metrics()
+    written = puller(addr, ndial) \
+            >> measure(stats) \
+            >> chunk_writer(out, check, manifest)
+    with reporting(stats, label="Received"):
+        if control is None:
+            for _ in written:
+                pass
+        else:
+            assert manifest is not None
+            with serving(control, manifest_handler(manifest)):
+                for _ in written:
+                    pass
+
+@app.command()
+def relay(out: Annotated[
+            List[str],
+            typer.Option("--out", "-o", help="Address to listen at (URL format) for a downstream consumer.  Repeat for each consumer."),
+        ],
+        listen: Annotated[
+            Optional[str],
+            typer.Option("--listen", "-l", help="Address to listen at (URL format)."),
+        ] = None,
+        dial: Annotated[
+            Optional[str],
+            typer.Option("--dial", "-d", help="Address to dial (URL format)."),
+        ] = None,
+        ndial: Annotated[
+            Optional[int],
+            typer.Option("--ndial", "-n", help="Number of simultaneous connections (dial only)"),
+        ] = None,
+        mode: Annotated[
+            str,
+            typer.Option(help="balance: each message goes to one consumer.  broadcast: every message goes to all consumers."),
+        ] = "balance",
+        queue: Annotated[
+            int,
+            typer.Option(help="Messages queued per consumer."),
+        ] = 64,
+        slow: Annotated[
+            str,
+            typer.Option(help="What to do when a consumer's queue is full: block, drop or spill (to disk)."),
+        ] = "block",
+        spill_dir: Annotated[
+            Optional[Path],
+            typer.Option(help="Directory for spill files (default: system temp dir)."),
+        ] = None,
+        spill_mem_mb: Annotated[
+            Optional[float],
+            typer.Option(help="Also spill once a consumer's queue holds this many MB (with --slow spill)."),
+        ] = None,
+        quiet: Annotated[
+            bool,
+            typer.Option("--quiet", "-q", help="Quiet. Don't output to stderr."),
+        ] = False,
+    ) -> None:
+    """
+    Pull data from an open nng stream once, and
+    redistribute it to several downstream consumers.
+    """
+    assert (dial is None) != (listen is None), "Use either dial or listen to specify an address."
+
+    if listen is None:
+        addr = dial
+    else:
+        assert ndial is None or ndial == 0, "Invalid ndial for listening mode"
+        ndial = 0
+        addr = listen
+
+    if ndial is None: # wasn't set above, must be dialing
+        ndial = 1
+
+    outlets = [Outlet(o, queue, slow,
+                      None if spill_dir is None else str(spill_dir),
+                      None if spill_mem_mb is None
+                           else int(spill_mem_mb*1024**2))
+               for o in out]
+    stats = Metrics()
+    inp = puller(addr, ndial) >> measure(stats)
+    with reporting(stats, log_interval=None if quiet else 1.0,
+                   label="Relayed"):
+        n = inp >> fan_out(outlets, mode)
+    if not quiet:
+        print(f"Relayed {n} messages.", file=sys.stderr)
+        for o in outlets:
+            print(o.summary(), file=sys.stderr)
 
 """
     try:
@@ -138,72 +698,187 @@ def display_sz(inp: Iterator[bytes]) -> Iterator[bytes]:
         print("Stream completed with no data.", file=sys.stderr)
 """
 
+@app.command()
+def bench(transport: Annotated[
+            Optional[List[str]],
+            typer.Option("--transport", "-t", help="tcp, ipc or inproc (repeat to sweep; default: all)."),
+        ] = None,
+        size_kb: Annotated[
+            Optional[List[int]],
+            typer.Option(help="Message size in kB (repeat to sweep; default: 1 and 1024)."),
+        ] = None,
+        ndial: Annotated[
+            Optional[List[int]],
+            typer.Option("--ndial", "-n", help="Number of connections (repeat to sweep; default: 1)."),
+        ] = None,
+        sink: Annotated[
+            Optional[List[str]],
+            typer.Option(help="null, tar (to /dev/null) or dir (to a temporary directory) (repeat to sweep; default: null)."),
+        ] = None,
+        count: Annotated[
+            int,
+            typer.Option(help="Messages per case."),
+        ] = 1000,
+        output: Annotated[
+            Optional[Path],
+            typer.Option("--output", "-o", help="Save the results (JSON) here, e.g. as a baseline."),
+        ] = None,
+        baseline: Annotated[
+            Optional[Path],
+            typer.Option(help="Compare against results saved earlier, and exit with an error if any case got slower."),
+        ] = None,
+        tolerance: Annotated[
+            float,
+            typer.Option(help="Allowed slowdown relative to the baseline (as a fraction)."),
+        ] = 0.1,
+    ) -> None:
+    """
+    Measure push/pull throughput and latency over loopback
+    connections, printing the results as JSON to stdout.
+    """
+    import json
+    from .bench import sweep, compare
+    results = sweep(transport or ("tcp", "ipc", "inproc"),
+                    [kb*1024 for kb in size_kb or (1, 1024)],
+                    ndial or (1,), sink or ("null",), count)
+    print(json.dumps(results, indent=2))
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+    if baseline is not None:
+        slow = compare(results, json.loads(baseline.read_text()), tolerance)
+        for line in slow:
+            print(f"Slower than baseline: {line}", file=sys.stderr)
+        if slow:
+            sys.exit(1)
+
 @app.command()
 def get(config: Annotated[
-            Path,
-            typer.Argument(help="LCLStreamer configuration file (json or yaml format)"),
+            List[Path],
+            typer.Argument(help="LCLStreamer configuration files (json or yaml format).  A file holding a list of configurations requests a transfer for each."),
         ],
         server: Annotated[
             str,
             typer.Option(help="API server name (Certified URL format)."),
         ] = "https://sdfdtn003.slac.stanford.edu:4433",
+        expand_key: Annotated[
+            Optional[List[str]],
+            typer.Option("--expand", help="Request one transfer for each value of a config entry holding a list (e.g. runs or detectors, with dots separating nested keys).  Repeat to expand several."),
+        ] = None,
+        names: Annotated[
+            str,
+            typer.Option(help="Naming scheme for output files (must contain a single numeric format specifier like %d or %x).  With several transfers, names are prefixed by a directory for each."),
+        ] = "%05d.h5",
+        aio: Annotated[
+            bool,
+            typer.Option("--aio", help="Receive with asyncio, keeping several receives in flight."),
+        ] = False,
+        metrics: Annotated[
+            Optional[Path],
+            typer.Option(help="Export metrics to this file periodically (Prometheus text format if it ends in .prom, else JSON lines)."),
+        ] = None,
+        metrics_interval: Annotated[
+            float,
+            typer.Option(help="Seconds between metrics exports."),
+        ] = 10.0,
+        index: Annotated[
+            Optional[Path],
+            typer.Option(help="Also write an index of the tar members (name, offset, size, time, number) to this file, for random access with TarIndex."),
+        ] = None,
+        workers: Annotated[
+            int,
+            typer.Option(help="Number of processes, each dialing the stream and writing its share of the messages to its own tar shard (single transfer only)."),
+        ] = 1,
+        shards: Annotated[
+            str,
+            typer.Option(help="Tar file names for the shards (with --workers, containing a numeric format specifier like %02d)."),
+        ] = "shard-%02d.tar",
     ) -> None:
     """
-    Request a data stream from LCLStreamer-API
-    and write the contents as a tarfile to stdout.
+    Request data streams from LCLStreamer-API
+    and write the contents as a tarfile to stdout
+    (or to --workers tar shards).
+
+    Several transfers are requested concurrently, and
+    pulled in parallel into the same tarfile.
     """
 
-    if config.suffix == ".yml" or config.suffix == ".yaml":
-        cfg = yaml.safe_load( config.read_text() )
-    else:
-        cfg = json.loads( config.read_text() )
-    #print(json.dumps(cfg, indent=2))
+    sources = []
+    for path in config:
+        sources += load_configs(path)
+    for key in expand_key or []:
+        sources = expand(sources, key)
+    sources = unique_labels(sources)
+    assert workers == 1 or len(sources) == 1, \
+            "Workers are only available for a single transfer."
 
     # ask lclstream-api politely for data
+    import asyncio
+    from certified import Certified
     cert = Certified()
     headers = { "user-agent": f"lclstream/{__version__}",
                 "Accept": "application/json" }
 
-    async def request_data() -> Tuple[bool, Dict[str,Any]]:
+    async def request_data() -> List[Tuple[bool, Dict[str,Any]]]:
         async with cert.ClientSession(
                         base_url = server,
                         headers = headers,
                     ) as cli:
-            resp = await cli.post("/v1/transfers", cfg)
-            ok = resp.status_code//100 == 2
-            ans = await resp.json()
-        return ok, ans
+            return await request_all(cli, [cfg for label, cfg in sources])
 
-    async def cancel_transfer(tid: int) -> None:
+    async def cancel_transfers(tids: List[int]) -> None:
         async with cert.ClientSession(
                         base_url = server,
                         headers = headers,
                     ) as cli:
-            await cli.delete(f"/v1/transfers/{tid}")
+            await cancel_all(cli, tids)
+
+    results = asyncio.run(request_data())
+
+    # parse responses from server
+    tids : List[int] = []
+    urls : List[str] = []
+    for (label, cfg), (ok, ans) in zip(sources, results):
+        if len(sources) > 1:
+            print(label, ok, ans)
+        else:
+            print(ok, ans)
+        if ok and ans.get("id", -1) > 0:
+            tids.append(ans["id"])
+        urls.append(ans.get("url", "") if ok else "")
 
-    ok, ans = asyncio.run(request_data())
+    def cancel() -> None:
+        nonlocal tids
+        if tids:
+            asyncio.run(cancel_transfers(tids))
+        tids = []
 
-    # parse response from server
-    print(ok, ans)
-    url : str = ans.get("url", "")
-    tid : int = ans.get("id", -1)
-    if not ok or url == "":
+    if "" in urls:
+        cancel()
         sys.exit(1)
 
     def kill_transfer(sig, frame):
-        nonlocal tid
-        if tid > 0:
-            asyncio.run(cancel_transfer(tid))
-        tid = -1
+        cancel()
         sys.exit(0) # Exit the program gracefully
 
     signal.signal(signal.SIGINT, kill_transfer)
     signal.signal(signal.SIGPIPE, kill_transfer)
     signal.signal(signal.SIGTERM, kill_transfer)
 
-    # stream the response to stdout
+    # stream the responses to stdout
     try:
-        pull(dial=url, ndial=1)
+        if len(urls) == 1:
+            pull(dial=urls[0], ndial=1, names=names, aio=aio,
+                 metrics=metrics, metrics_interval=metrics_interval,
+                 index=index, workers=workers, shards=shards)
+            return
+        stats = Metrics()
+        inp = merge([(f"{label}/", lambda url=url: receive(url, 1, aio))
+                     for (label, cfg), url in zip(sources, urls)], names)
+        inp >>= measure(stats, numbered=True)
+        with reporting(stats, metrics, metrics_interval, 1.0, "Received"):
+            sys.stdout.flush()
+            inp >> write_tar_fd(sys.stdout.fileno(), names,
+                                numbered=True, index=index)
     except Exception:
         kill_transfer(None, None)
         raise
@@ -0,0 +1,194 @@
+""" On-disk progress manifests, used to resume transfers.
+
+A `ChunkManifest` is a bitmap of the chunks of a file
+that have been written (see `stream_chunks`).
+A `Progress` is the count of messages a sink has committed
+(see `pull --resume`), and for a sink writing one file,
+the file's size at that point.
+
+Both are saved periodically by writing a temporary
+file and renaming it over the old one, so a manifest
+on disk is always complete.
+"""
+
+from typing import Optional, Union, TypeVar
+from collections.abc import Iterator
+import os
+import stat
+import struct
+import time
+from pathlib import Path
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+def save_atomic(path: Union[str,os.PathLike], data: bytes) -> None:
+    tmp = f"{os.fspath(path)}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class ChunkManifest:
+    """ Bitmap of completed chunks of a file of `size`
+    bytes, split into chunks of `chunksz` bytes.
+    """
+    header = struct.Struct('!4sqq')
+    magic = b'LCLM'
+
+    def __init__(self, size: int, chunksz: int,
+                 bits: Optional[bytes] = None) -> None:
+        assert chunksz > 0
+        self.size = size
+        self.chunksz = chunksz
+        self.nchunks = (size + chunksz - 1) // chunksz
+        nbytes = (self.nchunks + 7) // 8
+        if bits is None:
+            self.bits = bytearray(nbytes)
+        else:
+            assert len(bits) == nbytes, "Invalid manifest size."
+            self.bits = bytearray(bits)
+        self.count = sum(bin(b).count("1") for b in self.bits)
+
+    def __contains__(self, i: int) -> bool:
+        return (self.bits[i >> 3] >> (i & 7)) & 1 == 1
+
+    def add(self, i: int) -> bool:
+        """ Mark chunk `i` done.  Returns False if it already was.
+        """
+        if i in self:
+            return False
+        self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+        return True
+
+    def complete(self) -> bool:
+        return self.count == self.nchunks
+
+    def tobytes(self) -> bytes:
+        return self.header.pack(self.magic, self.size, self.chunksz) \
+               + bytes(self.bits)
+
+    @classmethod
+    def frombytes(cls, buf: bytes) -> "ChunkManifest":
+        magic, size, chunksz = cls.header.unpack_from(buf)
+        assert magic == cls.magic, "Not a chunk manifest."
+        return cls(size, chunksz, buf[cls.header.size:])
+
+    def save(self, path: Union[str,os.PathLike]) -> None:
+        save_atomic(path, self.tobytes())
+
+    @classmethod
+    def load(cls, path: Union[str,os.PathLike], size: int, chunksz: int
+            ) -> "ChunkManifest":
+        """ Load the manifest saved at `path`, if it exists
+        and describes the same file layout.  Otherwise,
+        start a new (empty) manifest.
+        """
+        try:
+            m = cls.frombytes(Path(path).read_bytes())
+            if m.size == size and m.chunksz == chunksz:
+                return m
+        except (OSError, AssertionError, struct.error):
+            pass
+        return cls(size, chunksz)
+
+class Progress:
+    """ Count of messages committed by a sink,
+    saved to `path` after every `every` messages
+    or `interval` seconds, whichever comes first.
+
+    `start` is the count found on disk when created,
+    and `offset` the output file's size at that count
+    (if the sink recorded it).
+    """
+    def __init__(self, path: Union[str,os.PathLike],
+                 every: int = 100, interval: float = 1.0) -> None:
+        self.path = path
+        self.every = every
+        self.interval = interval
+        self.offset : Optional[int] = None
+        try:
+            fields = [int(x) for x in Path(path).read_text().split()]
+            self.start = fields[0]
+            if len(fields) > 1:
+                self.offset = fields[1]
+        except (OSError, ValueError, IndexError):
+            self.start = 0
+        self.count = self.start
+        self.saved = self.start
+        self.t0 = time.time()
+
+    def commit(self, count: int, offset: Optional[int] = None) -> None:
+        self.count = count
+        if offset is not None:
+            self.offset = offset
+        if count - self.saved >= self.every \
+                or time.time() - self.t0 >= self.interval:
+            self.save()
+
+    def save(self) -> None:
+        if self.offset is None:
+            save_atomic(self.path, b"%d\n" % self.count)
+        else:
+            save_atomic(self.path, b"%d %d\n" % (self.count, self.offset))
+        self.saved = self.count
+        self.t0 = time.time()
+
+    def tobytes(self) -> bytes:
+        return struct.pack('!q', self.saved)
+
+    @staticmethod
+    def frombytes(buf: bytes) -> int:
+        return struct.unpack('!q', buf)[0]
+
+T = TypeVar('T')
+
+def is_file(fd: int) -> bool:
+    return stat.S_ISREG(os.fstat(fd).st_mode)
+
+def rewind(fd: int, progress: Progress) -> int:
+    """ Cut the regular file `fd`, which a resumed sink is
+    about to append to, back to its size after the last
+    committed message.  This drops any partly written
+    message and, for a tar file, the end-of-archive blocks,
+    so that the appended messages continue the same archive.
+
+    Returns the position the new output starts at.
+    """
+    size = os.fstat(fd).st_size
+    if progress.start == 0:
+        return size
+    if progress.offset is None:
+        _logger.warning("No output size was recorded - appending as is.")
+        return size
+    if size < progress.offset:
+        _logger.warning("Output holds %d bytes, fewer than the %d "
+                        "committed - appending as is (open it with >> "
+                        "to resume).", size, progress.offset)
+        return size
+    os.ftruncate(fd, progress.offset)
+    os.lseek(fd, progress.offset, os.SEEK_SET)
+    return progress.offset
+
+@stream.stream
+def commit_count(inp: Iterator[T], progress: Progress,
+                 fd: Optional[int] = None) -> Iterator[T]:
+    """ Pass messages through to a sink that writes each one
+    before asking for the next, counting a message as
+    committed once the sink asks for the next one.
+
+    If the sink writes to a regular file `fd`, the file's
+    position is committed along with the count (see `rewind`).
+    """
+    n = progress.start
+    try:
+        for x in inp:
+            yield x
+            n += 1
+            progress.commit(n, None if fd is None
+                               else os.lseek(fd, 0, os.SEEK_CUR))
+    finally:
+        progress.save()
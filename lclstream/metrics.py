@@ -0,0 +1,260 @@
+""" Counters and fixed-bucket histograms for a running stream.
+
+`measure` is a pass-through stream stage that records, for
+every message, its size and
+
+* the inter-arrival time (since the previous message),
+* the wait - time spent waiting on the stage's input
+  (the network, for a puller),
+* the sink time - time spent downstream before the next
+  message was requested (the disk, for a writer).
+
+Together these tell whether a transfer is network-, CPU-
+or disk-bound.  Stages that queue messages internally
+report their queue depths as gauges ("recv_queue",
+"send_queue", "prefetch_queue", "write_queue" and the
+"spool_*" gauges).  Recording is a few clock reads and bisects
+per message, so it can be left on.
+
+`reporting` exports the metrics periodically, either as
+JSON lines or as a Prometheus text file, and logs
+progress to stderr.
+"""
+
+from typing import Dict, List, Optional, Union, Any, Sequence
+from collections.abc import Iterator, Callable
+from contextlib import contextmanager
+from bisect import bisect_left
+from pathlib import Path
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import stream
+
+from .manifest import save_atomic
+
+Buffer = Union[bytes, memoryview]
+
+# bucket upper bounds
+size_buckets = [float(2**k) for k in range(8, 32, 2)] # 256 B .. 1 GB
+time_buckets = [m*10.0**e for e in range(-6, 2) for m in (1, 2, 5)] + [100.0]
+
+class Histogram:
+    """ Counts of observations falling at or below each of
+    the (sorted) `bounds`, plus an overflow bucket.
+    """
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = list(bounds)
+        self.counts = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, x: float) -> None:
+        self.counts[bisect_left(self.bounds, x)] += 1
+        self.count += 1
+        self.sum += x
+        if x > self.max:
+            self.max = x
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the q-th quantile
+        (the largest value seen, for the overflow bucket).
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q*self.count
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def todict(self) -> Dict[str,Any]:
+        return {"bounds": self.bounds, "counts": list(self.counts),
+                "count": self.count, "sum": self.sum, "max": self.max,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+class Metrics:
+    """ A named set of counters, gauges and histograms.
+
+    Updates are not locked - readers on other threads may
+    see a slightly stale snapshot, which is fine for reporting.
+    Readers copy each dict before iterating over it, since
+    new names can be added while they run.
+    """
+    def __init__(self, prefix: str = "lclstream") -> None:
+        self.prefix = prefix
+        self.start = time.time()
+        self.counters : Dict[str,float] = {}
+        self.gauges : Dict[str,float] = {}
+        self.histograms : Dict[str,Histogram] = {}
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def histogram(self, name: str,
+                  bounds: Sequence[float] = time_buckets) -> Histogram:
+        try:
+            return self.histograms[name]
+        except KeyError:
+            h = self.histograms[name] = Histogram(bounds)
+            return h
+
+    def snapshot(self) -> Dict[str,Any]:
+        return {"time": time.time(),
+                "elapsed": time.time() - self.start,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {k: h.todict()
+                               for k, h in list(self.histograms.items())}}
+
+    def add(self, snap: Dict[str,Any]) -> None:
+        """ Add in a `snapshot` of other metrics (e.g. from
+        another process).  Counters and gauges are summed,
+        and histograms with the same bounds are merged.
+        """
+        for k, v in snap["counters"].items():
+            self.inc(k, v)
+        for k, v in snap["gauges"].items():
+            self.gauges[k] = self.gauges.get(k, 0) + v
+        for k, d in snap["histograms"].items():
+            h = self.histogram(k, d["bounds"])
+            if h.bounds != d["bounds"]:
+                continue
+            h.counts = [a+b for a, b in zip(h.counts, d["counts"])]
+            h.count += d["count"]
+            h.sum += d["sum"]
+            h.max = max(h.max, d["max"])
+
+    def prometheus(self) -> str:
+        """ Format in the Prometheus text exposition format.
+        """
+        out : List[str] = []
+        def name(k: str) -> str:
+            return f"{self.prefix}_{k}"
+        for k, v in list(self.counters.items()):
+            out += [f"# TYPE {name(k)}_total counter", f"{name(k)}_total {v}"]
+        for k, v in list(self.gauges.items()):
+            out += [f"# TYPE {name(k)} gauge", f"{name(k)} {v}"]
+        for k, h in list(self.histograms.items()):
+            out.append(f"# TYPE {name(k)} histogram")
+            total = 0
+            for bound, n in zip(h.bounds + [math.inf], h.counts):
+                total += n
+                le = "+Inf" if bound == math.inf else repr(bound)
+                out.append(f'{name(k)}_bucket{{le="{le}"}} {total}')
+            out += [f"{name(k)}_sum {h.sum}", f"{name(k)}_count {h.count}"]
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> str:
+        """ One line describing progress so far.
+        """
+        n = int(self.counters.get("messages", 0))
+        mb = self.counters.get("bytes", 0)/1024**2
+        dt = max(time.time() - self.start, 1e-9)
+        ans = f"{n} messages, {mb:.1f} MB in {dt:.1f} seconds: {mb/dt:.2f} MB/sec"
+        wait = self.histograms.get("wait_seconds")
+        sink = self.histograms.get("sink_seconds")
+        if wait is not None and sink is not None:
+            ans += f" (waiting {wait.sum:.1f} s, in sink {sink.sum:.1f} s)"
+        stall = self.counters.get("stall_seconds", 0) \
+              + self.counters.get("credit_wait_seconds", 0)
+        if stall > 0:
+            ans += f", stalled on backpressure {stall:.1f} s"
+        return ans
+
+    def write(self, path: Union[str,os.PathLike]) -> None:
+        """ Export to `path` - rewritten as a Prometheus text
+        file if it ends in .prom, or else appended to
+        as JSON lines.
+        """
+        if os.fspath(path).endswith(".prom"):
+            save_atomic(path, self.prometheus().encode())
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+@stream.stream
+def measure(inp: Iterator[Any], metrics: Metrics,
+            numbered: bool = False) -> Iterator[Any]:
+    """ Pass messages through, recording their count, size,
+    inter-arrival time, wait and sink time into `metrics`.
+    With `numbered`, messages are (n, msg) pairs.
+    """
+    sizes = metrics.histogram("message_bytes", size_buckets)
+    gaps = metrics.histogram("interarrival_seconds")
+    waits = metrics.histogram("wait_seconds")
+    sinks = metrics.histogram("sink_seconds")
+    clock = time.perf_counter
+    t_req = t_prev = clock()
+    for x in inp:
+        t = clock()
+        sz = len(x[1] if numbered else x)
+        metrics.inc("messages")
+        metrics.inc("bytes", sz)
+        sizes.observe(sz)
+        waits.observe(t - t_req)
+        gaps.observe(t - t_prev)
+        t_prev = t
+        yield x
+        t_req = clock()
+        sinks.observe(t_req - t)
+
+class Reporter(threading.Thread):
+    """ Call `fn()` every `interval` seconds until stopped.
+    """
+    def __init__(self, fn: Callable[[], None], interval: float) -> None:
+        super().__init__(daemon=True)
+        self.fn = fn
+        self.interval = interval
+        self.done = threading.Event()
+
+    def run(self) -> None:
+        while not self.done.wait(self.interval):
+            self.fn()
+
+    def stop(self) -> None:
+        self.done.set()
+        self.join()
+
+@contextmanager
+def reporting(metrics: Metrics,
+              path: Optional[Path] = None,
+              interval: float = 10.0,
+              log_interval: Optional[float] = 1.0,
+              label: str = "Transferred",
+             ) -> Iterator[Metrics]:
+    """ Export `metrics` to `path` (see `Metrics.write`) every
+    `interval` seconds, and print a progress line to stderr
+    every `log_interval` seconds (None for quiet).
+
+    On exit, the metrics are exported once more, and a final
+    summary is printed (unless quiet).
+    """
+    def log() -> None:
+        print(f"At {metrics.summary()}", file=sys.stderr)
+    reporters = []
+    if path is not None:
+        reporters.append(Reporter(lambda: metrics.write(path), interval))
+    if log_interval is not None:
+        reporters.append(Reporter(log, log_interval))
+    for r in reporters:
+        r.start()
+    try:
+        yield metrics
+    finally:
+        for r in reporters:
+            r.stop()
+        if path is not None:
+            metrics.write(path)
+        if log_interval is not None:
+            print(f"{label} {metrics.summary()}", file=sys.stderr)
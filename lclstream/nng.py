@@ -1,14 +1,41 @@
-from typing import TypeVar, Optional, Union
-from collections.abc import Iterator, Callable
+""" Streams over nng sockets (via pynng).
+
+To avoid copies, `sendable` and `message_view` reach into
+pynng internals that are not part of its public API: cffi's
+`ffi.from_buffer` from `pynng._nng`, and the `_buffer` of a
+received `pynng.Message` (present in pynng 0.8 and 0.9).
+Both fall back to copying through the public `send()`/`recv()`
+types (bytes) if a pynng release drops them.
+"""
+from typing import TypeVar, Optional, Union, Any
+from collections.abc import Iterator, Iterable, AsyncIterator, AsyncIterable, Callable
 import io
 import time
+import struct
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager
 import logging
 _logger = logging.getLogger(__name__)
 
 import stream
-import h5py # type: ignore[import-untyped]
-from pynng import Push0, Pull0, Timeout, ConnectionRefused # type: ignore[import-untyped]
+from pynng import Push0, Pull0, Req0, Rep0, Timeout, TryAgain, ConnectionRefused # type: ignore[import-untyped]
+try: # private - see module docstring
+    from pynng._nng import ffi # type: ignore[import-untyped]
+except ImportError:
+    ffi = None
+
+from .stream_utils import iterate_async
+from .metrics import Metrics
 
+# Defaults for the socket options below, which can be
+# overridden per socket with the `opts` arguments.
+#   send_buffer_size / recv_buffer_size - messages queued
+#       in the socket (0-8192), before send blocks / beyond
+#       those already received
+#   send_timeout / recv_timeout - ms before a blocked
+#       send / recv gives up and retries (-1 for never)
 send_opts : dict[str,Union[str,int]] = {
      #"send_buffer_size": 32 # send blocks if 32 messages queue up
 }
@@ -16,14 +43,92 @@ recv_options : dict[str,Union[str,int]] = {
     "recv_timeout": 5000
 }
 
+credit_fmt = struct.Struct('!q')
+
+class Credits:
+    """ Pusher side of credit-based flow control.
+
+    Listens at `addr` for grants from the pullers, and
+    allows one message to be sent per credit granted.
+    """
+    def __init__(self, addr: str) -> None:
+        self.sock = Pull0(listen=addr, recv_timeout=1000)
+        self.available = 0
+
+    def take(self) -> float:
+        """ Use up one credit, waiting for a grant if there are
+        none left.  Returns the time spent waiting.
+        """
+        if self.available > 0:
+            self.available -= 1
+            return 0.0
+        t0 = time.perf_counter()
+        while self.available == 0:
+            try:
+                self.available += credit_fmt.unpack(self.sock.recv())[0]
+            except Timeout:
+                _logger.debug("Push: waiting for credits")
+        self.available -= 1
+        return time.perf_counter() - t0
+
+    def close(self) -> None:
+        self.sock.close()
+
+class Grants:
+    """ Puller side of credit-based flow control.
+
+    Dials the pusher's credit address and grants it `window`
+    messages up front, then tops it up every window/2
+    messages consumed.  So at most `window` messages are
+    ever queued between the pusher and the consumer.
+    """
+    def __init__(self, addr: str, window: int) -> None:
+        assert window > 0
+        self.sock = Push0(send_buffer_size=16)
+        self.sock.dial(addr, block=False) # the pusher may not be up yet
+        self.step = max(window//2, 1)
+        self.used = 0
+        self.grant(window)
+
+    def grant(self, n: int) -> None:
+        self.sock.send(credit_fmt.pack(n))
+
+    def consumed(self) -> None:
+        self.used += 1
+        if self.used == self.step:
+            self.grant(self.used)
+            self.used = 0
+
+    def close(self) -> None:
+        self.sock.close()
+
+def send_all(push: Push0, msg: Any) -> float:
+    """ Send `msg`, retrying on send timeouts.
+    Returns the time the send was blocked by backpressure.
+    """
+    try:
+        push.send(msg, block=False)
+        return 0.0
+    except TryAgain:
+        pass
+    t0 = time.perf_counter()
+    while True:
+        try:
+            push.send(msg)
+            break
+        except Timeout:
+            _logger.debug("Push: slow output")
+    return time.perf_counter() - t0
+
 T = TypeVar('T')
-def load_h5(buf: bytes, reader: Callable[[h5py.File],T]) -> Optional[T]:
+def load_h5(buf: bytes, reader: Callable[[Any],T]) -> Optional[T]:
     """ Simple function to read an hdf5 file from
     its serialized bytes representation.
 
     Returns the result of calling `reader(h5file)`
     or None on error.
     """
+    import h5py # type: ignore[import-untyped]
     try:
         with io.BytesIO(buf) as f:
             with h5py.File(f, 'r') as h:
@@ -32,14 +137,50 @@ def load_h5(buf: bytes, reader: Callable[[h5py.File],T]) -> Optional[T]:
         pass
     return None
 
+def sendable(msg : Any) -> Any:
+    """ pynng can only send bytes (or cffi pointers).
+    Wrap other buffers (memoryview, mmap, ...) without copying,
+    or copy them if pynng's ffi is unavailable.
+    """
+    if isinstance(msg, bytes):
+        return msg
+    if ffi is None:
+        return bytes(msg)
+    return ffi.from_buffer(msg)
+
+def message_view(msg : Any) -> Union[bytes,memoryview]:
+    """ A view of a received pynng.Message's buffer,
+    or a copy if pynng doesn't expose its buffer.
+    """
+    buf = getattr(msg, "_buffer", None)
+    if buf is None:
+        return msg.bytes
+    return memoryview(buf)
+
 @stream.stream
-def pusher(gen : Iterator[bytes], addr : str, ndial : int
+def pusher(gen : Iterator[bytes], addr : str, ndial : int,
+           opts : Optional[dict[str,Union[str,int]]] = None,
+           credits : Optional[str] = None,
+           metrics : Optional[Metrics] = None,
           ) -> Iterator[int]:
-    # transform messages sent into sizes sent
+    """ Send messages over an nng Push0 socket,
+    transforming messages sent into sizes sent.
+
+    `opts` override the socket options in `send_opts`.
+    If `credits` is an address, it is listened at for
+    grants from the pullers (see `puller`), and no message
+    is sent without a credit.
+
+    Time spent blocked - on the socket or waiting for
+    credits - is added to the "stall_seconds" and
+    "credit_wait_seconds" counters of `metrics`.
+    """
     assert ndial >= 0
     options = dict(send_opts)
+    options.update(opts or {})
     if ndial == 0:
         options["listen"] = addr
+    gate = None if credits is None else Credits(credits)
     try:
         with Push0(**options) as push:
             for dial in range(ndial):
@@ -51,13 +192,40 @@ def pusher(gen : Iterator[bytes], addr : str, ndial : int
                 _logger.info("Listening on %s.", addr)
 
             for msg in gen:
-                push.send(msg)
+                if gate is not None:
+                    waited = gate.take()
+                    if metrics is not None:
+                        metrics.inc("credit_wait_seconds", waited)
+                stalled = send_all(push, sendable(msg))
+                if metrics is not None and stalled > 0:
+                    metrics.inc("stalls")
+                    metrics.inc("stall_seconds", stalled)
                 yield len(msg)
     except ConnectionRefused as e:
         _logger.error("Unable to connect to %s - %s", addr, e)
+    finally:
+        if gate is not None:
+            gate.close()
 
 @stream.source
-def puller(addr : str, ndial : int) -> Iterator[bytes]:
+def puller(addr : str, ndial : int, zerocopy : bool = False,
+           opts : Optional[dict[str,Union[str,int]]] = None,
+           credits : Optional[str] = None,
+           window : int = 64,
+          ) -> Iterator[Union[bytes,memoryview]]:
+    """ Receive messages from an nng Pull0 socket.
+
+    If `zerocopy` is set, each message is yielded as a
+    memoryview over nng's own message buffer instead of
+    being copied into a bytes object.  The view is only
+    valid until the next message is requested, so it must
+    be consumed (e.g. written out) before then.
+
+    `opts` override the socket options in `recv_options`.
+    If `credits` is the pusher's credit address, the
+    pusher is granted `window` messages at a time, as the
+    consumer takes them.
+    """
     assert ndial >= 0
 
     done = 0
@@ -72,8 +240,10 @@ def puller(addr : str, ndial : int) -> Iterator[bytes]:
         done += 1
 
     options = dict(recv_options)
+    options.update(opts or {})
     if ndial == 0:
         options["listen"] = addr
+    grants = None
     try:
         with Pull0(**options) as pull:
             pull.add_post_pipe_connect_cb(show_open)
@@ -85,14 +255,301 @@ def puller(addr : str, ndial : int) -> Iterator[bytes]:
             else:
                 _logger.info("Connected to %s x %d - starting recv.",
                               addr, ndial)
+            if credits is not None:
+                grants = Grants(credits, window)
 
             while started == 0 or (done != started):
                 try:
-                    msg = pull.recv()
-                    yield msg
+                    if zerocopy:
+                        # msg owns the buffer - keep it alive
+                        # until the consumer comes back.
+                        msg = pull.recv_msg()
+                        yield message_view(msg)
+                    else:
+                        msg = pull.recv()
+                        yield msg
                 except Timeout:
                     if started:
                         _logger.debug("Pull: slow input")
+                    continue
+                if grants is not None:
+                    grants.consumed()
 
     except ConnectionRefused as e:
         _logger.error("Unable to connect to %s - %s", addr, e)
+    finally:
+        if grants is not None:
+            grants.close()
+
+async def apuller(addr : str, ndial : int, inflight : int = 4,
+                  maxsize : int = 32,
+                  opts : Optional[dict[str,Union[str,int]]] = None,
+                  metrics : Optional[Metrics] = None,
+                 ) -> AsyncIterator[bytes]:
+    """ Async version of `puller`.
+
+    Keeps `inflight` receives outstanding on the socket
+    (shared among all its pipes) and buffers up to `maxsize`
+    received messages in an asyncio.Queue, so the consumer
+    can process one message while the next ones arrive.
+
+    The stream ends once all connected pipes have closed
+    and the socket has been drained.  `opts` are extra
+    socket options (see `recv_options`).  The number of
+    messages received but not yet consumed is set as the
+    "recv_queue" gauge of `metrics`.
+    """
+    assert ndial >= 0
+    assert inflight > 0
+
+    loop = asyncio.get_running_loop()
+    queue : asyncio.Queue = asyncio.Queue(maxsize)
+    closed = asyncio.Event()
+    stopping = False
+    done = 0
+    started = 0
+    def show_open(pipe):
+        nonlocal started
+        _logger.info("Pull: pipe opened")
+        started += 1
+    def show_close(pipe):
+        nonlocal done
+        _logger.info("Pull: pipe closed")
+        done += 1
+        if done == started:
+            loop.call_soon_threadsafe(closed.set)
+
+    # Receives complete in the order they were posted,
+    # but their callbacks may run in any order.  Number them
+    # as they are posted and hand them off in that order.
+    tickets = itertools.count()
+    pending : dict[int,bytes] = {}
+    nxt = 0
+    async def flush() -> None:
+        nonlocal nxt
+        while nxt in pending:
+            msg = pending.pop(nxt)
+            nxt += 1
+            await asyncio.shield(queue.put(msg))
+
+    async def recv_loop(pull) -> None:
+        try:
+            while not stopping:
+                t = next(tickets)
+                # pynng's arecv still returns a message that
+                # arrived before a cancellation took effect.
+                pending[t] = await pull.arecv()
+                await flush()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            await queue.put(e)
+
+    async def drain(pull, receivers) -> None:
+        nonlocal stopping
+        await closed.wait()
+        stopping = True
+        for t in receivers:
+            t.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        for t in sorted(pending): # skip receives that were cancelled
+            await queue.put(pending.pop(t))
+        while True: # collect anything still queued in the socket
+            try:
+                msg = pull.recv(block=False)
+            except TryAgain:
+                break
+            await queue.put(msg)
+        await queue.put(None)
+
+    options : dict[str,Any] = dict(opts or {})
+    if ndial == 0:
+        options["listen"] = addr
+    try:
+        with Pull0(**options) as pull:
+            pull.add_post_pipe_connect_cb(show_open)
+            pull.add_post_pipe_remove_cb(show_close)
+            for dial in range(ndial):
+                pull.dial(addr, block=True)
+            if ndial == 0:
+                _logger.info("Pull: waiting for connection")
+            else:
+                _logger.info("Connected to %s x %d - starting recv.",
+                              addr, ndial)
+
+            receivers = [asyncio.create_task(recv_loop(pull))
+                         for i in range(inflight)]
+            tasks = receivers + [asyncio.create_task(drain(pull, receivers))]
+            try:
+                while True:
+                    msg = await queue.get()
+                    if msg is None:
+                        break
+                    if isinstance(msg, Exception):
+                        raise msg
+                    if metrics is not None:
+                        metrics.set("recv_queue",
+                                    queue.qsize() + len(pending))
+                    yield msg
+            finally:
+                stopping = True
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    except ConnectionRefused as e:
+        _logger.error("Unable to connect to %s - %s", addr, e)
+
+async def apusher(gen : Union[Iterable[bytes], AsyncIterable[bytes]],
+                  addr : str, ndial : int, inflight : int = 1,
+                  maxsize : int = 32,
+                  opts : Optional[dict[str,Union[str,int]]] = None,
+                  metrics : Optional[Metrics] = None,
+                 ) -> AsyncIterator[int]:
+    """ Async version of `pusher`.
+
+    Messages are taken from `gen` (a plain iterable is read
+    from a worker thread, so producing the next message
+    overlaps with sending the current one) into a queue of
+    up to `maxsize` messages, and sent by `inflight`
+    concurrent senders.
+
+    Yields the size of each message sent.  Note that
+    messages may be sent out of order if inflight > 1.
+    `opts` override the socket options in `send_opts`.
+    The number of messages waiting to be sent is set as
+    the "send_queue" gauge of `metrics`.
+    """
+    assert ndial >= 0
+    assert inflight > 0
+
+    todo : asyncio.Queue = asyncio.Queue(maxsize)
+    sent : asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> None:
+        try:
+            if isinstance(gen, AsyncIterable):
+                async for msg in gen:
+                    await todo.put(msg)
+            else:
+                it = iter(gen)
+                while True:
+                    msg = await asyncio.to_thread(next, it, None)
+                    if msg is None:
+                        break
+                    await todo.put(msg)
+        except Exception as e:
+            await sent.put(e)
+        for i in range(inflight):
+            await todo.put(None)
+
+    async def send_loop(push) -> None:
+        try:
+            while True:
+                msg = await todo.get()
+                if msg is None:
+                    break
+                await push.asend(sendable(msg))
+                await sent.put(len(msg))
+        except Exception as e:
+            await sent.put(e)
+        await sent.put(None)
+
+    options = dict(send_opts)
+    options.update(opts or {})
+    if ndial == 0:
+        options["listen"] = addr
+    try:
+        with Push0(**options) as push:
+            for dial in range(ndial):
+                push.dial(addr, block=True)
+            if ndial > 0:
+                _logger.info("Connected to %s x %d - starting stream.",
+                             addr, ndial)
+            else:
+                _logger.info("Listening on %s.", addr)
+
+            tasks = [asyncio.create_task(produce())] \
+                  + [asyncio.create_task(send_loop(push))
+                     for i in range(inflight)]
+            try:
+                running = inflight
+                while running > 0:
+                    x = await sent.get()
+                    if x is None:
+                        running -= 1
+                    elif isinstance(x, Exception):
+                        raise x
+                    else:
+                        if metrics is not None:
+                            metrics.set("send_queue", todo.qsize())
+                        yield x
+            finally:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    except ConnectionRefused as e:
+        _logger.error("Unable to connect to %s - %s", addr, e)
+
+@stream.source
+def aio_puller(addr : str, ndial : int, inflight : int = 4,
+               opts : Optional[dict[str,Union[str,int]]] = None,
+               metrics : Optional[Metrics] = None,
+              ) -> Iterator[bytes]:
+    """ `puller` running on `apuller` in a background thread.
+    """
+    yield from iterate_async(apuller(addr, ndial, inflight, opts=opts,
+                                     metrics=metrics))
+
+@stream.stream
+def aio_pusher(gen : Iterator[bytes], addr : str, ndial : int,
+               inflight : int = 1,
+               opts : Optional[dict[str,Union[str,int]]] = None,
+               metrics : Optional[Metrics] = None,
+              ) -> Iterator[int]:
+    """ `pusher` running on `apusher` in a background thread.
+    """
+    yield from iterate_async(apusher(gen, addr, ndial, inflight, opts=opts,
+                                     metrics=metrics))
+
+def request(addr : str, msg : bytes, timeout : int = 10000
+           ) -> Optional[bytes]:
+    """ Send a request to a Rep0 socket at `addr`
+    and return its reply (or None on timeout).
+    """
+    try:
+        with Req0(dial=addr, recv_timeout=timeout,
+                  send_timeout=timeout) as req:
+            req.send(msg)
+            return req.recv()
+    except Timeout:
+        _logger.warning("No reply from %s", addr)
+    return None
+
+@contextmanager
+def serving(addr : str, handler : Callable[[bytes],bytes]
+           ) -> Iterator[None]:
+    """ Answer requests arriving at `addr` with `handler`
+    (from a background thread) while this context is open.
+    """
+    stop = threading.Event()
+    def serve(rep) -> None:
+        while not stop.is_set():
+            try:
+                req = rep.recv()
+            except Timeout:
+                continue
+            try:
+                rep.send(handler(req))
+            except Exception as e:
+                _logger.error("Unable to answer request - %s", e)
+                rep.send(b"")
+
+    with Rep0(listen=addr, recv_timeout=100) as rep:
+        th = threading.Thread(target=serve, args=(rep,), daemon=True)
+        th.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            th.join()
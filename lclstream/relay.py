@@ -0,0 +1,160 @@
+""" Fan one stream out to several downstream consumers.
+
+Each downstream address gets its own Push0 socket, its own
+bounded queue and a sender thread.  Messages are either
+load-balanced over the consumers, or broadcast to all of them.
+When a consumer's queue is full, the `policy` decides what
+happens to the message:
+
+* "block" - wait for room (slowing down the whole relay),
+* "drop"  - discard it for this consumer,
+* "spill" - append it to a file, to be sent later in order.
+
+Broadcast does not use Pub0, since nng's Pub0 silently drops
+messages for subscribers that fall behind - which would
+defeat the "block" and "spill" policies.
+"""
+
+from typing import List, Optional, Union
+from collections.abc import Iterator
+import queue
+import threading
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+from pynng import Push0, Timeout # type: ignore[import-untyped]
+
+from .nng import sendable
+from .spool import Spool
+
+modes = ("balance", "broadcast")
+policies = ("block", "drop", "spill")
+
+Buffer = Union[bytes, memoryview]
+
+class Outlet:
+    """ One downstream consumer, listening at `addr`.
+    """
+    poll_ms = 100 # how often a blocked send checks for close
+    def __init__(self, addr: str,
+                 maxsize: int = 64, policy: str = "block",
+                 spill_dir: Optional[str] = None,
+                 max_bytes: Optional[int] = None) -> None:
+        assert policy in policies, f"Invalid policy {policy}"
+        self.addr = addr
+        self.policy = policy
+        self.sent = 0
+        self.dropped = 0
+        self.q : Union[Spool, queue.Queue]
+        if policy == "spill":
+            self.q = Spool(maxsize, spill_dir, max_bytes)
+        else:
+            self.q = queue.Queue(maxsize)
+        self.abort = threading.Event()
+        self.sock = Push0(listen=addr, send_timeout=self.poll_ms)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def qsize(self) -> int:
+        if isinstance(self.q, Spool):
+            return len(self.q)
+        return self.q.qsize()
+
+    def put(self, msg: Buffer) -> None:
+        if isinstance(self.q, Spool):
+            self.q.put(msg)
+        elif self.policy == "block":
+            self.q.put(msg)
+        else:
+            try:
+                self.q.put_nowait(msg)
+            except queue.Full:
+                self.dropped += 1
+
+    def send(self, msg: Buffer) -> bool:
+        """ Send one message, retrying until it goes
+        or `close` gives up.
+        """
+        data = sendable(msg)
+        while not self.abort.is_set():
+            try:
+                self.sock.send(data)
+                return True
+            except Timeout:
+                pass
+        return False
+
+    def run(self) -> None:
+        while True:
+            msg = self.q.get()
+            if msg is None:
+                break
+            if self.send(msg):
+                self.sent += 1
+            else:
+                self.dropped += 1
+
+    def close(self, timeout: float = 10.0) -> None:
+        """ Send everything still queued, then close the socket.
+
+        Messages still unsent after `timeout` seconds (e.g.
+        because the consumer stopped reading) are dropped,
+        with a warning.
+        """
+        deadline = time.monotonic() + timeout
+        queued = True
+        if isinstance(self.q, Spool):
+            self.q.close()
+        else:
+            try:
+                self.q.put(None, timeout=timeout)
+            except queue.Full:
+                queued = False
+        self.thread.join(max(0.0, deadline - time.monotonic()))
+        if self.thread.is_alive():
+            dropped = self.dropped
+            self.abort.set() # the sender drops the rest
+            if not queued:
+                self.q.put(None)
+            self.thread.join()
+            _logger.warning("Gave up on %s after %g s: dropped %d messages.",
+                            self.addr, timeout, self.dropped - dropped)
+        self.sock.close()
+
+    def summary(self) -> str:
+        ans = f"{self.addr}: sent {self.sent}"
+        if self.dropped:
+            ans += f", dropped {self.dropped}"
+        if isinstance(self.q, Spool) and self.q.total_spilled:
+            ans += f", {self.q.summary()}"
+        return ans
+
+@stream.sink
+def fan_out(inp: Iterator[Buffer], outlets: List[Outlet],
+            mode: str = "balance") -> int:
+    """ Distribute messages to `outlets`, either
+    each to the least busy outlet ("balance"),
+    or every one to all outlets ("broadcast").
+
+    Closes the outlets once the input ends, and returns
+    the number of messages received.
+    """
+    assert mode in modes, f"Invalid mode {mode}"
+    assert len(outlets) > 0
+    n = 0
+    try:
+        for msg in inp:
+            if mode == "broadcast":
+                for o in outlets:
+                    o.put(msg)
+            else: # rotate, so ties are broken round-robin
+                k = n % len(outlets)
+                min(outlets[k:] + outlets[:k], key=Outlet.qsize).put(msg)
+            n += 1
+    finally:
+        for o in outlets:
+            o.close()
+            _logger.info("Relay to %s", o.summary())
+    return n
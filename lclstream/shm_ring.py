@@ -0,0 +1,331 @@
+""" Hand messages to local processes through a ring buffer
+in shared memory.
+
+A `RingWriter` (e.g. the `write_shm` sink) puts messages into
+fixed-size slots of a `multiprocessing.shared_memory` segment,
+and any number of `RingReader`s on the same node attach by name
+and read them in place, as memoryviews into the segment.
+
+The segment holds a header, a table of attached readers
+(pid, oldest sequence number still in use), an index of
+(sequence number, size) per slot, and the slots themselves.
+All integers are little-endian uint64/int64, at 8-byte
+aligned offsets.
+
+When the ring is full, the writer's `policy` decides:
+
+* "block"     - wait for the slowest reader to move on,
+* "overwrite" - reuse the oldest slot anyway.  Readers that
+                fall more than a ring behind skip ahead
+                (counting the messages they lost), and should
+                check `valid(seq)` after using a view.
+"""
+
+from typing import Optional, Union, Tuple, List, Any
+from collections.abc import Iterator
+from multiprocessing import shared_memory, resource_tracker
+import fcntl
+import os
+import struct
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+from .stream_utils import numbering
+
+Buffer = Union[bytes, memoryview]
+
+policies = ("block", "overwrite")
+
+magic = b"LCLRING1"
+header_fmt = struct.Struct('<8sQQQ') # magic, slots, slot size, max readers
+HEAD = 32   # offset of the count of messages written
+CLOSED = 40 # offset of the closed flag
+READERS = 64
+reader_fmt = struct.Struct('<qq') # pid (0 if free), oldest seq in use
+entry_fmt = struct.Struct('<qq') # seq (-1 while being written), size
+u64 = struct.Struct('<q')
+
+poll = 0.0005 # seconds between checks while waiting
+shm_dir = "/dev/shm" # where POSIX shared memory segments live
+
+class Layout:
+    """ Offsets within a ring segment.
+    """
+    def __init__(self, slots: int, slot_size: int, readers: int) -> None:
+        self.slots = slots
+        self.slot_size = slot_size
+        self.readers = readers
+        self.index = READERS + readers*reader_fmt.size
+        data = self.index + slots*entry_fmt.size
+        self.data = (data + 63) // 64 * 64
+        self.size = self.data + slots*slot_size
+
+    def reader(self, k: int) -> int:
+        return READERS + k*reader_fmt.size
+
+    def entry(self, seq: int) -> int:
+        return self.index + (seq % self.slots)*entry_fmt.size
+
+    def slot(self, seq: int) -> int:
+        return self.data + (seq % self.slots)*self.slot_size
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """ Open an existing segment without letting this process's
+    resource tracker unlink it on exit.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False) # type: ignore[call-arg]
+    except TypeError: # Python < 3.13 always registers it
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class RingWriter:
+    """ Create the ring segment `name`, with `slots` slots
+    of `slot_size` bytes, and room for `readers` readers.
+    """
+    def __init__(self, name: str, slots: int = 64,
+                 slot_size: int = 8*1024*1024,
+                 policy: str = "block", readers: int = 16) -> None:
+        assert policy in policies, f"Invalid policy {policy}"
+        assert slots > 0 and slot_size > 0 and readers > 0
+        self.layout = Layout(slots, slot_size, readers)
+        self.policy = policy
+        self.shm = shared_memory.SharedMemory(name, create=True,
+                                              size=self.layout.size)
+        self.buf = self.shm.buf
+        header_fmt.pack_into(self.buf, 0, bytes(8), slots, slot_size, readers)
+        u64.pack_into(self.buf, HEAD, 0)
+        u64.pack_into(self.buf, CLOSED, 0)
+        for k in range(readers):
+            reader_fmt.pack_into(self.buf, self.layout.reader(k), 0, 0)
+        for i in range(slots):
+            entry_fmt.pack_into(self.buf, self.layout.entry(i), -1, 0)
+        self.buf[:len(magic)] = magic # ready for readers
+        self.head = 0
+
+    def oldest_in_use(self) -> Optional[int]:
+        """ The oldest message any live reader still holds.
+        """
+        lay = self.layout
+        oldest = None
+        for k in range(lay.readers):
+            pid, tail = reader_fmt.unpack_from(self.buf, lay.reader(k))
+            if pid == 0:
+                continue
+            if not alive(pid):
+                _logger.warning("Dropping reader %d (process %d is gone).",
+                                k, pid)
+                reader_fmt.pack_into(self.buf, lay.reader(k), 0, 0)
+                continue
+            if oldest is None or tail < oldest:
+                oldest = tail
+        return oldest
+
+    def behind(self) -> List[Tuple[int,int]]:
+        """ (pid, next message wanted) of each reader
+        that has not read everything written.
+        """
+        lay = self.layout
+        out = []
+        for k in range(lay.readers):
+            pid, tail = reader_fmt.unpack_from(self.buf, lay.reader(k))
+            if pid != 0 and tail < self.head:
+                out.append((pid, tail))
+        return out
+
+    def put(self, msg: Buffer) -> int:
+        """ Add a message, returning its sequence number.
+        """
+        lay = self.layout
+        view = memoryview(msg).cast('B')
+        if len(view) > lay.slot_size:
+            raise ValueError(f"Message of {len(view)} bytes is larger "
+                             f"than the ring's slots ({lay.slot_size}).")
+        seq = self.head
+        if self.policy == "block":
+            while True:
+                oldest = self.oldest_in_use()
+                if oldest is None or oldest > seq - lay.slots:
+                    break
+                time.sleep(poll)
+        entry = lay.entry(seq)
+        entry_fmt.pack_into(self.buf, entry, -1, 0)
+        off = lay.slot(seq)
+        self.buf[off:off+len(view)] = view
+        entry_fmt.pack_into(self.buf, entry, seq, len(view))
+        self.head = seq + 1
+        u64.pack_into(self.buf, HEAD, self.head)
+        return seq
+
+    def close(self, timeout: float = 60.0) -> None:
+        """ Tell readers no more messages are coming.  With the
+        "block" policy, wait for them to finish, then remove
+        the segment (attached readers keep their mapping).
+
+        Gives up waiting, with a warning, once the readers
+        have made no progress for `timeout` seconds.
+        """
+        u64.pack_into(self.buf, CLOSED, 1)
+        if self.policy == "block":
+            last = None
+            while True:
+                oldest = self.oldest_in_use()
+                if oldest is None or oldest >= self.head:
+                    break
+                if oldest != last:
+                    last = oldest
+                    deadline = time.monotonic() + timeout
+                elif time.monotonic() > deadline:
+                    _logger.warning("Readers stalled at close (pid, next "
+                                    "message of %d): %s", self.head,
+                                    self.behind())
+                    break
+                time.sleep(poll)
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+class RingReader:
+    """ Attach to the ring segment `name`, starting with the
+    next message written (or the oldest one still in the
+    ring, if `from_start` is set).
+
+    `read` returns each message as a memoryview into the
+    segment, which stays valid until the next `read`
+    (with the "block" policy).
+    """
+    def __init__(self, name: str, from_start: bool = False) -> None:
+        self.shm = attach(name)
+        self.buf = self.shm.buf
+        m, slots, slot_size, readers = header_fmt.unpack_from(self.buf, 0)
+        assert m == magic, f"{name} is not a message ring."
+        self.layout = Layout(slots, slot_size, readers)
+        self.lost = 0
+        self.view : Optional[memoryview] = None
+
+        head = self.head()
+        self.next = max(head - slots, 0) if from_start else head
+        # claim a reader place, locking out other readers doing the same
+        lock = os.open(os.path.join(shm_dir, self.shm.name), os.O_RDONLY)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            for k in range(readers):
+                pid, tail = reader_fmt.unpack_from(self.buf,
+                                                   self.layout.reader(k))
+                if pid == 0 or not alive(pid):
+                    self.k = k
+                    reader_fmt.pack_into(self.buf, self.layout.reader(k),
+                                         os.getpid(), self.next)
+                    break
+            else:
+                raise RuntimeError(f"All {readers} reader places of {name} are taken.")
+        finally:
+            os.close(lock) # releases the flock
+
+    def head(self) -> int:
+        return u64.unpack_from(self.buf, HEAD)[0]
+
+    def closed(self) -> bool:
+        return u64.unpack_from(self.buf, CLOSED)[0] != 0
+
+    def set_tail(self, seq: int) -> None:
+        reader_fmt.pack_into(self.buf, self.layout.reader(self.k),
+                             os.getpid(), seq)
+
+    def valid(self, seq: int) -> bool:
+        """ Whether message `seq` is still in its slot.
+        """
+        return entry_fmt.unpack_from(self.buf,
+                                     self.layout.entry(seq))[0] == seq
+
+    def read(self, timeout: Optional[float] = None
+            ) -> Optional[Tuple[int,memoryview]]:
+        """ Wait for the next message, and return its
+        (sequence number, data).  Returns None once the
+        writer has closed the ring and everything was read,
+        or on timeout.
+        """
+        lay = self.layout
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        self.set_tail(self.next) # done with the previous one
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head = self.head()
+            if head - self.next > lay.slots: # lapped by the writer
+                self.lost += head - lay.slots - self.next
+                self.next = head - lay.slots
+            if self.next < head:
+                seq = self.next
+                s, size = entry_fmt.unpack_from(self.buf, lay.entry(seq))
+                if s != seq: # overwritten in the meantime
+                    continue
+                off = lay.slot(seq)
+                self.view = self.buf[off:off+size]
+                self.next = seq + 1
+                return seq, self.view
+            if self.closed():
+                return None
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(poll)
+
+    def __iter__(self) -> Iterator[memoryview]:
+        while True:
+            ans = self.read()
+            if ans is None:
+                break
+            yield ans[1]
+
+    def close(self) -> None:
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        reader_fmt.pack_into(self.buf, self.layout.reader(self.k), 0, 0)
+        self.buf = None
+        self.shm.close()
+
+    def __enter__(self) -> "RingReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+@stream.sink
+def write_shm(inp: Iterator[Buffer], name: str,
+              slots: int = 64, slot_size: int = 8*1024*1024,
+              policy: str = "block", readers: int = 16,
+              numbered: bool = False) -> int:
+    """ Put every message into the shared memory ring `name`
+    (see `RingWriter`) for local `RingReader`s.
+    With `numbered`, messages are (n, msg) pairs, and the
+    ring is filled in the order they arrive.
+
+    Returns the number of messages written.
+    """
+    ring = RingWriter(name, slots, slot_size, policy, readers)
+    n = 0
+    try:
+        for _, msg in numbering(inp, 0, numbered):
+            ring.put(msg)
+            n += 1
+    finally:
+        ring.close()
+    return n
@@ -0,0 +1,237 @@
+""" A FIFO queue that spills to disk.
+
+`Spool` keeps messages in memory up to a count and a byte
+budget, and appends the rest to segment files, which are
+read back in order and removed once drained.  `spooled`
+runs one between a receiver and a slow sink, so that
+stalls in the sink don't hold up receiving.
+"""
+
+from typing import Optional, Union, List
+from collections.abc import Iterator
+from collections import deque
+import os
+import struct
+import tempfile
+import threading
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+from .metrics import Metrics
+
+Buffer = Union[bytes, memoryview]
+
+length_fmt = struct.Struct('!Q')
+
+class Segment:
+    """ One append-only spill file.  It is unlinked as soon
+    as it is created, so it disappears once closed.
+    """
+    def __init__(self, spill_dir: Optional[str] = None) -> None:
+        self.fd, name = tempfile.mkstemp(prefix="lclstream-spool",
+                                         dir=spill_dir)
+        os.unlink(name)
+        self.wpos = 0 # end of the data
+        self.rpos = 0 # next message to read
+        self.count = 0 # messages put (or being put) and not yet read
+
+    def append(self, msg: Buffer) -> int:
+        sz = memoryview(msg).nbytes
+        n = os.pwritev(self.fd, [length_fmt.pack(sz), msg], self.wpos)
+        assert n == length_fmt.size + sz, "Short write to spool."
+        self.wpos += n
+        return n
+
+    def read(self) -> bytes:
+        sz, = length_fmt.unpack(os.pread(self.fd, length_fmt.size,
+                                         self.rpos))
+        msg = os.pread(self.fd, sz, self.rpos+length_fmt.size)
+        self.rpos += length_fmt.size + sz
+        return msg
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class Spool:
+    """ Thread-safe FIFO queue of messages that keeps up to
+    `maxsize` messages and `max_bytes` bytes (if set) in
+    memory, and appends the rest to files in `spill_dir`.
+    A new file is started every `segment_bytes`, and
+    files are removed as soon as they have been read.
+
+    Messages come out in the order they were put in.
+    `get` returns None once the spool is closed and empty.
+
+    Disk reads and writes happen outside the lock, so a
+    slow disk doesn't block the other side.  Spilled messages
+    are counted (and their place reserved) under the lock,
+    writers take turns writing, and so do readers.
+
+    The largest number of messages held, and bytes held in
+    memory and on disk, are kept as high-water marks
+    (`peak_messages`, `peak_mem_bytes`, `peak_spill_bytes`).
+    """
+    def __init__(self, maxsize: int,
+                 spill_dir: Optional[str] = None,
+                 max_bytes: Optional[int] = None,
+                 segment_bytes: int = 256*1024**2) -> None:
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.segment_bytes = segment_bytes
+        self.mem : deque[bytes] = deque()
+        self.segments : deque[Segment] = deque()
+        self.cond = threading.Condition()
+        self.wlock = threading.Lock() # one writer at a time
+        self.rlock = threading.Lock() # one reader at a time
+        self.closed = False
+        self.spilled = 0 # messages on disk (or being written)
+        self.readable = 0 # spilled messages fully written
+        self.total_spilled = 0
+        self.mem_bytes = 0
+        self.spill_bytes = 0
+        self.peak_messages = 0
+        self.peak_mem_bytes = 0
+        self.peak_spill_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.mem) + self.spilled
+
+    def fits(self, size: int) -> bool:
+        return len(self.mem) < self.maxsize and \
+               (self.max_bytes is None or
+                self.mem_bytes + size <= self.max_bytes)
+
+    def put(self, msg: Buffer) -> None:
+        size = memoryview(msg).nbytes
+        with self.wlock:
+            with self.cond:
+                if self.spilled == 0 and self.fits(size):
+                    self.mem.append(bytes(msg))
+                    self.mem_bytes += size
+                    self.peak_mem_bytes = max(self.peak_mem_bytes,
+                                              self.mem_bytes)
+                    self.peak_messages = max(self.peak_messages, len(self))
+                    self.cond.notify()
+                    return
+                # once spilling, keep spilling until drained
+                if not self.segments or \
+                        self.segments[-1].wpos >= self.segment_bytes:
+                    self.segments.append(Segment(self.spill_dir))
+                seg = self.segments[-1]
+                seg.count += 1
+                self.spilled += 1
+                self.peak_messages = max(self.peak_messages, len(self))
+            try:
+                n = seg.append(msg)
+            except BaseException:
+                with self.cond:
+                    seg.count -= 1
+                    self.spilled -= 1
+                    self.cond.notify_all()
+                raise
+            with self.cond:
+                self.readable += 1
+                self.total_spilled += 1
+                self.spill_bytes += n
+                self.peak_spill_bytes = max(self.peak_spill_bytes,
+                                            self.spill_bytes)
+                self.cond.notify()
+
+    def get(self) -> Optional[bytes]:
+        with self.rlock:
+            with self.cond:
+                while len(self.mem) == 0 and self.readable == 0 and \
+                        not (self.closed and self.spilled == 0):
+                    self.cond.wait()
+                if len(self.mem) > 0:
+                    msg = self.mem.popleft()
+                    self.mem_bytes -= len(msg)
+                    return msg
+                if self.spilled == 0:
+                    return None
+                seg = self.segments[0]
+                self.readable -= 1
+            try:
+                msg = seg.read()
+            except BaseException:
+                with self.cond:
+                    self.readable += 1
+                raise
+            with self.cond:
+                self.spill_bytes -= length_fmt.size + len(msg)
+                self.spilled -= 1
+                seg.count -= 1
+                if seg.count == 0 and (len(self.segments) > 1
+                                       or self.spilled == 0):
+                    seg.close()
+                    self.segments.popleft()
+            return msg
+
+    def close(self) -> None:
+        """ Signal that no more messages will be put.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def record(self, metrics: Metrics) -> None:
+        """ Set gauges for the current and peak usage.
+        """
+        metrics.set("spool_messages", len(self))
+        metrics.set("spool_mem_bytes", self.mem_bytes)
+        metrics.set("spool_spill_bytes", self.spill_bytes)
+        metrics.set("spool_peak_messages", self.peak_messages)
+        metrics.set("spool_peak_mem_bytes", self.peak_mem_bytes)
+        metrics.set("spool_peak_spill_bytes", self.peak_spill_bytes)
+
+    def summary(self) -> str:
+        return (f"spool peaked at {self.peak_messages} messages, "
+                f"{self.peak_mem_bytes/1024**2:.1f} MB in memory and "
+                f"{self.peak_spill_bytes/1024**2:.1f} MB on disk "
+                f"({self.total_spilled} messages spilled)")
+
+    def __del__(self) -> None:
+        for seg in self.segments:
+            seg.close()
+
+@stream.stream
+def spooled(inp: Iterator[Buffer], max_bytes: int,
+            spill_dir: Optional[str] = None,
+            maxsize: int = 1024**2,
+            segment_bytes: int = 256*1024**2,
+            metrics: Optional[Metrics] = None) -> Iterator[bytes]:
+    """ Read `inp` on a separate thread into a `Spool`,
+    so the input keeps being consumed at its own pace
+    while the messages are passed on in order.
+
+    Up to `max_bytes` (and `maxsize` messages) are held in
+    memory, after which messages spill to disk.  The spool's
+    usage is recorded in `metrics` as gauges (see
+    `Spool.record`), and its peaks are logged at the end.
+    """
+    spool = Spool(maxsize, spill_dir, max_bytes, segment_bytes)
+    errors : List[BaseException] = []
+    def fill() -> None:
+        try:
+            for msg in inp:
+                spool.put(msg)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            spool.close()
+    th = threading.Thread(target=fill, daemon=True)
+    th.start()
+    while True:
+        msg = spool.get()
+        if metrics is not None:
+            spool.record(metrics)
+        if msg is None:
+            break
+        yield msg
+    th.join()
+    _logger.info("The %s.", spool.summary())
+    if errors:
+        raise errors[0]
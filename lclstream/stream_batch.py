@@ -0,0 +1,122 @@
+""" Pack many small messages into one frame.
+
+A batch frame is
+
+    magic (8 bytes) | count (uint32) | count x length (uint32) | payloads
+
+with all integers big-endian.  Messages that do not start
+with the magic are passed through `unbatch` unchanged,
+so a puller can read batched and plain streams alike.
+"""
+
+from typing import Union, List, Any
+from collections.abc import Iterator
+import struct
+import threading
+import queue
+import time
+
+import stream
+
+Buffer = Union[bytes, memoryview]
+
+magic = b"LCLBATCH"
+count_fmt = struct.Struct('!I')
+
+def pack_batch(items: List[Buffer]) -> bytes:
+    lengths = [memoryview(x).nbytes for x in items]
+    return b"".join([magic, count_fmt.pack(len(items)),
+                     struct.pack(f'!{len(items)}I', *lengths)] + items)
+
+def unpack_batch(frame: Buffer) -> Iterator[memoryview]:
+    view = memoryview(frame).cast('B')
+    pos = len(magic)
+    n, = count_fmt.unpack_from(view, pos)
+    pos += count_fmt.size
+    lengths = struct.unpack_from(f'!{n}I', view, pos)
+    pos += 4*n
+    for sz in lengths:
+        yield view[pos:pos+sz]
+        pos += sz
+    assert pos == len(view), "Invalid batch frame size."
+
+def is_batch(msg: Buffer) -> bool:
+    return memoryview(msg)[:len(magic)] == magic
+
+@stream.stream
+def batch(inp: Iterator[Buffer],
+          max_bytes: int = 1024*1024,
+          max_delay: float = 0.01,
+         ) -> Iterator[Buffer]:
+    """ Coalesce small messages into batch frames.
+
+    A frame is sent once it holds `max_bytes`, or once its
+    first message has waited `max_delay` seconds - whichever
+    comes first.  Messages of `max_bytes` or more are
+    sent on their own, unchanged.
+
+    The input is read on a background thread, so that
+    partial batches are flushed on time even while it
+    is idle.
+    """
+    items : queue.Queue = queue.Queue(64)
+    end = object()
+    def read() -> None:
+        try:
+            for x in inp:
+                items.put(x)
+        except Exception as e:
+            items.put(e)
+        items.put(end)
+    threading.Thread(target=read, daemon=True).start()
+
+    pending : List[Buffer] = []
+    size = 0
+    deadline = 0.0
+    def flush() -> Buffer:
+        nonlocal size
+        if len(pending) == 1 and not is_batch(pending[0]):
+            out = pending[0]
+        else:
+            out = pack_batch(pending)
+        pending.clear()
+        size = 0
+        return out
+
+    while True:
+        try:
+            x : Any = items.get(timeout=max(deadline-time.time(), 0)
+                                        if pending else None)
+        except queue.Empty: # deadline reached
+            yield flush()
+            continue
+        if x is end:
+            break
+        if isinstance(x, Exception):
+            raise x
+        sz = memoryview(x).nbytes
+        if sz >= max_bytes and not is_batch(x):
+            if pending:
+                yield flush()
+            yield x
+            continue
+        if not pending:
+            deadline = time.time() + max_delay
+        pending.append(x)
+        size += sz
+        if size >= max_bytes:
+            yield flush()
+    if pending:
+        yield flush()
+
+@stream.stream
+def unbatch(inp: Iterator[Buffer]) -> Iterator[Buffer]:
+    """ Unpack batch frames into their messages
+    (as memoryviews into the frame).
+    Other messages are passed through unchanged.
+    """
+    for msg in inp:
+        if is_batch(msg):
+            yield from unpack_batch(msg)
+        else:
+            yield msg
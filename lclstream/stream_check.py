@@ -0,0 +1,161 @@
+""" Per-message checksums.
+
+A checked message is
+
+    magic (8 bytes) | algorithm id (uint8) | checksum (uint64) | data
+
+with all integers big-endian.  Messages that do not start
+with the magic are passed through `verify` unchanged,
+so only the sender has to choose whether to add them -
+unless the receiver requires them, which also catches
+damage to the magic itself.
+
+crc32 (from zlib) is always available.  crc32c and xxh3
+are used when the `crc32c` / `xxhash` packages are
+installed.
+"""
+
+from typing import Union, Dict, Tuple, Callable, Optional
+from collections.abc import Iterator
+import struct
+import zlib
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+from .stream_utils import pmap, lazy_pmap
+from .metrics import Metrics
+
+try:
+    import crc32c # type: ignore[import-not-found]
+except ImportError:
+    crc32c = None
+try:
+    import xxhash # type: ignore[import-not-found]
+except ImportError:
+    xxhash = None
+
+Buffer = Union[bytes, memoryview]
+
+magic = b"LCLCKSUM"
+header = struct.Struct('!BQ')
+
+modes = ("raise", "log", "drop")
+
+class ChecksumError(ValueError):
+    pass
+
+class Algorithm:
+    """ A checksum, with its id in the message header.
+    """
+    def __init__(self, name: str, ident: int,
+                 fn: Callable[[Buffer],int]) -> None:
+        self.name = name
+        self.ident = ident
+        self.fn = fn
+
+algorithms : Dict[str,Algorithm] = {}
+def add_algorithm(alg: Algorithm) -> None:
+    algorithms[alg.name] = alg
+
+add_algorithm(Algorithm("crc32", 1, zlib.crc32))
+if crc32c is not None:
+    add_algorithm(Algorithm("crc32c", 2, crc32c.crc32c))
+if xxhash is not None:
+    add_algorithm(Algorithm("xxh3", 3, xxhash.xxh3_64_intdigest))
+by_ident = {a.ident: a for a in algorithms.values()}
+known = {"crc32": 1, "crc32c": 2, "xxh3": 3} # including missing ones
+
+def fastest() -> str:
+    """ The fastest algorithm available here.
+    """
+    for name in ("xxh3", "crc32c"):
+        if name in algorithms:
+            return name
+    return "crc32"
+
+def is_checked(msg: Buffer) -> bool:
+    return memoryview(msg)[:len(magic)] == magic
+
+def encode(alg: Algorithm, data: Buffer) -> bytes:
+    return b"".join([magic, header.pack(alg.ident, alg.fn(data)), data])
+
+def decode(msg: Buffer) -> Tuple[bool, memoryview]:
+    """ Check one message (which must start with the magic),
+    returning (whether it is intact, payload).
+    """
+    view = memoryview(msg).cast('B')
+    ident, value = header.unpack_from(view, len(magic))
+    try:
+        alg = by_ident[ident]
+    except KeyError:
+        names = [k for k, v in known.items() if v == ident]
+        raise ValueError(f"Unknown checksum ({names[0]} is not installed)."
+                         if names else f"Unknown checksum ({ident}).")
+    data = view[len(magic)+header.size:]
+    return alg.fn(data) == value, data
+
+@stream.stream
+def checksum(inp: Iterator[Buffer],
+             algorithm: Optional[str] = None,
+             threads: int = 4) -> Iterator[bytes]:
+    """ Prefix each message with its checksum (by default,
+    the `fastest` available), computed on a pool of
+    `threads` threads (0 to compute them inline).
+    """
+    name = fastest() if algorithm is None else algorithm
+    try:
+        alg = algorithms[name]
+    except KeyError:
+        raise ValueError(f"Unknown checksum {name} (available: {', '.join(algorithms)}).")
+    run = lambda x: encode(alg, x)
+    if threads == 0:
+        yield from inp >> stream.map(run)
+    else:
+        yield from inp >> pmap(run, threads)
+
+@stream.stream
+def verify(inp: Iterator[Buffer], threads: int = 4,
+           mode: str = "raise",
+           metrics: Optional[Metrics] = None,
+           required: bool = False) -> Iterator[Buffer]:
+    """ Check and strip the checksums added by `checksum`,
+    on a pool of `threads` threads (0 to check inline, as
+    needed for the short-lived buffers of
+    `puller(zerocopy=True)`).  Other messages are passed
+    through unchanged, and the pool is only started once
+    a checked message arrives - unless checksums are
+    `required`, in which case they count as corrupt.
+
+    A corrupt message either stops the stream with a
+    ChecksumError ("raise"), or is logged and counted in
+    `metrics` ("corrupt"), then passed on ("log") or
+    left out ("drop").
+    """
+    assert mode in modes, f"Invalid mode {mode}"
+    def run(x: Buffer) -> Tuple[bool, Buffer]:
+        if is_checked(x):
+            try:
+                return decode(x)
+            except struct.error: # too short for the header
+                return False, x
+        return not required, x
+    if threads == 0:
+        checked = inp >> stream.map(run)
+    elif required:
+        checked = inp >> pmap(run, threads)
+    else:
+        checked = inp >> lazy_pmap(run, is_checked, threads)
+    n = 0
+    for i, (ok, x) in enumerate(checked):
+        if not ok:
+            if mode == "raise":
+                raise ChecksumError(f"Message {i} is corrupt.")
+            n += 1
+            _logger.error("Message %d is corrupt (%d so far).", i, n)
+            if metrics is not None:
+                metrics.inc("corrupt")
+            if mode == "drop":
+                continue
+        yield x
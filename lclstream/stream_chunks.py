@@ -0,0 +1,274 @@
+""" Chunked transfer of a single large file.
+
+Every message carries a 24-byte header with the chunk's
+offset, the total file size and the chunk size (all
+big-endian int64), followed by the chunk data.  The last
+message has offset -1 and carries the file's digest as
+"<alg>:<hex digest>" (see `FileDigest`).
+
+Since each message says where it goes and how large the
+file is, chunks may arrive in any order - so they can be
+spread over several connections.
+
+A receiver can keep a `ChunkManifest` of the chunks it
+has written.  If it is restarted, the sender can ask for
+that manifest (`fetch_manifest`) and send only the
+chunks still missing.
+"""
+
+from typing import Tuple, Union, Optional, Any, Dict
+from collections.abc import Iterator, Callable
+from concurrent.futures import ThreadPoolExecutor, Future
+import os
+import struct
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+from .stream_utils import file_chunks, new_hash
+from .manifest import ChunkManifest
+from .nng import request
+
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+chunk_header = struct.Struct('!qqq')
+manifest_request = struct.Struct('!qq')
+
+def encode_chunk(offset: int, size: int, chunksz: int, data: bytes
+                ) -> bytes:
+    return chunk_header.pack(offset, size, chunksz) + data
+
+def decode_chunk(msg: bytes) -> Tuple[int, int, int, bytes]:
+    """ Decode a chunk message into
+    (offset, file size, chunk size, data).
+    """
+    assert len(msg) >= chunk_header.size, "Unable to decode chunk header."
+    offset, size, chunksz = chunk_header.unpack_from(msg)
+    return offset, size, chunksz, msg[chunk_header.size:]
+
+def fetch_manifest(addr: str, size: int, chunksz: int
+                  ) -> Optional[ChunkManifest]:
+    """ Ask the receiver serving `manifest_handler` at `addr`
+    which chunks of the file it already has.
+    """
+    ans = request(addr, manifest_request.pack(size, chunksz))
+    if ans is None:
+        return None
+    return ChunkManifest.frombytes(ans)
+
+def manifest_handler(path: Union[str,os.PathLike]
+                    ) -> Callable[[bytes],bytes]:
+    """ Answer `fetch_manifest` requests with the manifest
+    last saved at `path`.
+    """
+    def handle(req: bytes) -> bytes:
+        size, chunksz = manifest_request.unpack(req)
+        return ChunkManifest.load(path, size, chunksz).tobytes()
+    return handle
+
+class FileDigest:
+    """ Digest of a file assembled from chunks.
+
+    For a plain hash algorithm (e.g. "sha256" or "crc32"),
+    this is the hash of the whole file.  Chunks are hashed
+    as they arrive, as long as they arrive in order.  Chunks
+    that arrive early are read back from `fd` once the chunks
+    before them are in (so usually from the page cache).
+
+    For "tree-<alg>", each chunk is hashed separately, on a
+    pool of `threads` threads (hashlib releases the GIL),
+    and the file digest is the hash of all chunk digests
+    concatenated in order.  This does not depend on arrival
+    order at all.
+
+    Chunks present in `done` but never passed to `add`
+    (e.g. from an earlier run) are read from `fd`.
+    """
+    def __init__(self, alg: str, done: ChunkManifest,
+                 fd: int = -1, threads: int = 4) -> None:
+        self.alg = alg
+        self.done = done
+        self.fd = fd
+        self.tree = alg.startswith("tree-")
+        if self.tree:
+            self.leaf = alg[5:]
+            self.pool = ThreadPoolExecutor(threads)
+            self.leaves : Dict[int,Future] = {}
+        else:
+            self.h = new_hash(alg)
+            self.next = 0 # first chunk not yet hashed
+
+    def _read(self, i: int) -> bytes:
+        off = i*self.done.chunksz
+        return os.pread(self.fd, min(self.done.chunksz, self.done.size-off),
+                        off)
+
+    def _catch_up(self) -> None:
+        while self.next < self.done.nchunks and self.next in self.done:
+            self.h.update(self._read(self.next))
+            self.next += 1
+
+    def add(self, i: int, data: bytes) -> None:
+        """ Add chunk `i` (which must then be marked in `done`).
+        """
+        if self.tree:
+            if i not in self.leaves:
+                self.leaves[i] = self.pool.submit(
+                        lambda x: new_hash(self.leaf, x).digest(), data)
+        else:
+            if i == self.next:
+                self.h.update(data)
+                self.next += 1
+            self._catch_up()
+
+    def close(self) -> None:
+        if self.tree:
+            self.pool.shutdown(cancel_futures=True)
+
+    def hexdigest(self) -> str:
+        """ Return "<alg>:<hex digest>" for the complete file.
+        """
+        if self.tree:
+            h = new_hash(self.leaf)
+            for i in range(self.done.nchunks):
+                if i not in self.leaves:
+                    self.add(i, self._read(i))
+                h.update(self.leaves[i].result())
+            ans = h.hexdigest()
+        else:
+            self._catch_up()
+            assert self.next == self.done.nchunks, "File is incomplete."
+            ans = self.h.hexdigest()
+        return f"{self.alg}:{ans}"
+
+@stream.source
+def file_messages(fname: Union[str,os.PathLike],
+                  chunksz: int = 1024*1024,
+                  alg: str = 'sha256',
+                  skip: Optional[ChunkManifest] = None,
+                 ) -> Iterator[bytes]:
+    """ Split a file into chunk messages, ending with
+    a message holding its digest (see `FileDigest`).
+
+    Chunks already present in `skip` are not sent
+    (but still count towards the digest).
+    """
+    size = os.stat(fname).st_size
+    sent = ChunkManifest(size, chunksz)
+    h = FileDigest(alg, sent)
+    for off, data in file_chunks(fname, chunksz):
+        i = off//chunksz
+        h.add(i, data)
+        sent.add(i)
+        if skip is not None and i in skip:
+            continue
+        yield encode_chunk(off, size, chunksz, data)
+    digest = h.hexdigest()
+    h.close()
+    yield encode_chunk(-1, size, chunksz, digest.encode('ascii'))
+
+def create_file(fname: Union[str,os.PathLike], size: int) -> int:
+    """ Create a file of the given size and return
+    an open (read-write) file descriptor to it.
+
+    Space is preallocated where the filesystem supports it.
+    """
+    fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+    os.ftruncate(fd, size)
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError: # not supported by this filesystem
+            pass
+    return fd
+
+@stream.stream
+def chunk_writer(gen: Iterator[bytes],
+                 fname: Union[str,os.PathLike],
+                 alg: str = 'sha256',
+                 manifest: Optional[Union[str,os.PathLike]] = None,
+                 interval: float = 1.0,
+                 threads: int = 4,
+                ) -> Iterator[int]:
+    """ Write chunk messages (in any order) into `fname`.
+
+    The file is created and preallocated when the first
+    message arrives, and each chunk is written at its
+    offset with `os.pwrite`.  Stops once every chunk of
+    the file and its digest have arrived, then checks
+    the digest, which is computed while writing (see
+    `FileDigest` for `alg` and `threads`).
+
+    If `manifest` is given, the chunks written so far are
+    recorded there every `interval` seconds (after syncing
+    the file).  A manifest left by an earlier, interrupted
+    run is picked up, so its chunks need not be sent again.
+    It is removed once the file is complete.
+
+    Yields the number of bytes written by each chunk.
+    """
+    fd = -1
+    done : Optional[ChunkManifest] = None
+    h : Optional[FileDigest] = None
+    digest = None
+    t0 = time.time()
+    def save() -> None:
+        if manifest is not None and done is not None:
+            fdatasync(fd)
+            done.save(manifest)
+    try:
+        for msg in gen:
+            off, size, chunksz, data = decode_chunk(msg)
+            if done is None:
+                if manifest is None:
+                    done = ChunkManifest(size, chunksz)
+                else:
+                    done = ChunkManifest.load(manifest, size, chunksz)
+                    if done.count > 0:
+                        _logger.info("Resuming with %d of %d chunks.",
+                                     done.count, done.nchunks)
+                fd = create_file(fname, size)
+                h = FileDigest(alg, done, fd, threads)
+            if size != done.size or chunksz != done.chunksz:
+                raise ValueError("Chunk is from a different file.")
+            if off == -1: # a final hash!
+                digest = bytes(data).decode('ascii')
+            else:
+                if off < 0 or off % chunksz != 0:
+                    raise ValueError("Invalid chunk offset")
+                if off+len(data) > size:
+                    raise ValueError("Refusing to write beyond end of file.")
+                i = off//chunksz
+                if i not in done:
+                    os.pwrite(fd, data, off)
+                    done.add(i)
+                    h.add(i, data)
+                yield len(data)
+            if digest is not None and done.complete():
+                break
+            if time.time() - t0 >= interval:
+                save()
+                t0 = time.time()
+        if done is None or h is None or digest is None \
+                or not done.complete():
+            _logger.error("Error: transfer incomplete (%d of %d chunks).",
+                          done.count if done else 0,
+                          done.nchunks if done else -1)
+            return
+        H = h.hexdigest()
+        if H != digest:
+            raise ValueError(f"Checksum mismatch for {fname} "
+                             f"(got {H}, sent {digest}).")
+        _logger.info("File checksum matches!")
+    finally:
+        if h is not None:
+            h.close()
+        if fd >= 0:
+            if done is not None and not done.complete():
+                save()
+            os.close(fd)
+
+    if manifest is not None and os.path.exists(manifest):
+        os.remove(manifest)
@@ -0,0 +1,161 @@
+""" Per-message compression.
+
+A compressed message is
+
+    magic (8 bytes) | codec id (uint8) | raw size (uint64) | data
+
+with all integers big-endian.  Messages that do not start
+with the magic are passed through `decompress` unchanged,
+so only the sender has to choose whether (and how) to
+compress.
+
+zlib is always available.  zstd and lz4 are used when the
+`zstandard` / `lz4` packages are installed.
+"""
+
+from typing import Union, Dict, Tuple, Callable, Optional
+from collections.abc import Iterator
+import struct
+import zlib
+
+import stream
+
+from .stream_utils import pmap, lazy_pmap
+
+try:
+    import zstandard # type: ignore[import-not-found]
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame # type: ignore[import-not-found]
+except ImportError:
+    lz4 = None
+
+Buffer = Union[bytes, memoryview]
+
+magic = b"LCLCODEC"
+header = struct.Struct('!BQ')
+
+class Codec:
+    """ A compression method, with its id in the message header.
+    """
+    def __init__(self, name: str, ident: int,
+                 compress: Callable[[Buffer,int],bytes],
+                 decompress: Callable[[Buffer,int],bytes],
+                 level: int) -> None:
+        self.name = name
+        self.ident = ident
+        self.compress = compress # (data, level) -> bytes
+        self.decompress = decompress # (data, raw size) -> bytes
+        self.level = level
+
+codecs : Dict[str,Codec] = {}
+def add_codec(codec: Codec) -> None:
+    codecs[codec.name] = codec
+
+add_codec(Codec("none", 0, lambda x, level: bytes(x),
+                           lambda x, size: bytes(x), 0))
+add_codec(Codec("zlib", 1, lambda x, level: zlib.compress(x, level),
+                           lambda x, size: zlib.decompress(x, bufsize=max(size, 1)),
+                           1))
+if zstandard is not None:
+    add_codec(Codec("zstd", 2,
+            lambda x, level: zstandard.ZstdCompressor(level).compress(x),
+            lambda x, size: zstandard.ZstdDecompressor().decompress(
+                                        x, max_output_size=size),
+            3))
+if lz4 is not None:
+    add_codec(Codec("lz4", 3,
+            lambda x, level: lz4.frame.compress(x, level),
+            lambda x, size: lz4.frame.decompress(x),
+            0))
+by_ident = {c.ident: c for c in codecs.values()}
+
+def is_compressed(msg: Buffer) -> bool:
+    return memoryview(msg)[:len(magic)] == magic
+
+def encode(codec: Codec, raw_size: int, data: Buffer) -> bytes:
+    return b"".join([magic, header.pack(codec.ident, raw_size), data])
+
+def decode(msg: Buffer) -> bytes:
+    """ Decompress one message (which must start with the magic).
+    """
+    view = memoryview(msg).cast('B')
+    ident, size = header.unpack_from(view, len(magic))
+    try:
+        codec = by_ident[ident]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec ({ident}).")
+    out = codec.decompress(view[len(magic)+header.size:], size)
+    assert len(out) == size, "Invalid decompressed size."
+    return out
+
+@stream.stream
+def compress(inp: Iterator[Buffer],
+             codec: str = "zlib",
+             level: Optional[int] = None,
+             threads: int = 4,
+             min_ratio: float = 0.9,
+             probe: int = 16,
+             sample: int = 64*1024,
+            ) -> Iterator[Buffer]:
+    """ Compress each message with `codec`, on a pool of
+    `threads` threads.
+
+    Every `probe` messages, the first `sample` bytes of the
+    message are test-compressed.  If that doesn't shrink
+    them below `min_ratio` of their size, the following
+    messages are sent uncompressed until the next probe.
+    A message is also sent uncompressed whenever compressing
+    it doesn't save space.
+    """
+    try:
+        c = codecs[codec]
+    except KeyError:
+        raise ValueError(f"Unknown codec {codec} (available: {', '.join(codecs)}).")
+    lvl = c.level if level is None else level
+    raw = codecs["none"]
+
+    def probe_ratio(x: Buffer) -> float:
+        part = memoryview(x).cast('B')[:sample]
+        if len(part) == 0:
+            return 1.0
+        return len(c.compress(part, lvl)) / len(part)
+
+    def run(item: Tuple[bool,Buffer]) -> Buffer:
+        worth, x = item
+        size = memoryview(x).nbytes
+        if worth:
+            out = c.compress(x, lvl)
+            if len(out) + len(magic) + header.size < size:
+                return encode(c, size, out)
+        if is_compressed(x): # would be mistaken for a compressed message
+            return encode(raw, size, x)
+        return x
+
+    def decide(inp: Iterator[Buffer]) -> Iterator[Tuple[bool,Buffer]]:
+        worth = True
+        for i, x in enumerate(inp):
+            if i % probe == 0:
+                worth = probe_ratio(x) < min_ratio
+            yield worth, x
+
+    yield from decide(inp) >> pmap(run, threads)
+
+@stream.stream
+def decompress(inp: Iterator[Buffer], threads: int = 4
+              ) -> Iterator[Buffer]:
+    """ Decompress messages made by `compress` on a pool of
+    `threads` threads (0 to decompress inline, as needed for
+    the short-lived buffers of `puller(zerocopy=True)`).
+    Other messages are passed through unchanged, and the
+    pool is only started once a compressed message arrives.
+    """
+    def run(x: Buffer) -> Buffer:
+        if is_compressed(x):
+            return decode(x)
+        return x
+    if threads == 0:
+        yield from inp >> stream.map(run)
+    else:
+        yield from inp >> lazy_pmap(run, is_compressed, threads)
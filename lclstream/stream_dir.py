@@ -0,0 +1,117 @@
+from typing import Union, List, Tuple, Optional
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from pathlib import Path
+import os
+
+import stream
+
+from .stream_utils import write_all, numbering, file_name
+from .manifest import Progress
+from .metrics import Metrics
+
+def fsync_path(path: Union[str,os.PathLike]) -> None:
+    """ Flush a file (or directory) to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@stream.sink
+def write_dir(inp: Iterator[bytes],
+              dirname: Union[str,os.PathLike],
+              names: str,
+              writers: int = 4,
+              fsync: int = 0,
+              atomic: bool = False,
+              start: int = 0,
+              progress: Optional[Progress] = None,
+              numbered: bool = False,
+              metrics: Optional[Metrics] = None,
+             ) -> int:
+    """ Write each message to its own file, `dirname/(names % i)`,
+    numbering from `start` (or, if `numbered` is set, taking
+    the numbers or names from (number or name, message) pairs).
+
+    Files are written by a pool of `writers` threads,
+    with at most 2*writers messages waiting to be written.
+
+    If `atomic` is set, each file is written under a hidden
+    temporary name and renamed into place once complete,
+    so readers never see a partial file.
+
+    If `fsync` > 0, files are flushed to disk in batches
+    of this many, followed by a single sync of the directory.
+    With `atomic`, files are renamed into place only after
+    they have been flushed.
+
+    If `progress` is given, it is kept up to date with
+    the count of files written in order (and flushed,
+    if `fsync` is set).
+
+    The number of messages waiting to be written is set
+    as the "write_queue" gauge of `metrics`.
+
+    Returns the number of files written.
+    """
+    assert writers > 0
+    assert fsync >= 0
+    outdir = Path(dirname)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    def write(i: Union[int,str], data: bytes) -> Tuple[Path,Path]:
+        final = outdir / file_name(names, i)
+        path = final.with_name(f".{final.name}.part") if atomic else final
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            write_all(fd, data)
+        finally:
+            os.close(fd)
+        if atomic and fsync == 0:
+            os.rename(path, final)
+        return path, final
+
+    batch : List[Tuple[Path,Path]] = []
+    def commit() -> None:
+        for x in pool.map(fsync_path, [path for path, final in batch]):
+            pass
+        if atomic:
+            for path, final in batch:
+                os.rename(path, final)
+        fsync_path(outdir)
+        batch.clear()
+        if progress is not None:
+            progress.commit(start+count)
+
+    count = 0
+    pending : deque[Future] = deque()
+    def finish_one() -> None:
+        nonlocal count
+        written = pending.popleft().result()
+        count += 1
+        if fsync > 0:
+            batch.append(written)
+            if len(batch) >= fsync:
+                commit()
+        elif progress is not None:
+            progress.commit(start+count)
+
+    try:
+        with ThreadPoolExecutor(writers) as pool:
+            for i, data in numbering(inp, start, numbered):
+                if len(pending) >= 2*writers:
+                    finish_one()
+                pending.append(pool.submit(write, i, data))
+                if metrics is not None:
+                    metrics.set("write_queue", len(pending))
+            while len(pending) > 0:
+                finish_one()
+            if len(batch) > 0:
+                commit()
+    finally:
+        if progress is not None:
+            progress.save()
+    return count
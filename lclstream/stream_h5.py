@@ -0,0 +1,402 @@
+from typing import TypeVar, Optional, Union, Dict, List, Any
+from collections.abc import Iterator, Callable
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque
+import itertools
+import multiprocessing
+import threading
+import queue
+import os
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+import numpy as np
+import h5py # type: ignore[import-untyped]
+import hdf5plugin # type: ignore[import-untyped]
+
+from .nng import load_h5
+from .stream_utils import numbering
+
+T = TypeVar('T')
+Buffer = Union[bytes, memoryview]
+
+_names = itertools.count()
+
+def open_image(buf: Buffer) -> h5py.File:
+    """ Open the serialized bytes of an hdf5 file as an
+    in-memory file image (core driver, no backing store).
+
+    Unlike wrapping the bytes in a file-like object, HDF5
+    then reads straight from memory, without calling back
+    into Python for every read.
+    """
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fapl_core(backing_store=False)
+    fapl.set_file_image(buf)
+    # HDF5 identifies open files by name, so keep them unique
+    name = f"lclstream-image-{os.getpid()}-{next(_names)}".encode()
+    fid = h5py.h5f.open(name, h5py.h5f.ACC_RDONLY, fapl=fapl)
+    return h5py.File(fid)
+
+def load_image(buf: Buffer, reader: Callable[[h5py.File],T]
+              ) -> Optional[T]:
+    """ Like `nng.load_h5`, but opens the file with `open_image`.
+
+    Returns the result of calling `reader(h5file)`
+    or None on error.
+    """
+    try:
+        with open_image(buf) as h:
+            return reader(h)
+    except (IOError, OSError):
+        pass
+    return None
+
+@stream.stream
+def decode_h5(inp: Iterator[Buffer],
+              reader: Callable[[h5py.File],T],
+              workers: int = 4,
+              inflight: Optional[int] = None,
+              mp_context: Optional[str] = None,
+             ) -> Iterator[Optional[T]]:
+    """ Run `load_image(msg, reader)` on every message,
+    using a pool of `workers` processes (0 to decode inline),
+    and yield the results in order.
+
+    At most `inflight` messages (default 2*workers) are
+    being decoded at a time.  `reader` must be picklable
+    (e.g. a module-level function), and so must its results.
+    `mp_context` selects the multiprocessing start method.
+    """
+    if workers == 0:
+        for msg in inp:
+            yield load_image(msg, reader)
+        return
+
+    if inflight is None:
+        inflight = 2*workers
+    assert inflight > 0
+    ctx = multiprocessing.get_context(mp_context)
+    pending : deque[Future] = deque()
+    with ProcessPoolExecutor(workers, mp_context=ctx) as pool:
+        for msg in inp:
+            if len(pending) >= inflight:
+                yield pending.popleft().result()
+            if not isinstance(msg, bytes): # memoryviews can't be pickled
+                msg = bytes(msg)
+            pending.append(pool.submit(load_image, msg, reader))
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+DType = Union[None, str, np.dtype, Dict[str,Any]]
+
+@stream.stream
+def tensor_batches(inp: Iterator[Buffer],
+                   names: List[str],
+                   batch_size: int,
+                   dtype: DType = None,
+                   prefetch: int = 2,
+                   drop_last: bool = False,
+                  ) -> Iterator[Dict[str,np.ndarray]]:
+    """ Read the datasets `names` out of each hdf5 message
+    (using `load_h5`), and yield batches of `batch_size` events
+    as a dict of arrays, shaped `(batch_size,) + dataset.shape`.
+
+    `dtype` converts the datasets on read - either one dtype
+    for all, or a dict by name (default: the stored dtype).
+    Shapes and dtypes are taken from the first message;
+    messages that can't be read, or don't match, are skipped.
+
+    Batches are assembled on a background thread, up to
+    `prefetch` ahead, directly into a fixed set of
+    preallocated buffers.  So a batch is only valid until
+    the next one is requested - copy it to keep it longer.
+    The last, partial batch is yielded as a shorter view
+    unless `drop_last` is set.
+    """
+    assert batch_size > 0 and prefetch > 0
+    def dtype_of(name: str, ds: h5py.Dataset) -> np.dtype:
+        if isinstance(dtype, dict):
+            return np.dtype(dtype.get(name, ds.dtype))
+        return np.dtype(ds.dtype if dtype is None else dtype)
+
+    free : queue.Queue = queue.Queue()
+    ready : queue.Queue = queue.Queue()
+    stop = threading.Event()
+    end = object()
+    layout : Dict[str,Any] = {} # name -> (shape, dtype)
+
+    def allocate(h: h5py.File) -> None:
+        # raises KeyError before allocating anything
+        layout.update({name: (h[name].shape, dtype_of(name, h[name]))
+                       for name in names})
+        for _ in range(prefetch+2): # in use, being filled, and ready
+            free.put({name: np.empty((batch_size,)+shape, dt)
+                      for name, (shape, dt) in layout.items()})
+
+    def get_free() -> Optional[Dict[str,np.ndarray]]:
+        while not stop.is_set():
+            try:
+                return free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    bufs : Optional[Dict[str,np.ndarray]] = None
+    n = 0
+    def read(h: h5py.File) -> bool:
+        nonlocal bufs
+        if not layout:
+            allocate(h)
+        for name in names:
+            ds = h[name]
+            if ds.shape != layout[name][0]:
+                _logger.warning("Skipping event: %s has shape %s, "
+                                "expected %s.", name, ds.shape,
+                                layout[name][0])
+                return False
+        if bufs is None:
+            bufs = get_free()
+            if bufs is None: # stopped
+                return False
+        for name in names:
+            h[name].read_direct(bufs[name][n, ...]) # a view, even for scalars
+        return True
+
+    def produce() -> None:
+        nonlocal bufs, n
+        try:
+            for msg in inp:
+                if stop.is_set():
+                    return
+                try:
+                    ok = load_h5(msg, read)
+                except KeyError as e: # missing dataset
+                    _logger.warning("Skipping event: %s", e)
+                    ok = None
+                if not ok:
+                    continue
+                n += 1
+                if n == batch_size:
+                    ready.put((bufs, n))
+                    bufs = None
+                    n = 0
+            if n > 0 and not drop_last:
+                ready.put((bufs, n))
+        except Exception as e:
+            ready.put(e)
+        finally:
+            ready.put(end)
+
+    t = threading.Thread(target=produce, daemon=True)
+    t.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            full, count = item
+            if count == batch_size:
+                yield full
+            else:
+                yield {name: x[:count] for name, x in full.items()}
+            free.put(full) # the consumer is done with it
+    finally:
+        stop.set()
+
+def h5_filter(name: Optional[str], level: Optional[int] = None
+             ) -> Dict[str,Any]:
+    """ Keyword arguments to `create_dataset` for compressing
+    with `name` (None, gzip, lzf, or one of the hdf5plugin
+    filters lz4, zstd, blosc, bitshuffle).
+    """
+    if name is None or name == "none":
+        return {}
+    if name == "gzip":
+        return {"compression": "gzip",
+                "compression_opts": 4 if level is None else level}
+    if name == "lzf":
+        return {"compression": "lzf"}
+    if name == "lz4":
+        return dict(hdf5plugin.LZ4())
+    if name == "zstd":
+        return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    if name == "blosc":
+        return dict(hdf5plugin.Blosc(cname="lz4",
+                                     clevel=5 if level is None else level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if name == "bitshuffle":
+        return dict(hdf5plugin.Bitshuffle(cname="lz4"))
+    raise ValueError(f"Unknown compression {name}.")
+
+def all_datasets(h: h5py.File) -> List[str]:
+    names : List[str] = []
+    def visit(name: str, obj: Any) -> None:
+        if isinstance(obj, h5py.Dataset):
+            names.append(name)
+    h.visititems(visit)
+    return names
+
+class H5Appender:
+    """ Append blocks of events to datasets in a series of
+    hdf5 files, `pattern % 0`, `pattern % 1`, ...
+    starting a new file once `rollover` bytes (uncompressed)
+    have been written to the current one.
+    """
+    def __init__(self, pattern: str, layout: Dict[str,Any],
+                 chunk_events: int, filters: Dict[str,Any],
+                 rollover: int) -> None:
+        self.pattern = pattern
+        self.layout = layout # name -> (shape, dtype)
+        self.chunk_events = chunk_events
+        self.filters = filters
+        self.rollover = rollover
+        self.nfiles = 0
+        self.h : Optional[h5py.File] = None
+        self.size = 0 # bytes written to the current file
+
+    def open(self) -> h5py.File:
+        h = h5py.File(self.pattern % self.nfiles, "w")
+        self.nfiles += 1
+        self.size = 0
+        for name, (shape, dtype) in self.layout.items():
+            h.create_dataset(name, (0,)+shape, dtype,
+                             maxshape=(None,)+shape,
+                             chunks=(self.chunk_events,)+shape,
+                             **self.filters)
+        return h
+
+    def append(self, block: Dict[str,np.ndarray], n: int) -> None:
+        if self.h is None:
+            self.h = self.open()
+        for name, x in block.items():
+            ds = self.h[name]
+            m = ds.shape[0]
+            ds.resize(m+n, axis=0)
+            ds[m:m+n] = x[:n]
+            self.size += x[:n].nbytes
+        if self.rollover > 0 and self.size >= self.rollover:
+            self.close()
+
+    def close(self) -> None:
+        if self.h is not None:
+            self.h.close()
+            self.h = None
+
+@stream.sink
+def write_h5(inp: Iterator[Buffer],
+             pattern: str,
+             datasets: Optional[List[str]] = None,
+             compression: Optional[str] = None,
+             chunk_events: int = 64,
+             buffer_events: int = 1024,
+             rollover: int = 4*1024**3,
+             start: int = 0,
+             numbered: bool = False,
+            ) -> int:
+    """ Append the datasets of every hdf5 message along
+    a new first (event) axis, into large chunked files
+    named `pattern % k` (k = 0, 1, ...).
+
+    `datasets` selects the datasets to keep (default:
+    all datasets in the first message).  Their shapes and
+    dtypes are taken from the first message; messages that
+    can't be read or don't match are skipped.  The message
+    number of every event (see `numbering` for `start` and
+    `numbered`) is stored in the "event" dataset.
+
+    Events are gathered in blocks of `chunk_events` (also the
+    hdf5 chunk size) and written by a background thread,
+    with up to `buffer_events` events waiting.  Files are
+    compressed with `compression` (see `h5_filter`), and a
+    new file is started after `rollover` bytes (uncompressed,
+    0 for no limit).
+
+    Returns the number of events written.
+    """
+    assert chunk_events > 0
+    assert "%" in pattern, "pattern needs a numeric format specifier."
+    filters = h5_filter(compression)
+    blocks : queue.Queue = queue.Queue(max(buffer_events//chunk_events, 1))
+    end = object()
+    errors : List[Exception] = []
+    layout : Dict[str,Any] = {}
+
+    def write() -> None:
+        out = H5Appender(pattern, layout, chunk_events, filters, rollover)
+        try:
+            while True:
+                item = blocks.get()
+                if item is end:
+                    break
+                if not errors:
+                    out.append(*item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            out.close()
+
+    def read(h: h5py.File) -> Optional[Dict[str,np.ndarray]]:
+        if not layout:
+            names = all_datasets(h) if datasets is None else datasets
+            layout.update({name: (h[name].shape, h[name].dtype)
+                           for name in names})
+            layout["event"] = ((), np.dtype(np.int64))
+        ans = {}
+        for name in layout:
+            if name == "event":
+                continue
+            ds = h[name]
+            if (ds.shape, ds.dtype) != layout[name]:
+                _logger.warning("Skipping event: %s is %s %s, expected %s %s.",
+                                name, ds.shape, ds.dtype, *layout[name])
+                return None
+            ans[name] = ds[()]
+        return ans
+
+    def new_block() -> Dict[str,np.ndarray]:
+        return {name: np.empty((chunk_events,)+shape, dtype)
+                for name, (shape, dtype) in layout.items()}
+
+    writer = threading.Thread(target=write, daemon=True)
+    started = False
+    count = 0
+    block : Dict[str,np.ndarray] = {}
+    n = 0
+    try:
+        for i, msg in numbering(inp, start, numbered):
+            try:
+                ev = load_image(msg, read)
+            except KeyError as e: # missing dataset
+                _logger.warning("Skipping event: %s", e)
+                ev = None
+            if ev is None:
+                continue
+            if not started: # now that the layout is known
+                writer.start()
+                started = True
+            if not block:
+                block = new_block()
+            ev["event"] = np.int64(i)
+            for name, x in ev.items():
+                block[name][n] = x
+            n += 1
+            count += 1
+            if n == chunk_events:
+                blocks.put((block, n))
+                block = {}
+                n = 0
+            if errors:
+                raise errors[0]
+        if n > 0:
+            blocks.put((block, n))
+    finally:
+        if started:
+            blocks.put(end)
+            writer.join()
+    if errors:
+        raise errors[0]
+    return count
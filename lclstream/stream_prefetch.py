@@ -0,0 +1,81 @@
+from typing import Union, Optional, Tuple
+from collections.abc import Iterator, Iterable
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+import os
+import mmap
+
+import stream
+
+from .metrics import Metrics
+
+Buffer = Union[bytes, mmap.mmap]
+
+def read_file(fname: Union[str,os.PathLike], mmap_min: int = 0
+             ) -> Buffer:
+    """ Read a file's contents.
+
+    Files of at least `mmap_min` bytes (if `mmap_min` > 0)
+    are memory-mapped instead of read, and the kernel is
+    asked to start reading them in right away.
+    """
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_min <= 0 or size < max(mmap_min, 1):
+            return f.read()
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_WILLNEED)
+    return mm
+
+@stream.source
+def prefetch(names: Iterable[Union[str,os.PathLike]],
+             depth: int = 8,
+             budget: int = 256*1024**2,
+             threads: int = 4,
+             mmap_min: int = 16*1024**2,
+             metrics: Optional[Metrics] = None,
+            ) -> Iterator[Buffer]:
+    """ Read files in order, keeping up to `depth` reads
+    ahead of the consumer on a pool of `threads` threads.
+
+    New reads are not started while the files being read,
+    or read but not yet consumed, hold `budget` bytes or
+    more (counting each file's size from when its read is
+    started).  Large files are memory-mapped (see `read_file`).
+    The number of reads queued ahead is set as the
+    "prefetch_queue" gauge of `metrics`.
+    """
+    assert depth > 0
+    it = iter(names)
+    pending : deque[Tuple[Future,int]] = deque()
+    held = 0 # bytes reserved by the pending reads
+
+    def file_size(name: Union[str,os.PathLike]) -> int:
+        try:
+            return os.stat(name).st_size
+        except OSError: # reported by read_file
+            return 0
+
+    with ThreadPoolExecutor(threads) as pool:
+        def fill() -> None:
+            nonlocal held
+            while len(pending) < depth and held < budget:
+                try:
+                    name = next(it)
+                except StopIteration:
+                    return
+                size = file_size(name)
+                held += size
+                pending.append((pool.submit(read_file, name, mmap_min),
+                                size))
+
+        fill()
+        while len(pending) > 0:
+            f, size = pending.popleft()
+            data = f.result()
+            held -= size
+            fill()
+            if metrics is not None:
+                metrics.set("prefetch_queue", len(pending))
+            yield data
@@ -0,0 +1,174 @@
+""" Sequence numbers, to restore the order of a stream
+received over several connections.
+
+A numbered message is
+
+    magic (8 bytes) | stream id (uint64) | first number (uint64)
+                    | sequence number (uint64) | payload
+
+with all integers big-endian.  `sequence` numbers the
+messages of one sender, and `reorder` puts them back in
+order on the receiving side, reporting any gaps and
+duplicates.  Every message carries the number its stream
+started from, so the receiver knows where each stream
+begins whichever message arrives first.
+"""
+
+from typing import Union, Dict, List, Tuple, Optional
+from collections.abc import Iterator
+import struct
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+from .metrics import Metrics
+
+Buffer = Union[bytes, memoryview]
+
+magic = b"LCLSEQNO"
+header = struct.Struct('!QQQ')
+
+def is_numbered(msg: Buffer) -> bool:
+    return memoryview(msg)[:len(magic)] == magic
+
+def encode_seq(stream_id: int, start: int, seq: int,
+               data: Buffer) -> bytes:
+    return b"".join([magic, header.pack(stream_id, start, seq), data])
+
+def decode_seq(msg: Buffer) -> Tuple[int, int, int, memoryview]:
+    """ Split a numbered message into
+    (stream id, first number, sequence number, payload).
+    """
+    view = memoryview(msg).cast('B')
+    stream_id, start, seq = header.unpack_from(view, len(magic))
+    return stream_id, start, seq, view[len(magic)+header.size:]
+
+@stream.stream
+def sequence(inp: Iterator[Buffer], stream_id: int = 0,
+             start: int = 0) -> Iterator[bytes]:
+    """ Number messages from `start`, tagged with `stream_id`.
+    """
+    for i, x in enumerate(inp, start):
+        yield encode_seq(stream_id, start, i, x)
+
+class Reorder:
+    """ Reorder buffer for one stream.
+
+    Holds up to `window` messages that arrived ahead of the
+    next expected one.  Once it is full, the missing messages
+    are given up on (and counted as a gap).  If they still
+    turn up later, they are passed on late, rather than lost.
+
+    Missing messages are remembered as ranges, up to
+    `max_missing` of them.  Beyond that, the oldest are
+    forgotten, and count as duplicates if they turn up.
+    """
+    max_missing = 1024
+
+    def __init__(self, start: int, window: int) -> None:
+        self.next = start
+        self.window = window
+        self.held : Dict[int,memoryview] = {}
+        self.missing : List[range] = []
+        self.gaps = 0
+        self.duplicates = 0
+        self.late = 0
+
+    def put(self, seq: int, data: memoryview
+           ) -> Iterator[Tuple[int,memoryview]]:
+        """ Add one message, yielding all messages that
+        are now in order.
+        """
+        if seq < self.next:
+            if self.recover(seq):
+                self.gaps -= 1
+                self.late += 1
+                yield seq, data
+            else:
+                self.duplicates += 1
+            return
+        if seq in self.held:
+            self.duplicates += 1
+            return
+        self.held[seq] = data
+        if len(self.held) > self.window:
+            self.skip_to(min(self.held))
+        yield from self.ready()
+
+    def ready(self) -> Iterator[Tuple[int,memoryview]]:
+        while self.next in self.held:
+            yield self.next, self.held.pop(self.next)
+            self.next += 1
+
+    def recover(self, seq: int) -> bool:
+        """ Remove `seq` from the missing messages,
+        returning whether it was among them.
+        """
+        for k, r in enumerate(self.missing):
+            if seq in r:
+                self.missing[k:k+1] = [x for x in (range(r.start, seq),
+                                                   range(seq+1, r.stop))
+                                       if len(x) > 0]
+                return True
+        return False
+
+    def skip_to(self, seq: int) -> None:
+        _logger.warning("Missing messages %d to %d.", self.next, seq-1)
+        self.missing.append(range(self.next, seq))
+        if len(self.missing) > self.max_missing:
+            del self.missing[0]
+        self.gaps += seq - self.next
+        self.next = seq
+
+    def flush(self) -> Iterator[Tuple[int,memoryview]]:
+        """ Yield everything still held, in order.
+        """
+        while self.held:
+            self.skip_to(min(self.held))
+            yield from self.ready()
+
+@stream.stream
+def reorder(inp: Iterator[Buffer], window: int = 1024,
+            metrics: Optional[Metrics] = None,
+           ) -> Iterator[Tuple[int,memoryview]]:
+    """ Restore the order of numbered messages,
+    yielding (sequence number, payload) pairs.
+
+    Each stream id is reordered separately, starting from
+    the first number in its headers, and holding up to
+    `window` messages.  Messages without a sequence
+    header are an error.
+
+    The number of missing, duplicate and late messages
+    are logged at the end, and counted in `metrics`
+    ("gaps", "duplicates" and "late").
+    """
+    assert window > 0
+    streams : Dict[int,Reorder] = {}
+    def count() -> None:
+        if metrics is not None:
+            for k in ("gaps", "duplicates", "late"):
+                metrics.counters[k] = sum(getattr(r, k)
+                                          for r in streams.values())
+    try:
+        for msg in inp:
+            if not is_numbered(msg):
+                raise ValueError("Message has no sequence number.")
+            stream_id, start, seq, data = decode_seq(msg)
+            try:
+                r = streams[stream_id]
+            except KeyError:
+                r = streams[stream_id] = Reorder(start, window)
+            yield from r.put(seq, data)
+            if metrics is not None:
+                count()
+        for r in streams.values():
+            yield from r.flush()
+    finally:
+        count()
+        for stream_id, r in streams.items():
+            if r.gaps or r.duplicates or r.late:
+                _logger.warning("Stream %d: %d missing, %d duplicate "
+                                "and %d late messages.", stream_id,
+                                r.gaps, r.duplicates, r.late)
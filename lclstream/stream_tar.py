@@ -1,17 +1,96 @@
-from typing import Any
+from typing import Any, Union, List, Tuple, Optional
 from collections.abc import Iterator
+from collections import deque
 import tarfile
 import io
+import os
+import select
+import stat
+import time
+import ctypes
+import fcntl
+import termios
+import logging
+_logger = logging.getLogger(__name__)
 
 import stream
 
+from .stream_utils import write_all, numbering, file_name
+from .tar_index import IndexWriter
+
+Buffer = Union[bytes, memoryview]
+
+BLOCK = tarfile.BLOCKSIZE
+zeros = bytes(tarfile.RECORDSIZE)
+max_size = 8**11 # larger sizes need a pax header
+
+def _template() -> Tuple[bytearray, int]:
+    """ The ustar header `tarfile` writes for a regular file,
+    with an empty name and zero size - and the byte-sum of
+    its fields, with the checksum field counted as spaces.
+    """
+    info = tarfile.TarInfo("")
+    buf = bytearray(info.tobuf(tarfile.USTAR_FORMAT, tarfile.ENCODING,
+                               "surrogateescape"))
+    buf[148:156] = b" "*8
+    return buf, sum(buf)
+_header, _header_sum = _template()
+
+def tar_header(name: str, size: int) -> bytes:
+    """ The 512-byte tar header that `tarfile` writes for a
+    file called `name` holding `size` bytes (with default
+    metadata: mode 0644, owner 0, mtime 0).
+
+    Built directly, without tarfile, for names of up to
+    100 ascii characters and sizes below 8 GiB.
+    Anything else goes through tarfile, since it needs
+    a pax extended header.
+    """
+    bname = name.encode("ascii", "surrogateescape") \
+            if name.isascii() else b""
+    if not bname or len(bname) > 100 or size >= max_size:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        return info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING,
+                          "surrogateescape")
+    buf = bytearray(_header)
+    buf[:len(bname)] = bname
+    bsize = b"%011o\0" % size
+    buf[124:136] = bsize
+    chksum = _header_sum + sum(bname) + sum(bsize) - sum(_header[124:136])
+    buf[148:155] = b"%06o\0" % chksum
+    return bytes(buf)
+
+def padding(size: int) -> bytes:
+    rem = size % BLOCK
+    return zeros[:BLOCK-rem] if rem else b""
+
+def writev_all(fd: int, bufs: List[Buffer]) -> int:
+    """ Write all of `bufs` to `fd` with as few `os.writev`
+    calls as possible (one, unless writes come up short).
+    """
+    views = [memoryview(b).cast('B') for b in bufs]
+    total = sum(len(v) for v in views)
+    while views:
+        n = os.writev(fd, views)
+        while views and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if n:
+            views[0] = views[0][n:]
+    return total
+
 @stream.sink
-def write_tar(inp: Iterator[bytes], file: Any, names: str
-             ) -> None:
+def write_tar(inp: Iterator[bytes], file: Any, names: str,
+              start: int = 0, numbered: bool = False) -> None:
+    """ Write messages to `file` as a tar stream, naming
+    them `names % i` (see `numbering` for `start`
+    and `numbered`).
+    """
     with tarfile.open(fileobj=file.buffer, mode="w|") as tar:
-        for i, data in enumerate(inp):
+        for i, data in numbering(inp, start, numbered):
             # Create a TarInfo object for the file
-            info = tarfile.TarInfo(names % i)
+            info = tarfile.TarInfo(file_name(names, i))
             info.size = len(data)
 
             # Create a BytesIO object to hold the file content
@@ -19,3 +98,163 @@ def write_tar(inp: Iterator[bytes], file: Any, names: str
 
             # Add the file to the tar archive
             tar.addfile(info, fileobj=file_obj)
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+def _vmsplice() -> Any:
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fn = libc.vmsplice
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                   ctypes.c_size_t, ctypes.c_uint]
+    fn.restype = ctypes.c_ssize_t
+    return fn
+vmsplice = _vmsplice()
+
+def is_pipe(fd: int) -> bool:
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+class PipeSplicer:
+    """ Move buffers into a pipe with vmsplice, so that the
+    pipe refers to their pages rather than a copy.
+
+    Since the reader sees those pages only once it gets to
+    them, every buffer is held until the reader has
+    consumed it (tracked with FIONREAD).  Buffers passed in
+    must not be modified afterwards.
+    """
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.written = 0
+        self.held : deque[Tuple[int,Buffer]] = deque()
+        try: # a larger pipe means fewer wakeups
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, 1024*1024)
+        except (OSError, AttributeError):
+            pass
+
+    def unread(self) -> int:
+        n = ctypes.c_int()
+        fcntl.ioctl(self.fd, termios.FIONREAD, n)
+        return n.value
+
+    def release(self) -> None:
+        consumed = self.written - self.unread()
+        while self.held and self.held[0][0] <= consumed:
+            self.held.popleft()
+
+    def write(self, bufs: List[Buffer]) -> int:
+        import numpy as np
+        arrs = [np.frombuffer(b, np.uint8) for b in bufs if len(b)]
+        total = 0
+        for a in arrs:
+            total += a.nbytes
+            self.held.append((self.written+total, a))
+        iov = (iovec*len(arrs))(*[(a.ctypes.data, a.nbytes) for a in arrs])
+        k = 0
+        while k < len(arrs):
+            n = vmsplice(self.fd,
+                         ctypes.addressof(iov) + k*ctypes.sizeof(iovec),
+                         len(arrs)-k, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            while k < len(arrs) and n >= iov[k].iov_len:
+                n -= iov[k].iov_len
+                k += 1
+            if n:
+                iov[k].iov_base += n
+                iov[k].iov_len -= n
+        self.written += total
+        self.release()
+        return total
+
+    def close(self, timeout: float = 60.0) -> None:
+        """ Wait for the reader to consume everything,
+        so the buffers can be freed.
+
+        Gives up with a warning if the reader closes the pipe,
+        or consumes nothing for `timeout` seconds.
+        """
+        p = select.poll()
+        p.register(self.fd, 0) # errors are always reported
+        unread = -1
+        while self.held:
+            if p.poll(0):
+                _logger.warning("Pipe closed with %d bytes unread.", unread)
+                return
+            if self.unread() != unread:
+                unread = self.unread()
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                _logger.warning("Pipe reader stalled with %d bytes unread.",
+                                unread)
+                return
+            time.sleep(0.001)
+            self.release()
+
+@stream.sink
+def write_tar_fd(inp: Iterator[Buffer], fd: int,
+                 names: str, start: int = 0,
+                 numbered: bool = False,
+                 splice: bool = False,
+                 index: Optional[Union[str,os.PathLike]] = None,
+                 offset: int = 0,
+                 keep: int = 0,
+                ) -> None:
+    """ Same output as `write_tar`, but each payload is
+    written straight from its buffer to the file descriptor
+    `fd`, rather than being copied through tarfile.
+    Headers are built directly, and each member (header,
+    payload and padding) is written with a single writev.
+
+    This accepts the memoryviews from `puller(zerocopy=True)`.
+
+    If `splice` is set and `fd` is a pipe, members are
+    moved into the pipe with vmsplice instead of being
+    copied.  Buffers are then held until the reader has
+    consumed them, so they must stay valid until then
+    (i.e. not the zerocopy memoryviews).
+
+    If `index` is given, an index of the members is written
+    there as well (see `tar_index`).  Members named by
+    (name, msg) pairs are numbered by their position.
+
+    When `fd` continues an archive (see `manifest.rewind`),
+    `offset` is where the output starts within it, and the
+    first `keep` entries of its index are kept.
+    """
+    splicer = None
+    if splice:
+        if vmsplice is not None and is_pipe(fd):
+            splicer = PipeSplicer(fd)
+        else:
+            _logger.info("Not splicing - output is not a pipe.")
+    write = writev_all if splicer is None \
+            else lambda fd, bufs: splicer.write(bufs)
+
+    idx = None if index is None else IndexWriter(index, keep)
+    pos = offset
+    try:
+        for k, (i, data) in enumerate(numbering(inp, start, numbered)):
+            size = memoryview(data).nbytes
+            name = file_name(names, i)
+            header = tar_header(name, size)
+            if idx is not None:
+                idx.add(name, pos+len(header), size,
+                        k if isinstance(i, str) else i)
+            pos += write(fd, [header, data, padding(size)])
+    finally:
+        if idx is not None:
+            idx.close()
+    # end of archive, padded out to a full record like tarfile does
+    end = 2*BLOCK
+    rem = (pos + end) % tarfile.RECORDSIZE
+    if rem:
+        end += tarfile.RECORDSIZE - rem
+    write(fd, [zeros[:end]])
+    if splicer is not None:
+        splicer.close()
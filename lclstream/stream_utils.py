@@ -1,10 +1,16 @@
-from typing import Tuple, Union
-from collections.abc import Iterator
+from typing import List, Tuple, Union, TypeVar, Any
+from collections.abc import Iterator, AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import itertools
+import zlib
 import os
 from pathlib import Path
 import time
 import struct
+import asyncio
+import threading
+import queue
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -19,6 +25,171 @@ import stream
 #            yield x
 #            pbar.update(len(x)-4)
 
+T = TypeVar('T')
+
+def iterate_async(agen: AsyncIterator[T], maxsize: int = 16
+                 ) -> Iterator[T]:
+    """ Iterate over an async generator from synchronous code.
+
+    The generator runs on its own event loop in a background
+    thread, so it keeps working while the caller processes
+    the items already delivered (up to `maxsize` at a time).
+    Exceptions raised by the generator are re-raised here.
+    """
+    out : queue.Queue = queue.Queue(maxsize)
+    stop = threading.Event()
+    end = object()
+
+    def put(item: Any) -> bool:
+        # blocking put that gives up once the consumer has left
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def run() -> None:
+        try:
+            async for x in agen:
+                try:
+                    out.put_nowait((x, None))
+                except queue.Full:
+                    if not await asyncio.to_thread(put, (x, None)):
+                        break
+        except BaseException as e:
+            put((end, e))
+            return
+        finally:
+            await agen.aclose()
+        put((end, None))
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(run())
+    def main() -> None:
+        try:
+            loop.run_until_complete(task)
+        finally:
+            loop.close()
+    th = threading.Thread(target=main, daemon=True)
+    th.start()
+    try:
+        while True:
+            x, err = out.get()
+            if err is not None:
+                raise err
+            if x is end:
+                break
+            yield x
+    finally:
+        stop.set()
+        try:
+            loop.call_soon_threadsafe(task.cancel)
+        except RuntimeError: # loop already closed
+            pass
+        th.join()
+
+S = TypeVar('S')
+
+@stream.stream
+def pmap(inp: Iterator[S], fn: Callable[[S],T], threads: int = 4
+        ) -> Iterator[T]:
+    """ Like stream.map, but runs `fn` on a pool of `threads`
+    threads (with up to 2*threads items in flight), keeping
+    the output in order.
+
+    Items are read and submitted from a background thread,
+    so each result is passed on as soon as it (and those
+    before it) are done, even while the next item is slow
+    to arrive.  They are read ahead of the consumer, so they
+    must stay valid after the next one is requested.
+    """
+    assert threads > 0
+    pending : queue.Queue = queue.Queue(2*threads)
+    stop = threading.Event()
+    end = object()
+
+    def put(item: Any) -> bool:
+        # blocking put that gives up once the consumer has left
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed() -> None:
+        try:
+            for x in inp:
+                if not put((pool.submit(fn, x), None)):
+                    return
+        except BaseException as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    pool = ThreadPoolExecutor(threads)
+    th = threading.Thread(target=feed, daemon=True)
+    th.start()
+    try:
+        while True:
+            f, err = pending.get()
+            if err is not None:
+                raise err
+            if f is end:
+                break
+            yield f.result()
+        th.join()
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@stream.stream
+def lazy_pmap(inp: Iterator[S], fn: Callable[[S],T],
+              needs: Callable[[S],bool], threads: int = 4
+             ) -> Iterator[T]:
+    """ Like pmap, but runs `fn` inline until the first item
+    that `needs` work, and only uses the pool from there on.
+    So a stream with nothing to do never leaves this thread.
+    """
+    it = iter(inp)
+    for x in it:
+        if needs(x):
+            yield from itertools.chain([x], it) >> pmap(fn, threads)
+            return
+        yield fn(x)
+
+def write_all(fd: int, data: Union[bytes,memoryview]) -> int:
+    """ Write all of `data` to the file descriptor `fd`,
+    retrying on short writes.  Returns the number of bytes
+    written.
+    """
+    view = memoryview(data).cast('B')
+    n = len(view)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+    return n
+
+def numbering(inp: Iterator[Any], start: int = 0,
+              numbered: bool = False) -> Iterator[Tuple[Any,Any]]:
+    """ Pair messages with their file numbers, counting from
+    `start` - or, if `numbered` is set, take the numbers
+    from (number, message) pairs (e.g. from `reorder`),
+    or the file names from (name, message) pairs
+    (e.g. from `merge`).
+    """
+    if numbered:
+        return iter(inp)
+    return enumerate(inp, start)
+
+def file_name(names: str, key: Union[int,str]) -> str:
+    """ The name of file number `key` (`names % key`),
+    or `key` itself if it is already a name.
+    """
+    return key if isinstance(key, str) else names % key
+
 clock0 = lambda: {'count': 0, 'size': 0, 'wait': 0, 'time': time.time()}
 def rate_clock(state, sz):
     t = time.time()
@@ -36,6 +207,33 @@ def clock():
     """
     return stream.fold(rate_clock, clock0())
 
+class Crc32:
+    """ zlib.crc32 with the interface of a hashlib hash.
+    Much cheaper than a cryptographic hash, but only good
+    for catching accidental corruption.
+    """
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self, data: bytes = b'') -> None:
+        self.value = zlib.crc32(data)
+
+    def update(self, data: bytes) -> None:
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return struct.pack('!I', self.value)
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+def new_hash(alg: str, data: bytes = b'') -> Any:
+    """ Like hashlib.new, but also accepts 'crc32'.
+    """
+    if alg == 'crc32':
+        return Crc32(data)
+    return hashlib.new(alg, data)
+
 @stream.stream
 def hasher(it : Iterator[bytes], alg='sha256'
           ) -> Iterator[Union[bytes,str]]:
@@ -43,7 +241,7 @@ def hasher(it : Iterator[bytes], alg='sha256'
     this stream.  The last message from the stream
     will be a string, containing the stream's hash digest.
     """
-    h = hashlib.new(alg)
+    h = new_hash(alg)
     for x in it:
         h.update(x)
         yield x
@@ -83,13 +281,46 @@ def file_writer(gen: Iterator[Tuple[int,bytes]],
                 size: int = 0,
                 append: bool = False,
                ) -> Iterator[int]:
+    """ Write (offset, data) chunks into `fname` (or append
+    them, ignoring the offsets), until a final (-1, hash)
+    message, whose sha256 is then checked.
+
+    The hash is computed while writing.  Chunks arriving in
+    order are hashed as they go, and chunks that arrive
+    early are read back (usually from the page cache) once
+    the gap before them is filled - so the file is not read
+    again at the end.
+    """
     if append:
-        mode = 'ab'
+        mode = 'a+b'
     else:
-        mode = 'wb'
+        mode = 'w+b'
     pos = 0
     off = 0
+    h = new_hash('sha256')
+    hashed = 0 # the file is hashed up to here
+    ahead : List[Tuple[int,int]] = [] # (start, end) written beyond it
     with open(fname, mode) as f:
+        def read_back(end: int) -> None:
+            nonlocal hashed
+            f.flush()
+            while hashed < end:
+                data = os.pread(f.fileno(), min(end-hashed, 1 << 20), hashed)
+                if len(data) == 0:
+                    break
+                h.update(data)
+                hashed += len(data)
+
+        def catch_up() -> None:
+            while True:
+                ends = [e for s, e in ahead if s <= hashed]
+                if not ends or max(ends) <= hashed:
+                    return
+                read_back(max(ends))
+                ahead[:] = [(s, e) for s, e in ahead if e > hashed]
+
+        if append: # the hash covers what was there already
+            read_back(os.fstat(f.fileno()).st_size)
         for off, data in gen:
             if not append:
                 if off == -1: # a final hash!
@@ -101,11 +332,20 @@ def file_writer(gen: Iterator[Tuple[int,bytes]],
                 if off != pos:
                     f.seek(off)
                     pos = off
+            if pos == hashed:
+                h.update(data)
+                hashed += len(data)
+            elif pos+len(data) > hashed:
+                ahead.append((pos, pos+len(data)))
             yield f.write(data)
             pos += len(data)
+            if ahead:
+                catch_up()
+        if off == -1: # anything not yet hashed (e.g. holes)
+            read_back(os.fstat(f.fileno()).st_size)
 
     if off == -1:
-        H = hash_file(fname)
+        H = h.hexdigest()
         assert H == data.decode('ascii')
         _logger.warning("File checksum matches!")
     else:
@@ -0,0 +1,142 @@
+""" Sidecar index of a tar stream, for random access.
+
+An index file is
+
+    magic (8 bytes) | entry | entry | ...
+
+where each entry is
+
+    offset (uint64) | size (uint64) | time (float64) | seq (int64) |
+    name length (uint16) | name (utf-8)
+
+with all integers big-endian.  `offset` is the position of
+the member's data in the archive, `time` is when it was
+written (seconds since the epoch) and `seq` is its number
+(the sequence number with `pull --seq`, else its position).
+"""
+
+from typing import Union, Dict, List, Optional, NamedTuple, BinaryIO
+from collections.abc import Iterator
+import mmap
+import os
+import struct
+import time
+
+magic = b"LCLTIDX1"
+entry_fmt = struct.Struct('!QQdqH')
+
+class IndexEntry(NamedTuple):
+    name: str
+    offset: int
+    size: int
+    time: float
+    seq: int
+
+def entries_end(data: bytes, count: int) -> int:
+    """ Position just after the first `count` entries
+    of the index `data`.
+    """
+    assert data[:len(magic)] == magic, "Not a tar index."
+    pos = len(magic)
+    for i in range(count):
+        assert pos + entry_fmt.size <= len(data), \
+                f"Index holds only {i} of {count} entries."
+        n = entry_fmt.unpack_from(data, pos)[-1]
+        pos += entry_fmt.size + n
+    return pos
+
+class IndexWriter:
+    """ Append entries to the index file at `path`.
+
+    With `keep` > 0, the first `keep` entries already in
+    the file are kept (for an archive being resumed), and
+    any after them are replaced.  Entries are written
+    unbuffered, so the index is never behind the archive.
+    """
+    def __init__(self, path: Union[str,os.PathLike], keep: int = 0) -> None:
+        if keep > 0:
+            self.f : BinaryIO = open(path, "r+b", buffering=0)
+            end = entries_end(self.f.read(), keep)
+            self.f.truncate(end)
+            self.f.seek(end)
+        else:
+            self.f = open(path, "wb", buffering=0)
+            self.f.write(magic)
+
+    def add(self, name: str, offset: int, size: int, seq: int) -> None:
+        bname = name.encode("utf-8", "surrogateescape")
+        self.f.write(entry_fmt.pack(offset, size, time.time(), seq,
+                                    len(bname)) + bname)
+
+    def close(self) -> None:
+        self.f.close()
+
+def read_index(path: Union[str,os.PathLike]) -> List[IndexEntry]:
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:len(magic)] == magic, f"{path} is not a tar index."
+    pos = len(magic)
+    out = []
+    while pos < len(data):
+        offset, size, t, seq, n = entry_fmt.unpack_from(data, pos)
+        pos += entry_fmt.size
+        name = data[pos:pos+n].decode("utf-8", "surrogateescape")
+        pos += n
+        out.append(IndexEntry(name, offset, size, t, seq))
+    assert pos == len(data), f"{path} is truncated."
+    return out
+
+class TarIndex:
+    """ Random access to the members of a tar archive
+    through its index (by default `archive + ".idx"`).
+
+    The archive is memory-mapped, and members are returned
+    as memoryviews into it - without copying or scanning.
+    The views must be released before the index is closed.
+    """
+    def __init__(self, archive: Union[str,os.PathLike],
+                 index: Optional[Union[str,os.PathLike]] = None) -> None:
+        if index is None:
+            index = f"{os.fspath(archive)}.idx"
+        self.entries = read_index(index)
+        self.by_name : Dict[str,IndexEntry] = {e.name: e for e in self.entries}
+        self.by_seq : Dict[int,IndexEntry] = {e.seq: e for e in self.entries}
+        with open(archive, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) \
+                      if size > 0 else None
+        self.view = memoryview(self.mm) if self.mm is not None \
+                    else memoryview(b"")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.by_name)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.by_name
+
+    def member(self, e: IndexEntry) -> memoryview:
+        assert e.offset + e.size <= len(self.view), \
+                f"{e.name} is past the end of the archive."
+        return self.view[e.offset:e.offset+e.size]
+
+    def __getitem__(self, name: str) -> memoryview:
+        return self.member(self.by_name[name])
+
+    def seq(self, seq: int) -> memoryview:
+        """ The member with sequence number `seq`.
+        """
+        return self.member(self.by_seq[seq])
+
+    def close(self) -> None:
+        self.view.release()
+        if self.mm is not None:
+            self.mm.close()
+
+    def __enter__(self) -> "TarIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
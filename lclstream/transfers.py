@@ -0,0 +1,145 @@
+""" Request several transfers from LCLStreamer-API at once,
+and merge their streams into one.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from collections.abc import Iterator, Callable
+from pathlib import Path
+import json
+import queue
+import re
+import threading
+import logging
+_logger = logging.getLogger(__name__)
+
+import stream
+
+Buffer = Union[bytes, memoryview]
+Source = Tuple[str, Dict[str,Any]] # (label, config)
+
+def load_configs(path: Path) -> List[Source]:
+    """ Read a json or yaml config file, labeled by its name.
+    A file holding a list of configs requests one transfer
+    for each, labeled name-0, name-1, ...
+    """
+    if path.suffix == ".yml" or path.suffix == ".yaml":
+        import yaml
+        cfg = yaml.safe_load(path.read_text())
+    else:
+        cfg = json.loads(path.read_text())
+    if isinstance(cfg, list):
+        return [(f"{path.stem}-{k}", c) for k, c in enumerate(cfg)]
+    return [(path.stem, cfg)]
+
+def label_part(value: Any) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value))
+
+def expand(sources: List[Source], key: str) -> List[Source]:
+    """ Replace every config whose value at `key` (with dots
+    separating nested keys, e.g. "source.run") is a list
+    by one config for each of its values.
+    """
+    path = key.split(".")
+    out = []
+    for label, cfg in sources:
+        node = cfg
+        for k in path[:-1]:
+            node = node.get(k, {}) if isinstance(node, dict) else {}
+        values = node.get(path[-1]) if isinstance(node, dict) else None
+        if not isinstance(values, list):
+            out.append((label, cfg))
+            continue
+        for v in values:
+            new = json.loads(json.dumps(cfg)) # deep copy
+            node = new
+            for k in path[:-1]:
+                node = node[k]
+            node[path[-1]] = v
+            out.append((f"{label}-{label_part(v)}", new))
+    return out
+
+def unique_labels(sources: List[Source]) -> List[Source]:
+    seen : Dict[str,int] = {}
+    out = []
+    for label, cfg in sources:
+        n = seen.get(label, 0)
+        seen[label] = n + 1
+        out.append((label if n == 0 else f"{label}.{n}", cfg))
+    return out
+
+async def request_all(session: Any, cfgs: Sequence[Dict[str,Any]]
+                     ) -> List[Tuple[bool, Dict[str,Any]]]:
+    """ POST every config to /v1/transfers concurrently,
+    returning an (ok, response) pair for each.
+
+    A request that fails outright gives (False, {"error": ...}),
+    so the transfers created by the others are still returned
+    (to be used or cancelled).
+    """
+    import asyncio
+    async def one(cfg: Dict[str,Any]) -> Tuple[bool, Dict[str,Any]]:
+        resp = await session.post("/v1/transfers", cfg)
+        ok = resp.status_code//100 == 2
+        return ok, await resp.json()
+    ans = await asyncio.gather(*map(one, cfgs), return_exceptions=True)
+    out : List[Tuple[bool, Dict[str,Any]]] = []
+    for x in ans:
+        if isinstance(x, Exception):
+            _logger.error("Transfer request failed: %s", x)
+            out.append((False, {"error": str(x)}))
+        elif isinstance(x, BaseException):
+            raise x
+        else:
+            out.append(x)
+    return out
+
+async def cancel_all(session: Any, tids: Sequence[int]) -> None:
+    """ DELETE every transfer concurrently (logging failures).
+    """
+    import asyncio
+    ans = await asyncio.gather(*[session.delete(f"/v1/transfers/{tid}")
+                                 for tid in tids],
+                               return_exceptions=True)
+    for tid, x in zip(tids, ans):
+        if isinstance(x, BaseException):
+            _logger.error("Unable to cancel transfer %d: %s", tid, x)
+
+@stream.source
+def merge(sources: Sequence[Tuple[str, Callable[[], Iterator[Buffer]]]],
+          names: str, maxsize: int = 64
+         ) -> Iterator[Tuple[str,Buffer]]:
+    """ Run each source (a `(prefix, start)` pair, where
+    `start()` returns its messages) on its own thread,
+    and yield (name, message) pairs as they arrive.
+
+    Messages are named `prefix + names % i`, with `i`
+    counting each source's messages separately.  Up to
+    `maxsize` messages wait to be consumed.  An error in
+    any source is raised once the others are done.
+    """
+    q : queue.Queue[Optional[Tuple[str,Buffer]]] = queue.Queue(maxsize)
+    errors : List[BaseException] = []
+    def run(prefix: str, start: Callable[[], Iterator[Buffer]]) -> None:
+        try:
+            for i, msg in enumerate(start()):
+                q.put((prefix + names % i, msg))
+        except BaseException as e:
+            _logger.error("Source %s failed: %s", prefix, e)
+            errors.append(e)
+        finally:
+            q.put(None)
+    threads = [threading.Thread(target=run, args=src, daemon=True)
+               for src in sources]
+    for th in threads:
+        th.start()
+    running = len(threads)
+    while running > 0:
+        item = q.get()
+        if item is None:
+            running -= 1
+        else:
+            yield item
+    for th in threads:
+        th.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,94 @@
+""" Run a receive pipeline in several processes.
+
+Each worker is a separate process (so none of them share a
+GIL), exporting its metrics as JSON lines to its own file.
+The parent follows those files, combining them into one
+`Metrics`, and stops all workers if it is interrupted.
+"""
+
+from typing import Any, Dict, List, Sequence, Tuple, Union
+from collections.abc import Callable
+from multiprocessing.connection import wait
+import json
+import multiprocessing
+import os
+import logging
+_logger = logging.getLogger(__name__)
+
+from .metrics import Metrics
+
+class Follow:
+    """ Read the latest snapshot appended to a JSON lines
+    metrics file (see `Metrics.write`).
+    """
+    def __init__(self, path: Union[str,os.PathLike]) -> None:
+        self.path = path
+        self.pos = 0
+        self.partial = b""
+        self.last : Dict[str,Any] = {}
+
+    def update(self) -> Dict[str,Any]:
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.pos)
+                data = f.read()
+        except FileNotFoundError:
+            return self.last
+        self.pos += len(data)
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in reversed(lines):
+            if line.strip():
+                self.last = json.loads(line)
+                break
+        return self.last
+
+def run_workers(target: Callable[..., None],
+                args: Sequence[Tuple[Any,...]],
+                metrics_files: Sequence[Union[str,os.PathLike]],
+                stats: Metrics,
+                interval: float = 1.0) -> List[int]:
+    """ Run `target(*a)` in a new process for each `a` in `args`,
+    and wait for all of them, returning their exit codes.
+
+    Every `interval` seconds, `stats` is set to the sum of
+    the last snapshots written to `metrics_files`.
+
+    If this is interrupted (e.g. by a signal handler
+    raising SystemExit), the workers are terminated.
+    """
+    assert len(args) == len(metrics_files)
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=target, args=a, name=f"worker-{k}")
+             for k, a in enumerate(args)]
+    follow = [Follow(path) for path in metrics_files]
+
+    def update() -> None:
+        m = Metrics(stats.prefix)
+        for f in follow:
+            snap = f.update()
+            if snap:
+                m.add(snap)
+        stats.counters, stats.gauges, stats.histograms = \
+                m.counters, m.gauges, m.histograms
+
+    try:
+        for p in procs:
+            p.start()
+        running = {p.sentinel: p for p in procs}
+        while running:
+            for s in wait(list(running), interval):
+                p = running.pop(s) # type: ignore[call-overload]
+                p.join()
+                if p.exitcode != 0:
+                    _logger.error("%s exited with code %s.",
+                                  p.name, p.exitcode)
+            update()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            if p.pid is not None:
+                p.join()
+    return [p.exitcode for p in procs] # type: ignore[misc]
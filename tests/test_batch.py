@@ -0,0 +1,30 @@
+import random
+import time
+
+from lclstream.stream_batch import batch, unbatch, pack_batch, magic
+
+def test_batch_roundtrip():
+    random.seed(8)
+    msgs = [random.randbytes(random.randrange(0, 300)) for i in range(200)]
+    msgs.append(random.randbytes(5000)) # sent alone
+    msgs.append(magic + b"looks like a batch")
+    msgs += [b"x"]*3
+
+    frames = list(msgs >> batch(1000, 10.0))
+    assert len(frames) < len(msgs)
+    out = [bytes(x) for x in frames >> unbatch()]
+    assert out == msgs
+
+def test_unbatch_passthrough():
+    msgs = [b"plain", pack_batch([b"a", b"", b"bc"]), b"more"]
+    out = [bytes(x) for x in msgs >> unbatch()]
+    assert out == [b"plain", b"a", b"", b"bc", b"more"]
+
+def test_batch_delay():
+    def slow():
+        for i in range(3):
+            yield b"%d" % i
+            time.sleep(0.05)
+
+    frames = list(slow() >> batch(1000, 0.001))
+    assert frames == [b"0", b"1", b"2"]
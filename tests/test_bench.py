@@ -0,0 +1,43 @@
+import json
+
+import pytest
+from typer.testing import CliRunner
+
+from lclstream.lclstream import app
+from lclstream.bench import run_case, compare, transports, sinks
+
+@pytest.mark.parametrize("transport", transports)
+def test_transports(transport):
+    r = run_case(transport, 4096, 2, "null", 200)
+    assert r["count"] == 200
+    assert r["mb_per_s"] > 0 and r["msgs_per_s"] > 0
+    assert 0 < r["p50"] <= r["p99"]
+
+@pytest.mark.parametrize("sink", sinks)
+def test_sinks(sink):
+    assert run_case("inproc", 1024, 1, sink, 100)["count"] == 100
+
+def test_compare():
+    base = [{"transport": "tcp", "size": 1024, "ndial": 1, "sink": "null",
+             "mb_per_s": 100.0}]
+    fast = [dict(base[0], mb_per_s=95.0)]
+    slow = [dict(base[0], mb_per_s=80.0)]
+    other = [dict(base[0], ndial=2, mb_per_s=1.0)]
+    assert compare(fast, base) == []
+    assert len(compare(slow, base)) == 1
+    assert compare(other, base) == []
+
+def test_bench_cli(tmp_path):
+    out = tmp_path/"base.json"
+    runner = CliRunner()
+    result = runner.invoke(app, ["bench", "-t", "inproc", "--size-kb", "4",
+                                 "--count", "50", "-o", str(out)])
+    assert result.exit_code == 0, result.output
+    assert json.loads(out.read_text())[0]["count"] == 50
+
+    fast = json.loads(out.read_text())
+    fast[0]["mb_per_s"] *= 1000
+    out.write_text(json.dumps(fast))
+    result = runner.invoke(app, ["bench", "-t", "inproc", "--size-kb", "4",
+                                 "--count", "50", "--baseline", str(out)])
+    assert result.exit_code == 1
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from lclstream.stream_check import (
+    checksum,
+    verify,
+    algorithms,
+    is_checked,
+    ChecksumError,
+)
+from lclstream.stream_compress import compress, decompress
+from lclstream.metrics import Metrics
+
+@pytest.mark.parametrize("alg", sorted(algorithms))
+def test_checksum_roundtrip(alg):
+    random.seed(12)
+    msgs = [random.randbytes(random.randrange(0, 10000)) for i in range(50)]
+    out = list(msgs >> checksum(alg, threads=2))
+    assert all(is_checked(x) for x in out)
+    assert [bytes(x) for x in out >> verify(2)] == msgs
+    assert [bytes(x) for x in out >> verify(0)] == msgs
+    # unchecked messages pass through
+    assert [bytes(x) for x in msgs >> verify()] == msgs
+
+def corrupt(msgs, k):
+    out = list(msgs >> checksum())
+    bad = bytearray(out[k])
+    bad[-1] ^= 1
+    out[k] = bytes(bad)
+    return out
+
+def test_corrupt():
+    msgs = [b"%d" % i for i in range(10)]
+    with pytest.raises(ChecksumError):
+        list(corrupt(msgs, 3) >> verify())
+
+    m = Metrics()
+    out = [bytes(x) for x in corrupt(msgs, 3) >> verify(mode="log", metrics=m)]
+    assert out == msgs[:3] + [b"2"] + msgs[4:]
+    assert m.counters["corrupt"] == 1
+
+    out = [bytes(x) for x in corrupt(msgs, 3) >> verify(mode="drop")]
+    assert out == msgs[:3] + msgs[4:]
+
+def test_required():
+    msgs = [b"%d" % i for i in range(10)]
+    out = list(msgs >> checksum("crc32"))
+    bad = bytearray(out[3])
+    bad[0] ^= 1 # no longer looks checked
+    out[3] = bytes(bad)
+    out[5] = out[5][:10] # header cut short
+    # passed through, unless checksums are required
+    assert bytes(list(out[:5] >> verify())[3]) == bytes(bad)
+    for threads in (0, 2):
+        with pytest.raises(ChecksumError):
+            list(out >> verify(threads, required=True))
+    m = Metrics()
+    res = [bytes(x) for x in out >> verify(mode="drop", metrics=m,
+                                           required=True)]
+    assert res == msgs[:3] + [msgs[4]] + msgs[6:]
+    assert m.counters["corrupt"] == 2
+
+def test_compressed():
+    msgs = [bytes(1000)*i for i in range(10)]
+    out = msgs >> compress("zlib") >> checksum("crc32")
+    assert [bytes(x) for x in out >> verify() >> decompress()] == msgs
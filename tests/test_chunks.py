@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from lclstream.stream_chunks import (
+    file_messages,
+    chunk_writer,
+    encode_chunk,
+)
+from lclstream.manifest import ChunkManifest
+
+@pytest.mark.parametrize("alg", ["sha256", "crc32",
+                                 "tree-sha256", "tree-crc32"])
+def test_chunks_out_of_order(tmpdir, alg):
+    random.seed(5)
+    src = tmpdir/"src.bin"
+    src.write_binary(random.randbytes(10*1000+17))
+    out = tmpdir/"out.bin"
+
+    msgs = list(file_messages(src, 1000, alg))
+    assert len(msgs) == 12 # 11 chunks + digest
+    random.shuffle(msgs)
+    msgs.insert(3, msgs[5]) # a duplicate chunk is harmless
+
+    written = msgs >> chunk_writer(out, alg)
+    assert sum(written) >= 10*1000+17
+    assert out.read_binary() == src.read_binary()
+
+def test_chunks_bad_digest(tmpdir):
+    out = tmpdir/"out.bin"
+    msgs = [encode_chunk(0, 4, 4, b"abcd"),
+            encode_chunk(-1, 4, 4, b"0"*64)]
+    with pytest.raises(ValueError):
+        list(msgs >> chunk_writer(out))
+
+    # sender and receiver must agree on the checksum
+    msgs = [encode_chunk(0, 4, 4, b"abcd"),
+            encode_chunk(-1, 4, 4, b"crc32:ed82cd11")]
+    list(msgs >> chunk_writer(out, "crc32"))
+    with pytest.raises(ValueError):
+        list(msgs >> chunk_writer(out, "tree-crc32"))
+
+@pytest.mark.parametrize("alg", ["sha256", "tree-sha256"])
+def test_chunks_resume(tmpdir, alg):
+    random.seed(6)
+    src = tmpdir/"src.bin"
+    src.write_binary(random.randbytes(20*1000))
+    out = tmpdir/"out.bin"
+    manifest = tmpdir/"out.bin.manifest"
+
+    # interrupted after 7 chunks
+    msgs = list(file_messages(src, 1000, alg))
+    list(msgs[:7] >> chunk_writer(out, alg, manifest, interval=0))
+    done = ChunkManifest.load(manifest, 20*1000, 1000)
+    assert done.count == 7
+
+    # only the missing chunks (+ digest) are sent
+    msgs = list(file_messages(src, 1000, alg, done))
+    assert len(msgs) == 20-7+1
+    list(msgs >> chunk_writer(out, alg, manifest))
+    assert out.read_binary() == src.read_binary()
+    assert not manifest.exists()
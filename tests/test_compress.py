@@ -0,0 +1,31 @@
+import random
+
+import pytest
+
+from lclstream.stream_compress import (
+    compress,
+    decompress,
+    codecs,
+    is_compressed,
+    magic,
+)
+
+@pytest.mark.parametrize("codec", sorted(codecs))
+def test_compress_roundtrip(codec):
+    random.seed(9)
+    msgs = [bytes(random.randrange(4))*random.randrange(0, 10000)
+                for i in range(50)]
+    msgs.append(magic + b"looks compressed")
+
+    out = list(msgs >> compress(codec, threads=2))
+    if codec != "none":
+        assert sum(map(len, out)) < sum(map(len, msgs))
+    assert [bytes(x) for x in out >> decompress(2)] == msgs
+    assert [bytes(x) for x in out >> decompress(0)] == msgs
+
+def test_compress_skips_random():
+    random.seed(10)
+    msgs = [random.randbytes(5000) for i in range(20)]
+    out = list(msgs >> compress("zlib", probe=4))
+    assert not any(is_compressed(x) for x in out)
+    assert out == msgs
@@ -0,0 +1,80 @@
+import os
+import random
+import tarfile
+
+import pytest
+
+from lclstream.stream_dir import write_dir
+from lclstream.stream_tar import write_tar_fd
+from lclstream.manifest import Progress, commit_count, rewind
+from lclstream.tar_index import TarIndex
+
+@pytest.mark.parametrize("fsync,atomic", [(0, False), (3, False),
+                                          (0, True), (4, True)])
+def test_write_dir(tmpdir, fsync, atomic):
+    random.seed(3)
+    msgs = [random.randbytes(random.randrange(1, 4096)) for i in range(25)]
+    out = tmpdir/"out"
+
+    n = msgs >> write_dir(out, "%02d.h5", 3, fsync, atomic)
+    assert n == len(msgs)
+    assert sorted(p.basename for p in out.listdir()) \
+                == [f"{i:02d}.h5" for i in range(len(msgs))]
+    for i, m in enumerate(msgs):
+        assert (out/f"{i:02d}.h5").read_binary() == m
+
+def test_write_dir_resume(tmpdir):
+    out = tmpdir/"out"
+    progress = Progress(tmpdir/"progress")
+    assert progress.start == 0
+    [b"a", b"b", b"c"] >> write_dir(out, "%02d.h5", 2, 0, False,
+                                    progress.start, progress)
+
+    progress = Progress(tmpdir/"progress")
+    assert progress.start == 3
+    [b"d", b"e"] >> write_dir(out, "%02d.h5", 2, 2, True,
+                              progress.start, progress)
+    assert Progress(tmpdir/"progress").start == 5
+    assert [(out/f"{i:02d}.h5").read_binary() for i in range(5)] \
+                == [b"a", b"b", b"c", b"d", b"e"]
+
+def test_tar_resume(tmpdir):
+    fname = str(tmpdir/"out.tar")
+    msgs = [random.randbytes(n) for n in (10, 600, 2000, 5)]
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        progress = Progress(tmpdir/"progress")
+        msgs[:2] >> commit_count(progress, fd) >> write_tar_fd(fd, "%02d.h5")
+        os.write(fd, b"partial") # interrupted in the middle of a message
+
+        progress = Progress(tmpdir/"progress")
+        assert progress.start == 2
+        rewind(fd, progress)
+        msgs[2:] >> commit_count(progress, fd) \
+                 >> write_tar_fd(fd, "%02d.h5", progress.start)
+    finally:
+        os.close(fd)
+    with tarfile.open(fname) as tar:
+        assert tar.getnames() == [f"{i:02d}.h5" for i in range(4)]
+        assert [tar.extractfile(m).read() for m in tar] == msgs
+
+def test_tar_resume_index(tmpdir):
+    fname = str(tmpdir/"out.tar")
+    msgs = [bytes([65+i])*(100*i+5) for i in range(4)]
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        progress = Progress(tmpdir/"progress")
+        msgs[:2] >> commit_count(progress, fd) \
+                 >> write_tar_fd(fd, "%02d.h5", index=fname+".idx")
+
+        progress = Progress(tmpdir/"progress")
+        offset = rewind(fd, progress)
+        msgs[2:] >> commit_count(progress, fd) \
+                 >> write_tar_fd(fd, "%02d.h5", progress.start,
+                                 index=fname+".idx", offset=offset,
+                                 keep=progress.start)
+    finally:
+        os.close(fd)
+    with TarIndex(fname) as idx:
+        assert list(idx) == [f"{i:02d}.h5" for i in range(4)]
+        assert [bytes(idx[f"{i:02d}.h5"]) for i in range(4)] == msgs
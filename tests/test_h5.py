@@ -0,0 +1,71 @@
+import io
+import os
+
+import h5py  # type: ignore
+import numpy as np
+import pytest
+
+from lclstream.nng import load_h5
+from lclstream.stream_h5 import decode_h5, load_image, tensor_batches, write_h5
+
+def make_h5(i):
+    with io.BytesIO() as f:
+        with h5py.File(f, "w") as h:
+            h["data"] = np.arange(i, i+10)
+            h["scalars/energy"] = 1.5*i
+        return f.getvalue()
+
+def read_event(h):
+    return int(h["data"][0]), float(h["scalars/energy"][()])
+
+def test_load_image():
+    buf = make_h5(3)
+    assert load_image(buf, read_event) == load_h5(buf, read_event)
+    assert load_image(memoryview(buf), read_event) == (3, 4.5)
+    assert load_image(b"not hdf5", read_event) is None
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_decode_h5(workers):
+    msgs = [make_h5(i) for i in range(20)]
+    msgs.insert(5, b"not hdf5")
+    out = list(msgs >> decode_h5(read_event, workers, 3))
+    assert out[5] is None
+    del out[5]
+    assert out == [(i, 1.5*i) for i in range(20)]
+
+def test_tensor_batches():
+    msgs = [make_h5(i) for i in range(7)]
+    msgs.insert(2, b"not hdf5")
+    seen = []
+    for b in msgs >> tensor_batches(["data", "scalars/energy"], 3,
+                                    dtype={"data": np.float32}):
+        assert b["data"].dtype == np.float32
+        assert b["data"].shape[1:] == (10,)
+        seen.append((b["data"][:,0].copy(), b["scalars/energy"].copy()))
+    assert [len(x) for x, e in seen] == [3, 3, 1]
+    assert np.concatenate([x for x, e in seen]).tolist() == list(range(7))
+    assert np.concatenate([e for x, e in seen]).tolist() == [1.5*i for i in range(7)]
+
+    out = list(msgs >> tensor_batches(["data"], 3, drop_last=True))
+    assert len(out) == 2
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_write_h5(tmp_path, compression):
+    msgs = [make_h5(i) for i in range(10)]
+    msgs.insert(3, b"not hdf5")
+    pattern = str(tmp_path/"agg-%02d.h5")
+    # 4 events per chunk, each 10*8 + 8 bytes: roll over after 2 chunks
+    n = msgs >> write_h5(pattern, compression=compression,
+                         chunk_events=4, buffer_events=8, rollover=600)
+    assert n == 10
+
+    data, energy, events = [], [], []
+    for k in range(2):
+        with h5py.File(pattern % k, "r") as h:
+            data.append(h["data"][:])
+            energy.append(h["scalars/energy"][:])
+            events.append(h["event"][:])
+    assert not os.path.exists(pattern % 2)
+    assert np.concatenate(data)[:,0].tolist() == list(range(10))
+    assert np.concatenate(energy).tolist() == [1.5*i for i in range(10)]
+    assert np.concatenate(events).tolist() == [0, 1, 2] + list(range(4, 11))
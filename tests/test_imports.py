@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Modules that only some commands need, loaded on first use.
+heavy = ["h5py", "hdf5plugin", "numpy", "yaml", "certified"]
+# Wall-clock budget for importing the CLI (beyond the interpreter
+# itself).  Timing depends on the machine, so it is only checked
+# when set, e.g. LCLSTREAM_IMPORT_BUDGET_MS=300.
+budget_ms = os.environ.get("LCLSTREAM_IMPORT_BUDGET_MS")
+
+def import_times(module):
+    """ Cumulative import time (in microseconds) of each
+    top-level module imported along with `module`.
+    """
+    ans = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                          f"import {module}"],
+                         capture_output=True, text=True, check=True)
+    times = {}
+    for line in ans.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def test_lazy_imports():
+    times = import_times("lclstream.lclstream")
+    assert "lclstream.lclstream" in times
+    assert [m for m in heavy if m in times] == []
+
+@pytest.mark.skipif(budget_ms is None,
+                    reason="set LCLSTREAM_IMPORT_BUDGET_MS to check")
+def test_import_budget():
+    # best of 3, to ride out a busy machine
+    t = min(import_times("lclstream.lclstream")["lclstream.lclstream"]
+            for i in range(3))
+    assert t < float(budget_ms)*1000, f"Importing the CLI took {t/1000:.0f} ms."
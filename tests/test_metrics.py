@@ -0,0 +1,46 @@
+import json
+import threading
+
+from lclstream.metrics import Histogram, Metrics, measure, reporting
+
+def test_histogram():
+    h = Histogram([1, 10, 100])
+    for x in [0.5, 2, 3, 50, 500]:
+        h.observe(x)
+    assert h.counts == [1, 2, 1, 1]
+    assert h.count == 5 and h.sum == 555.5
+    assert h.quantile(0.5) == 10
+    assert h.quantile(0.99) == 500
+
+def test_measure(tmp_path):
+    m = Metrics()
+    msgs = [b"x"*n for n in (10, 300, 5000)]
+    with reporting(m, tmp_path/"m.jsonl", 100, None):
+        assert list(msgs >> measure(m)) == msgs
+    assert m.counters == {"messages": 3, "bytes": 5310}
+    assert m.histograms["message_bytes"].count == 3
+    assert m.histograms["sink_seconds"].count == 3
+
+    snap = json.loads((tmp_path/"m.jsonl").read_text())
+    assert snap["counters"]["bytes"] == 5310
+
+    m.write(tmp_path/"m.prom")
+    text = (tmp_path/"m.prom").read_text()
+    assert "lclstream_messages_total 3" in text
+    assert 'lclstream_message_bytes_bucket{le="+Inf"} 3' in text
+    assert "lclstream_wait_seconds_count 3" in text
+
+def test_concurrent_export():
+    # export while another thread keeps adding names
+    m = Metrics()
+    def grow():
+        for i in range(20000):
+            m.set(f"q{i}", i)
+            m.inc(f"c{i}")
+            m.histogram(f"h{i}").observe(1)
+    th = threading.Thread(target=grow)
+    th.start()
+    while th.is_alive():
+        m.prometheus()
+        m.snapshot()
+    th.join()
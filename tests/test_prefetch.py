@@ -0,0 +1,44 @@
+import random
+import mmap
+
+from lclstream import stream_prefetch
+from lclstream.stream_prefetch import prefetch
+from lclstream.metrics import Metrics
+
+def test_prefetch(tmpdir):
+    random.seed(4)
+    fnames = []
+    for i in range(20):
+        fname = tmpdir/f"{i:02d}.h5"
+        fname.write_binary(random.randbytes(random.randrange(0, 20000)))
+        fnames.append(fname)
+
+    # small depth, budget and mmap threshold to exercise all paths
+    m = Metrics()
+    out = list(prefetch(fnames, 3, 10000, 2, 8000, metrics=m))
+    assert 0 <= m.gauges["prefetch_queue"] <= 3
+    assert len(out) == len(fnames)
+    assert any(isinstance(x, mmap.mmap) for x in out)
+    for fname, x in zip(fnames, out):
+        assert fname.read_binary() == x[:]
+
+def test_prefetch_budget(tmpdir, monkeypatch):
+    # files larger than budget/depth: reads in flight count too
+    fnames = []
+    for i in range(10):
+        fname = tmpdir/f"{i:02d}.h5"
+        fname.write_binary(bytes([i])*4000)
+        fnames.append(fname)
+    started = []
+    out = []
+    read_file = stream_prefetch.read_file
+    def record(name, mmap_min):
+        started.append(name)
+        # 2 reads fit in the budget and 1 more is started when
+        # the consumer takes the next file, 8 without the budget.
+        assert len(started) - len(out) <= 3
+        return read_file(name, mmap_min)
+    monkeypatch.setattr(stream_prefetch, "read_file", record)
+    for x in prefetch(fnames, 8, 6000, 2):
+        out.append(bytes(x))
+    assert out == [bytes([i])*4000 for i in range(10)]
@@ -0,0 +1,107 @@
+import random
+import threading
+import time
+
+from pynng import Pull0  # type: ignore
+
+from lclstream.spool import Segment, Spool, spooled
+from lclstream.metrics import Metrics
+from lclstream.relay import Outlet, fan_out
+
+def test_spool_order(tmpdir):
+    msgs = [b"%d" % i for i in range(20)]
+    s = Spool(3, str(tmpdir))
+    for m in msgs[:10]:
+        s.put(m)
+    assert s.get() == msgs[0]
+    for m in msgs[10:]:
+        s.put(m)
+    s.close()
+    out = []
+    while (x := s.get()) is not None:
+        out.append(x)
+    assert out == msgs[1:]
+    assert s.total_spilled == 17
+
+def test_spool_budget(tmpdir):
+    msgs = [bytes([i])*100 for i in range(50)]
+    # 3 messages fit in memory, and each segment holds 5
+    s = Spool(100, str(tmpdir), max_bytes=300, segment_bytes=500)
+    for m in msgs:
+        s.put(m)
+    assert s.total_spilled == 47 and len(s.segments) == 10
+    assert s.peak_mem_bytes == 300
+    assert s.peak_spill_bytes == 47*108
+    out = [s.get() for m in msgs[:20]]
+    assert len(s.segments) == 7 # drained ones are removed
+    s.close()
+    while (x := s.get()) is not None:
+        out.append(x)
+    assert out == msgs
+    assert s.spill_bytes == 0 and not s.segments
+    assert s.peak_messages == 50
+
+def test_spool_threads(tmpdir, monkeypatch):
+    # disk writes don't hold up readers
+    written = threading.Event()
+    append = Segment.append
+    def slow_append(self, msg):
+        assert written.wait(5)
+        return append(self, msg)
+    monkeypatch.setattr(Segment, "append", slow_append)
+    s = Spool(2, str(tmpdir))
+    msgs = [b"%d" % i for i in range(200)]
+    def fill():
+        for m in msgs:
+            s.put(m)
+        s.close()
+    th = threading.Thread(target=fill)
+    th.start()
+    out = [s.get(), s.get()] # while the third is being written
+    written.set()
+    while (x := s.get()) is not None:
+        out.append(x)
+    th.join()
+    assert out == msgs
+
+def test_spooled(tmpdir):
+    random.seed(5)
+    msgs = [random.randbytes(1000) for i in range(100)]
+    m = Metrics()
+    out = []
+    for x in msgs >> spooled(10000, str(tmpdir), metrics=m):
+        out.append(x)
+    assert out == msgs
+    assert m.gauges["spool_messages"] == 0
+    assert m.gauges["spool_peak_mem_bytes"] <= 10000
+
+def recv_all(addr, out):
+    with Pull0(dial=addr, recv_timeout=2000) as sock:
+        while len(out) < 100:
+            out.append(sock.recv())
+
+def test_broadcast():
+    random.seed(11)
+    msgs = [random.randbytes(100) for i in range(100)]
+    addrs = ["tcp://127.0.0.1:50210", "tcp://127.0.0.1:50211"]
+    outlets = [Outlet(a, 4, "spill") for a in addrs]
+
+    res = [[], []]
+    ths = [threading.Thread(target=recv_all, args=(a, r))
+           for a, r in zip(addrs, res)]
+    for th in ths:
+        th.start()
+    assert msgs >> fan_out(outlets, "broadcast") == 100
+    for th in ths:
+        th.join()
+    assert res == [msgs, msgs]
+
+def test_close_deadline():
+    # nobody reads from this outlet
+    o = Outlet("tcp://127.0.0.1:50212", 4, "block")
+    for i in range(3):
+        o.put(b"x")
+    t0 = time.monotonic()
+    o.close(timeout=0.3)
+    assert time.monotonic() - t0 < 2
+    assert (o.sent, o.dropped) == (0, 3)
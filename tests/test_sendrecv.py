@@ -1,16 +1,22 @@
 import os
+import time
+import asyncio
+import threading
 from io import BytesIO
 import signal
 import random
 from pathlib import Path
 
 import h5py  # type: ignore
+import pynng  # type: ignore
 from pynng import Pull0, Push0  # type: ignore
 
 import pytest
 from typer.testing import CliRunner
 from lclstream.lclstream import app
-from lclstream.nng import puller
+from lclstream import nng
+from lclstream.nng import puller, pusher, apuller, aio_pusher
+from lclstream.metrics import Metrics
 
 from contextlib import contextmanager
 
@@ -77,6 +83,71 @@ def test_the_test(tmpdir):
         run_push(fnames, dial=addr)
     check_data(fnames, out)
 
+def run_apull(output, **args):
+    output.mkdir()
+    async def recv():
+        i = 0
+        async for x in apuller(**args):
+            with open(output/f"{i:02d}.h5", "wb") as f:
+                f.write( x )
+            i += 1
+    asyncio.run(recv())
+
+def test_apuller(tmpdir):
+    inp = tmpdir / "input"
+    out = tmpdir / "output"
+    fnames = gen_data(inp, 100, 1024)
+
+    addr = "tcp://127.0.0.1:50205"
+    def push():
+        with Push0(dial=addr) as socket:
+            for fname in fnames:
+                socket.send(open(fname, "rb").read())
+            time.sleep(0.5) # let the send queue drain
+    th = threading.Thread(target=push)
+    th.start()
+    run_apull(out, addr=addr, ndial=0)
+    th.join()
+    check_data(fnames, out)
+
+def test_aio_pusher(tmpdir):
+    inp = tmpdir / "input"
+    out = tmpdir / "output"
+    fnames = gen_data(inp, 100, 1024)
+
+    addr = "tcp://127.0.0.1:50206"
+    th = threading.Thread(target=run_pull, args=(out,),
+                          kwargs={"addr": addr, "ndial": 0})
+    th.start()
+    time.sleep(0.2)
+    msgs = [open(n, "rb").read() for n in fnames]
+    sizes = msgs >> aio_pusher(addr, 1)
+    assert list(sizes) == [1024]*len(fnames)
+    th.join()
+    check_data(fnames, out)
+
+def test_credits():
+    addr = "tcp://127.0.0.1:50207"
+    credit_addr = "tcp://127.0.0.1:50208"
+    msgs = [random.randbytes(1000) for i in range(50)]
+    stats = Metrics()
+    def push():
+        sizes = msgs >> pusher(addr, 0, {"send_buffer_size": 4},
+                               credits=credit_addr, metrics=stats)
+        assert list(sizes) == [1000]*len(msgs)
+        time.sleep(0.5) # let the send queue drain
+    th = threading.Thread(target=push)
+    th.start()
+    time.sleep(0.2)
+    out = []
+    for x in puller(addr, 1, credits=credit_addr, window=4):
+        out.append(x)
+        time.sleep(0.01) # slow consumer
+    th.join()
+    assert out == msgs
+    # the pusher ran out of credits behind the slow consumer
+    assert stats.counters["credit_wait_seconds"] > 0.1
+
 runner = CliRunner()
 
 def xtest_push(tmpdir):
@@ -138,3 +209,14 @@ def xtest_badpush():
     result = runner.invoke(app, ["push", "--ndial", "0",
                                  "--addr", addr ])
     assert result.exit_code != 0
+
+def test_private_fallback(monkeypatch):
+    # pynng internals used for zero-copy are optional
+    data = memoryview(b"some data")
+    msg = pynng.Message(b"some data")
+    assert bytes(nng.message_view(msg)) == b"some data"
+    monkeypatch.setattr(nng, "ffi", None)
+    assert nng.sendable(data) == b"some data"
+    class Message: # without _buffer
+        bytes = b"abc"
+    assert nng.message_view(Message()) == b"abc"
@@ -0,0 +1,67 @@
+import random
+import tarfile
+
+from lclstream.stream_seq import (
+    sequence, reorder, is_numbered, encode_seq, decode_seq
+)
+from lclstream.stream_tar import write_tar_fd
+from lclstream.metrics import Metrics
+
+def test_sequence():
+    msgs = [random.randbytes(n) for n in (0, 10, 100)]
+    out = list(msgs >> sequence(7, 5))
+    assert all(is_numbered(x) for x in out)
+    assert [(s, i0, i, bytes(x)) for s, i0, i, x in map(decode_seq, out)] \
+            == [(7, 5, 5+i, x) for i, x in enumerate(msgs)]
+
+def test_reorder():
+    msgs = [random.randbytes(10) for i in range(20)]
+    numbered = list(msgs >> sequence())
+    shuffled = numbered[:]
+    random.seed(3)
+    random.shuffle(shuffled)
+    out = list(shuffled >> reorder(window=100))
+    assert [i for i, x in out] == list(range(20))
+    assert [bytes(x) for i, x in out] == msgs
+
+def test_gaps_and_duplicates():
+    numbered = list([b"x"]*10 >> sequence())
+    # 3 is lost, 1 is repeated, 6 arrives after the window moves on
+    inp = [numbered[i] for i in (0, 1, 2, 1, 4, 5, 7, 8, 9, 6)]
+    m = Metrics()
+    out = [i for i, x in inp >> reorder(window=2, metrics=m)]
+    assert out == [0, 1, 2, 4, 5, 7, 8, 9, 6]
+    assert m.counters == {"gaps": 1, "duplicates": 1, "late": 1}
+
+def test_streams():
+    a = list([b"a"]*3 >> sequence(1))
+    b = list([b"b"]*3 >> sequence(2, 100))
+    inp = [a[1], b[2], a[0], b[0], b[1], a[2]]
+    out = [(i, bytes(x)) for i, x in inp >> reorder(window=4)]
+    assert [i for i, x in out if x == b"a"] == [0, 1, 2]
+    assert [i for i, x in out if x == b"b"] == [100, 101, 102]
+
+def test_large_numbers():
+    # the first message to arrive is not the first sent,
+    # and the stream starts far from zero
+    numbered = list([b"x"]*5 >> sequence(0, 10**6))
+    inp = numbered[2:] + numbered[:2]
+    m = Metrics()
+    out = [i for i, x in inp >> reorder(window=8, metrics=m)]
+    assert out == [10**6 + i for i in range(5)]
+    assert m.counters == {"gaps": 0, "duplicates": 0, "late": 0}
+
+    # a long run of losses is remembered as one range
+    inp = [encode_seq(0, 0, i, b"x") for i in (0, 10**9, 10**9+1, 5)]
+    m = Metrics()
+    out = [i for i, x in inp >> reorder(window=1, metrics=m)]
+    assert out == [0, 10**9, 10**9+1, 5]
+    assert m.counters == {"gaps": 10**9-2, "duplicates": 0, "late": 1}
+
+def test_numbered_tar(tmp_path):
+    fname = tmp_path/"out.tar"
+    with open(fname, "wb") as f:
+        [(3, b"three"), (9, b"nine")] >> write_tar_fd(f.fileno(), "%02d.h5",
+                                                      numbered=True)
+    with tarfile.open(fname) as tar:
+        assert tar.getnames() == ["03.h5", "09.h5"]
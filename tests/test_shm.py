@@ -0,0 +1,120 @@
+import os
+import multiprocessing
+import random
+import threading
+import time
+
+import pytest
+
+from lclstream.shm_ring import RingWriter, RingReader, write_shm
+
+def ring_name() -> str:
+    return f"lclstream-test-{os.getpid()}-{random.randrange(1<<30)}"
+
+def test_ring():
+    name = ring_name()
+    msgs = [random.randbytes(n) for n in (0, 10, 1000, 4096)]
+    w = RingWriter(name, slots=4, slot_size=4096)
+    with RingReader(name) as r:
+        seqs = [w.put(m) for m in msgs]
+        assert seqs == [0, 1, 2, 3]
+        out = []
+        for m in msgs:
+            seq, view = r.read()
+            out.append((seq, bytes(view)))
+        assert out == list(enumerate(msgs))
+        assert r.read(timeout=0.01) is None
+        with pytest.raises(ValueError):
+            w.put(bytes(4097))
+    w.close()
+
+def test_overwrite():
+    name = ring_name()
+    w = RingWriter(name, slots=4, slot_size=16, policy="overwrite")
+    with RingReader(name) as r:
+        for i in range(10):
+            w.put(b"%d" % i)
+        w.close()
+        out = [bytes(x) for x in r]
+        assert out == [b"6", b"7", b"8", b"9"]
+        assert r.lost == 6
+
+def test_block():
+    name = ring_name()
+    msgs = [random.randbytes(100) for i in range(50)]
+    ready = threading.Event()
+    out = []
+    lost = []
+    def read() -> None:
+        with RingReader(name, from_start=True) as r:
+            ready.set()
+            out.extend(bytes(x) for x in r)
+            lost.append(r.lost)
+    t = threading.Thread(target=read)
+    # readers attached before the first message see all of them
+    w = RingWriter(name, slots=4, slot_size=100)
+    t.start()
+    ready.wait()
+    for m in msgs:
+        w.put(m)
+    w.close()
+    t.join()
+    assert out == msgs and lost == [0]
+
+def test_idle_reader():
+    # a reader that is attached but stops reading
+    name = ring_name()
+    w = RingWriter(name, slots=4, slot_size=16)
+    with RingReader(name) as r:
+        w.put(b"x")
+        assert w.behind() == [(os.getpid(), 0)]
+        t0 = time.monotonic()
+        w.close(timeout=0.2)
+        assert time.monotonic() - t0 < 5
+
+def read_sizes(name, ready, q) -> None:
+    with RingReader(name, from_start=True) as r:
+        ready.set()
+        q.put([len(x) for x in r])
+
+def test_processes():
+    name = ring_name()
+    ctx = multiprocessing.get_context("spawn")
+    ready = [ctx.Event() for i in range(2)]
+    q = ctx.Queue()
+    w = RingWriter(name, slots=3, slot_size=1024)
+    procs = [ctx.Process(target=read_sizes, args=(name, e, q)) for e in ready]
+    for p in procs:
+        p.start()
+    for e in ready:
+        assert e.wait(30)
+    for i in range(20):
+        w.put(bytes(i*50))
+    w.close()
+    assert [q.get(timeout=30) for p in procs] == [[i*50 for i in range(20)]]*2
+    for p in procs:
+        p.join()
+
+def test_write_shm():
+    name = ring_name()
+    msgs = [random.randbytes(10) for i in range(20)]
+    ready = threading.Event()
+    out = []
+    def read() -> None:
+        while True: # until the sink has created the ring
+            try:
+                r = RingReader(name)
+                break
+            except (FileNotFoundError, ValueError, AssertionError):
+                pass # not created (or initialized) yet
+        ready.set()
+        with r:
+            out.extend(bytes(x) for x in r)
+    def gen():
+        assert ready.wait(30) # the sink creates the ring before asking for messages
+        yield from msgs
+    t = threading.Thread(target=read)
+    t.start()
+    assert (gen() >> write_shm(name, slots=2, slot_size=10)) == 20
+    t.join()
+    assert out == msgs
@@ -0,0 +1,103 @@
+import io
+import os
+import random
+import tarfile
+import threading
+import time
+
+from lclstream.stream_tar import (
+    write_tar, write_tar_fd, tar_header, PipeSplicer
+)
+from lclstream.tar_index import TarIndex
+
+class Stdout:
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+def test_write_tar_fd(tmpdir):
+    random.seed(7)
+    msgs = [random.randbytes(n) for n in (0, 1, 511, 512, 513, 10000)]
+
+    ref = Stdout()
+    msgs >> write_tar(ref, "%02d.h5")
+
+    fname = str(tmpdir/"out.tar")
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT)
+    try:
+        [memoryview(m) for m in msgs] >> write_tar_fd(fd, "%02d.h5")
+    finally:
+        os.close(fd)
+
+    out = open(fname, "rb").read()
+    assert out == ref.buffer.getvalue()
+    with tarfile.open(fname) as tar:
+        for i, m in enumerate(msgs):
+            assert tar.extractfile(f"{i:02d}.h5").read() == m
+
+def test_tar_header():
+    for name, size in [("00001.h5", 1234), ("a"*100, 0), ("a"*101, 5),
+                       ("é.h5", 3), ("big.h5", 8**11)]:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        assert tar_header(name, size) == info.tobuf(tarfile.DEFAULT_FORMAT,
+                                                    tarfile.ENCODING,
+                                                    "surrogateescape")
+
+def test_splice():
+    random.seed(8)
+    msgs = [random.randbytes(n) for n in (0, 100, 70000, 3*1024*1024)]
+    ref = Stdout()
+    msgs >> write_tar(ref, "%02d.h5")
+
+    r, w = os.pipe()
+    out = []
+    def read():
+        while True:
+            x = os.read(r, 1 << 16)
+            if not x:
+                break
+            out.append(x)
+    th = threading.Thread(target=read)
+    th.start()
+    try:
+        msgs >> write_tar_fd(w, "%02d.h5", splice=True)
+    finally:
+        os.close(w)
+    th.join()
+    os.close(r)
+    assert b"".join(out) == ref.buffer.getvalue()
+
+def test_splice_stalled():
+    r, w = os.pipe()
+    try:
+        splicer = PipeSplicer(w)
+        splicer.write([bytes(1000)])
+        t0 = time.monotonic()
+        splicer.close(timeout=0.2) # nobody reads
+        assert time.monotonic() - t0 < 2
+        os.close(r)
+        r = -1
+        splicer.close() # reader gone
+    finally:
+        os.close(w)
+        if r >= 0:
+            os.close(r)
+
+def test_tar_index(tmpdir):
+    random.seed(9)
+    msgs = [random.randbytes(n) for n in (0, 1, 511, 512, 513, 10000)]
+    fname = str(tmpdir/"out.tar")
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT)
+    try:
+        msgs >> write_tar_fd(fd, "%02d.h5", start=5, index=fname+".idx")
+    finally:
+        os.close(fd)
+
+    with TarIndex(fname) as idx:
+        assert len(idx) == len(msgs)
+        assert list(idx) == [f"{i+5:02d}.h5" for i in range(len(msgs))]
+        for i, m in enumerate(msgs):
+            v = idx[f"{i+5:02d}.h5"]
+            assert v == m
+            assert idx.seq(i+5) == m
+            v.release()
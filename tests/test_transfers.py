@@ -0,0 +1,76 @@
+import asyncio
+import json
+import tarfile
+
+import pytest
+
+from lclstream.transfers import (
+    load_configs, expand, unique_labels, request_all, cancel_all, merge
+)
+from lclstream.stream_tar import write_tar_fd
+
+def test_configs(tmp_path):
+    (tmp_path/"a.json").write_text(json.dumps(
+            [{"source": {"run": [1, 2]}, "det": "x"}, {"det": "y"}]))
+    (tmp_path/"b.yaml").write_text("det: z\n")
+    sources = load_configs(tmp_path/"a.json") + load_configs(tmp_path/"b.yaml")
+    assert [l for l, c in sources] == ["a-0", "a-1", "b"]
+    sources = expand(sources, "source.run")
+    assert sources[:2] == [("a-0-1", {"source": {"run": 1}, "det": "x"}),
+                           ("a-0-2", {"source": {"run": 2}, "det": "x"})]
+    assert [l for l, c in unique_labels([("a", {}), ("a", {}), ("b", {})])] \
+            == ["a", "a.1", "b"]
+
+class Response:
+    def __init__(self, status_code, ans):
+        self.status_code = status_code
+        self.ans = ans
+    async def json(self):
+        return self.ans
+
+class Session:
+    def __init__(self):
+        self.deleted = []
+    async def post(self, path, cfg):
+        await asyncio.sleep(0.01)
+        if cfg["n"] < 0:
+            return Response(400, {"error": "bad"})
+        if cfg["n"] == 0:
+            raise ConnectionError("unreachable")
+        return Response(201, {"id": cfg["n"], "url": f"tcp://x:{cfg['n']}"})
+    async def delete(self, path):
+        self.deleted.append(path)
+
+def test_requests():
+    s = Session()
+    ans = asyncio.run(request_all(s, [{"n": 1}, {"n": -1}, {"n": 3}]))
+    assert [ok for ok, x in ans] == [True, False, True]
+    assert ans[2][1]["url"] == "tcp://x:3"
+    asyncio.run(cancel_all(s, [1, 3]))
+
+    # one request failing outright doesn't lose the others
+    ans = asyncio.run(request_all(s, [{"n": 1}, {"n": 0}]))
+    assert ans[0] == (True, {"id": 1, "url": "tcp://x:1"})
+    assert ans[1] == (False, {"error": "unreachable"})
+    assert sorted(s.deleted) == ["/v1/transfers/1", "/v1/transfers/3"]
+
+def test_merge(tmp_path):
+    srcs = [("a/", lambda: iter([b"a0", b"a1"])),
+            ("b/", lambda: iter([b"b0", b"b1", b"b2"]))]
+    out = list(merge(srcs, "%d.h5"))
+    assert sorted(out) == [("a/0.h5", b"a0"), ("a/1.h5", b"a1"),
+                           ("b/0.h5", b"b0"), ("b/1.h5", b"b1"),
+                           ("b/2.h5", b"b2")]
+
+    with open(tmp_path/"out.tar", "wb") as f:
+        merge(srcs, "%d.h5") >> write_tar_fd(f.fileno(), "%d.h5",
+                                             numbered=True)
+    with tarfile.open(tmp_path/"out.tar") as tar:
+        assert sorted(tar.getnames()) == [n for n, x in sorted(out)]
+
+def test_merge_error():
+    def bad():
+        yield b"x"
+        raise ValueError("lost")
+    with pytest.raises(ValueError):
+        list(merge([("a/", bad), ("b/", lambda: iter([b"y"]))], "%d"))
@@ -1,10 +1,16 @@
+import hashlib
 import random
+import threading
 
+import pytest
 import stream
 
+import lclstream.stream_utils
 from lclstream.stream_utils import (
     hash_file,
-    file_writer
+    file_writer,
+    pmap,
+    lazy_pmap,
 )
 
 def test_hash(tmpdir):
@@ -25,3 +31,54 @@ def test_hash(tmpdir):
     assert H == 'f8d82ce7a4af1c298b611c4cfa2552cae21e0b565695ab1c40979593f2af0bc5'
 
 
+
+def test_pmap():
+    assert list(range(100) >> pmap(lambda x: x*x, 3)) \
+            == [x*x for x in range(100)]
+
+    # results are passed on while the input is waiting
+    got = threading.Event()
+    def slow():
+        yield 1
+        yield 2
+        assert got.wait(5), "Results were held back."
+        yield 3
+    out = []
+    for x in slow() >> pmap(lambda x: -x, 4):
+        out.append(x)
+        if x == -2:
+            got.set()
+    assert out == [-1, -2, -3]
+
+    def bad():
+        yield 1
+        raise ValueError("lost")
+    it = iter(bad() >> pmap(lambda x: x))
+    assert next(it) == 1
+    with pytest.raises(ValueError):
+        next(it)
+
+def test_lazy_pmap():
+    where = []
+    def fn(x):
+        where.append(threading.current_thread())
+        return x+1
+    main = threading.current_thread()
+    out = list([0, 0, 1, 0, 1] >> lazy_pmap(fn, lambda x: x > 0, 2))
+    assert out == [1, 1, 2, 1, 2]
+    # the pool takes over from the first item needing work
+    assert where[:2] == [main, main]
+    assert main not in where[2:]
+
+def test_file_writer_order(tmpdir, monkeypatch):
+    # the file is hashed while writing, never re-read as a whole
+    monkeypatch.setattr(lclstream.stream_utils, "hash_file", None)
+    random.seed(13)
+    data = random.randbytes(10000)
+    chunks = [(off, data[off:off+1000]) for off in range(0, 10000, 1000)]
+    chunks[2], chunks[5] = chunks[5], chunks[2]
+    digest = hashlib.sha256(data).hexdigest().encode()
+    fname = str(tmpdir/"out.bin")
+    n = sum(chunks + [(-1, digest)] >> file_writer(fname, 10000))
+    assert n == 10000
+    assert open(fname, "rb").read() == data
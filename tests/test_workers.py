@@ -0,0 +1,51 @@
+import os
+import sys
+import tarfile
+
+from lclstream.metrics import Metrics
+from lclstream.workers import run_workers
+from lclstream.lclstream import shard_args
+from lclstream.stream_tar import write_tar_fd
+
+def work(k, path) -> None:
+    m = Metrics()
+    m.inc("messages", k+1)
+    m.histogram("wait_seconds").observe(0.01*k)
+    m.write(path)
+    if k == 2:
+        sys.exit(3)
+
+def test_run_workers(tmp_path):
+    files = [tmp_path/f"{k}.jsonl" for k in range(3)]
+    stats = Metrics()
+    codes = run_workers(work, [(k, f) for k, f in enumerate(files)],
+                        files, stats, 0.1)
+    assert codes == [0, 0, 3]
+    assert stats.counters == {"messages": 6}
+    assert stats.histograms["wait_seconds"].count == 3
+
+def test_add():
+    a = Metrics()
+    a.inc("bytes", 10)
+    a.histogram("x", [1, 2]).observe(1.5)
+    b = Metrics()
+    b.add(a.snapshot())
+    b.add(a.snapshot())
+    assert b.counters == {"bytes": 20}
+    assert b.histograms["x"].counts == [0, 2, 0]
+    assert b.histograms["x"].max == 1.5
+
+def test_shard_names(tmp_path):
+    kwargs = {"names": "%05d.h5", "output_dir": None}
+    names = []
+    for k in range(3):
+        shard, kw = shard_args(k, str(tmp_path/"shard-%02d.tar"), kwargs)
+        fd = os.open(shard, os.O_WRONLY | os.O_CREAT)
+        try: # each worker numbers its own messages from 0
+            [b"a", b"b"] >> write_tar_fd(fd, kw["names"])
+        finally:
+            os.close(fd)
+        with tarfile.open(shard) as tar:
+            names += tar.getnames()
+    assert len(names) == 6 and len(set(names)) == 6
+    assert names[2] == "01-00000.h5"